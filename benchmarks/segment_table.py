@@ -0,0 +1,78 @@
+"""Benchmark the segment table against the former DataFrame based implementation.
+
+Usage::
+
+    python benchmarks/segment_table.py [N_SECTIONS] [POINTS_PER_SECTION]
+"""
+
+import sys
+import timeit
+
+import morphio
+import numpy as np
+import pandas as pd
+
+from connectome_tools.morphology import SegmentTable
+
+COLUMNS = ["x1", "y1", "z1", "x2", "y2", "z2"]
+
+
+def _dataframe_segment_points(morph, neurite_type):
+    """Former implementation of ``stats._segment_points``, kept for comparison."""
+    index = []
+    chunks = []
+    for sec in morph.iter():
+        if sec.type == neurite_type:
+            pts = sec.points
+            chunk = np.zeros((len(pts) - 1, 6))
+            chunk[:, 0:3] = pts[:-1]
+            chunk[:, 3:6] = pts[1:]
+            chunks.append(chunk)
+            index.extend((sec.id + 1, seg_id) for seg_id in range(len(pts) - 1))
+    return pd.DataFrame(
+        data=np.concatenate(chunks),
+        index=pd.MultiIndex.from_tuples(index, names=["section_id", "segment_id"]),
+        columns=COLUMNS,
+    )
+
+
+def _dataframe_length(morph):
+    df = _dataframe_segment_points(morph, morphio.SectionType.axon)
+    return np.linalg.norm(df[COLUMNS[:3]].values - df[COLUMNS[3:]].values, axis=1).sum()
+
+
+def _segment_table_length(morph):
+    return SegmentTable.from_morphology(morph, morphio.SectionType.axon).lengths().sum()
+
+
+def _build_morph(n_sections, points_per_section, seed=0):
+    """Build a random axon, with each section branching in two children."""
+    rng = np.random.default_rng(seed)
+    morph = morphio.mut.Morphology()
+    parents = []
+    for _ in range(n_sections):
+        parent, start = parents.pop(0) if parents else (None, np.zeros(3))
+        points = start + np.cumsum(rng.normal(0, 5, (points_per_section, 3)), axis=0)
+        points[0] = start
+        level = morphio.PointLevel(points.tolist(), [1.0] * points_per_section)
+        if parent is None:
+            section = morph.append_root_section(level, morphio.SectionType.axon)
+        else:
+            section = parent.append_section(level)
+        parents.extend([(section, points[-1])] * 2)
+    return morph.as_immutable()
+
+
+def main(n_sections=2000, points_per_section=20, repeat=5):
+    """Run the benchmark and print the results."""
+    morph = _build_morph(n_sections, points_per_section)
+    n_segments = len(SegmentTable.from_morphology(morph))
+    np.testing.assert_allclose(_dataframe_length(morph), _segment_table_length(morph))
+    print(f"Morphology with {n_sections} sections and {n_segments} segments")
+    for name, func in [("DataFrame", _dataframe_length), ("SegmentTable", _segment_table_length)]:
+        best = min(timeit.repeat(lambda f=func: f(morph), number=1, repeat=repeat))
+        print(f"{name:>12}: {best * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
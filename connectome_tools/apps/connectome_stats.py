@@ -8,7 +8,23 @@ import numpy as np
 from bluepysnap import Circuit
 
 from connectome_tools import stats
-from connectome_tools.utils import cell_group, get_node_population_mtypes, runalone
+from connectome_tools.distributed import DEFAULT_SHARD_SIZE
+from connectome_tools.morphology import NEURITE_TYPES, compute_morphology_lengths
+from connectome_tools.utils import (
+    DEFAULT_PARALLEL_BACKEND,
+    DIR_PATH,
+    EXISTING_FILE_PATH,
+    FILE_PATH,
+    PARALLEL_BACKENDS,
+    cell_group,
+    clean_slurm_env,
+    get_node_population_mtypes,
+    load_yaml,
+    parallel_backend,
+    runalone,
+    submitit_executor,
+    validate_config,
+)
 
 L = logging.getLogger(__name__)
 
@@ -32,14 +48,26 @@ def _format_sample(sample, short=False):
         return NA_VALUE, NA_VALUE, NA_VALUE, NA_VALUE
 
 
+def _load_executor_params(executor_config):
+    """Return the validated executor parameters read from the given file, or None."""
+    if executor_config is None:
+        return None
+    executor_config = load_yaml(executor_config)
+    validate_config(executor_config, schema_name="executor_config")
+    return executor_config["executor"]
+
+
 @click.group()
 @click.version_option()
 @click.option("--seed", type=int, default=0, help="Random generator seed", show_default=True)
+@click.pass_context
 @runalone
-def app(seed):
+def app(ctx, seed):
     """Calculate some connectome statistics."""
     logging.basicConfig(level=logging.WARN)
     np.random.seed(seed)
+    # the seed is used by the commands to derive the random stream of each group or pathway
+    ctx.obj = {"seed": seed}
 
 
 @app.command()
@@ -48,8 +76,25 @@ def app(seed):
 @click.option("-n", "--sample-size", type=int, default=100, help="Sample size", show_default=True)
 @click.option("--pre", default=None, help="Presynaptic node set", show_default=True)
 @click.option("--post", default=None, help="Postsynaptic node set", show_default=True)
+@click.option(
+    "--rel-error",
+    type=float,
+    default=None,
+    help="Stop sampling when the relative half-width of the 95% CI of the mean is below this value",
+    show_default=True,
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=100,
+    help="Batch size, used only with --rel-error",
+    show_default=True,
+)
 @click.option("--short", is_flag=True, default=False, help="Omit sampled values", show_default=True)
-def nsyn_per_connection(circuit, edge_population, sample_size, pre, post, short):
+@click.pass_obj
+def nsyn_per_connection(
+    obj, circuit, edge_population, sample_size, pre, post, rel_error, batch_size, short
+):  # pylint: disable=too-many-locals,too-many-arguments,too-many-positional-arguments
     """Mean connection synapse count per pathway."""
     edge_population = Circuit(circuit).edges[edge_population]
     pre_mtypes = get_node_population_mtypes(edge_population.source)
@@ -63,6 +108,9 @@ def nsyn_per_connection(circuit, edge_population, sample_size, pre, post, short)
             n=sample_size,
             pre=cell_group(pre_mtype, node_set=pre),
             post=cell_group(post_mtype, node_set=post),
+            rel_error=rel_error,
+            batch_size=batch_size,
+            seed=obj["seed"],
         )
         mean, std, size, values = _format_sample(sample, short)
         click.echo("\t".join([pre_mtype, post_mtype, mean, std, size, values]))
@@ -77,13 +125,20 @@ def nsyn_per_connection(circuit, edge_population, sample_size, pre, post, short)
 @click.option("-n", "--sample-size", type=int, default=100, help="Sample size", show_default=True)
 @click.option(
     "--neurite-type",
-    type=click.Choice(stats.NEURITE_TYPES),
-    default="axon",
-    help="Neurite type",
+    "neurite_types",
+    type=click.Choice(NEURITE_TYPES),
+    multiple=True,
+    default=["axon"],
+    help="Neurite type (can be repeated to calculate the density of each type)",
     show_default=True,
 )
 @click.option("-t", "--node-set", default=None, help="Sample node set", show_default=True)
-@click.option("--mask", default=None, help="Region of interest", show_default=True)
+@click.option(
+    "--mask",
+    "masks",
+    multiple=True,
+    help="Region of interest (can be repeated to calculate the density in each mask)",
+)
 @click.option(
     "--assume-syns-bouton",
     type=float,
@@ -91,37 +146,195 @@ def nsyn_per_connection(circuit, edge_population, sample_size, pre, post, short)
     help="Synapse count per bouton",
     show_default=True,
 )
+@click.option(
+    "--lengths",
+    type=EXISTING_FILE_PATH,
+    default=None,
+    help="Precomputed morphology lengths and extents (see morphology-lengths)",
+    show_default=True,
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Maximum number of concurrently running jobs (if -1 all CPUs are used)",
+    show_default=True,
+)
+@click.option(
+    "--backend",
+    type=click.Choice(PARALLEL_BACKENDS),
+    default=DEFAULT_PARALLEL_BACKEND,
+    help="Backend used to run the jobs in parallel",
+    show_default=True,
+)
+@click.option(
+    "--rel-error",
+    type=float,
+    default=None,
+    help="Stop sampling when the relative half-width of the 95% CI of the mean is below this value",
+    show_default=True,
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=100,
+    help="Batch size, used only with --rel-error",
+    show_default=True,
+)
+@click.option(
+    "--cache-dir",
+    type=DIR_PATH,
+    default=None,
+    help="Directory of the persistent cache of the densities of each cell",
+    show_default=True,
+)
+@click.option(
+    "--workdir",
+    type=DIR_PATH,
+    default=None,
+    help="Working directory of the distributed mode, where the densities are computed by Slurm",
+    show_default=True,
+)
+@click.option(
+    "--shard-size",
+    type=int,
+    default=DEFAULT_SHARD_SIZE,
+    help="Maximum number of cells processed by each Slurm job, used only with --workdir",
+    show_default=True,
+)
+@click.option(
+    "--executor-config",
+    type=EXISTING_FILE_PATH,
+    default=None,
+    help="Path to the executor config file (YAML), used with --workdir or --backend submitit",
+    show_default=True,
+)
+@click.option(
+    "--cluster",
+    default=None,
+    help="Submitit cluster, used with --workdir or --backend submitit ('local' to run locally)",
+    show_default=True,
+)
+@click.option(
+    "--synapse-positions",
+    is_flag=True,
+    default=False,
+    help="Count the synapses on the axon inside the masks using their positions, if available",
+    show_default=True,
+)
 @click.option("--short", is_flag=True, default=False, help="Omit sampled values", show_default=True)
+@click.pass_obj
 def bouton_density(
+    obj,
     circuit,
     edge_population,
     atlas_path,
     sample_size,
-    neurite_type,
+    neurite_types,
     node_set,
-    mask,
+    masks,
     assume_syns_bouton,
+    lengths,
+    jobs,
+    backend,
+    rel_error,
+    batch_size,
+    cache_dir,
+    workdir,
+    shard_size,
+    executor_config,
+    cluster,
+    synapse_positions,
     short,
-):  # pylint: disable=too-many-locals,too-many-arguments
+):  # pylint: disable=too-many-locals,too-many-arguments,too-many-positional-arguments
     """Mean bouton density per mtype."""
+    executor_params = _load_executor_params(executor_config)
+    distributed = None
+    if workdir is not None:
+        clean_slurm_env()
+        distributed = {"workdir": workdir, "shard_size": shard_size, "cluster": cluster}
+        if executor_params is not None:
+            distributed["executor"] = executor_params
     edge_population = Circuit(circuit).edges[edge_population]
     mtypes = get_node_population_mtypes(edge_population.source)
+    # With multiple neurite types or masks, each morphology is loaded once,
+    # and a column is added to the output for the neurite type or the mask.
+    neurite_type = list(neurite_types) if len(neurite_types) > 1 else neurite_types[0]
+    mask = list(masks) if len(masks) > 1 else next(iter(masks), None)
+    labels = [
+        (name, values)
+        for name, values in [("neurite_type", neurite_types), ("mask", masks)]
+        if len(values) > 1
+    ]
 
-    click.echo("\t".join(["mtype", "mean", "std", "size", "sample"]))
+    click.echo("\t".join(["mtype", *(name for name, _ in labels), "mean", "std", "size", "sample"]))
 
-    for mtype in itertools.chain(["*"], mtypes):
-        if mtype == "*":
-            group = node_set
-        else:
-            group = cell_group(mtype, node_set=node_set)
-        sample = stats.sample_bouton_density(
+    # the samples of all the mtypes are processed in a single pass
+    with parallel_backend(backend), submitit_executor(executor_params, cluster):
+        samples = stats.sample_bouton_density_groups(
             edge_population,
             n=sample_size,
+            groups=[node_set, *(cell_group(mtype, node_set=node_set) for mtype in mtypes)],
             neurite_type=neurite_type,
-            group=group,
             synapses_per_bouton=assume_syns_bouton,
             mask=mask,
             atlas_path=atlas_path,
+            n_jobs=jobs,
+            lengths=lengths,
+            rel_error=rel_error,
+            batch_size=batch_size,
+            cache_dir=cache_dir,
+            distributed=distributed,
+            seed=obj["seed"],
+            synapse_positions=synapse_positions,
         )
-        mean, std, size, values = _format_sample(sample, short)
-        click.echo("\t".join([mtype, mean, std, size, values]))
+    for mtype, sample in zip(itertools.chain(["*"], mtypes), samples):
+        for index in itertools.product(*(range(len(values)) for _, values in labels)):
+            mean, std, size, values = _format_sample(sample[(slice(None), *index)], short)
+            columns = [label_values[i] for (_, label_values), i in zip(labels, index)]
+            click.echo("\t".join([mtype, *columns, mean, std, size, values]))
+
+
+@app.command()
+@click.argument("circuit")
+@click.option("-p", "--edge-population", required=True, help="Edge population name")
+@click.option("-o", "--output", type=FILE_PATH, required=True, help="Path to output file (.npz)")
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Maximum number of concurrently running jobs (if -1 all CPUs are used)",
+    show_default=True,
+)
+@click.option(
+    "--backend",
+    type=click.Choice(PARALLEL_BACKENDS),
+    default=DEFAULT_PARALLEL_BACKEND,
+    help="Backend used to run the jobs in parallel",
+    show_default=True,
+)
+@click.option(
+    "--executor-config",
+    type=EXISTING_FILE_PATH,
+    default=None,
+    help="Path to the executor config file (YAML), used only with --backend submitit",
+    show_default=True,
+)
+@click.option(
+    "--cluster",
+    default=None,
+    help="Submitit cluster, used only with --backend submitit ('local' to run locally)",
+    show_default=True,
+)
+def morphology_lengths(
+    circuit, edge_population, output, jobs, backend, executor_config, cluster
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """Precompute the lengths of the morphologies of the source nodes."""
+    executor_params = _load_executor_params(executor_config)
+    edge_population = Circuit(circuit).edges[edge_population]
+    with parallel_backend(backend), submitit_executor(executor_params, cluster):
+        lengths = compute_morphology_lengths(edge_population.source, n_jobs=jobs)
+    lengths.save(output)
+    click.echo(f"Saved the lengths of {len(lengths)} morphologies to {output}")
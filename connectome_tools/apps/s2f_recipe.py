@@ -27,12 +27,17 @@ from connectome_tools.s2f_recipe import (
     override_mtype,
 )
 from connectome_tools.utils import (
+    DEFAULT_PARALLEL_BACKEND,
+    EXISTING_FILE_PATH,
+    PARALLEL_BACKENDS,
     get_edge_population_mtypes,
     load_yaml,
     runalone,
     setup_logging,
+    submitit_executor,
     timed,
     validate_config,
+    worker_pool,
 )
 
 L = logging.getLogger("s2f-recipe")
@@ -97,19 +102,28 @@ def validate_params(pathway_dict):
         return False, ALTERNATIVE_PARAMS_2.difference(pathway_dict)
 
 
-def execute_strategies(edge_population, atlas_path, strategies, jobs, base_seed):
+def execute_strategies(edge_population, atlas_path, strategies, jobs, base_seed, backend=None):
     """Execute each strategy sequentially."""
     strategy_results = []
-    for entry in strategies:
-        # entry must be a dict containing only one strategy
-        assert len(entry) == 1, "Only one key can be specified for the strategy"
-        strategy, kwargs = next(iter(entry.items()))
-        if strategy in TASKS_WITH_MASKS:
-            # NOTE: temporary hack until we have a way to get atlas_path from snap circuit
-            kwargs["atlas_path"] = atlas_path
-        executor = DISPATCH[strategy](jobs, base_seed)
-        results = executor.run(edge_population, **kwargs)
-        strategy_results.extend(results)
+    # the same workers are used by all the strategies, unless they override the backend
+    with worker_pool(jobs, backend):
+        for entry in strategies:
+            # entry must be a dict containing only one strategy
+            assert len(entry) == 1, "Only one key can be specified for the strategy"
+            strategy, kwargs = next(iter(entry.items()))
+            if strategy in TASKS_WITH_MASKS:
+                # NOTE: temporary hack until we have a way to get atlas_path from snap circuit
+                kwargs["atlas_path"] = atlas_path
+            # the parallel backend and the parameters of the submitit executor
+            # can be overridden in the configuration of each strategy
+            executor = DISPATCH[strategy](
+                jobs,
+                base_seed,
+                backend=kwargs.pop("backend", backend),
+                executor_params=kwargs.pop("executor", None),
+            )
+            results = executor.run(edge_population, **kwargs)
+            strategy_results.extend(results)
     return strategy_results
 
 
@@ -146,7 +160,9 @@ def clean_recipe(recipe, mtypes):
             del recipe[pathway]
 
 
-def generate_recipe(edge_population, atlas_path, strategies, jobs, base_seed):
+def generate_recipe(
+    edge_population, atlas_path, strategies, jobs, base_seed, backend=None
+):  # pylint: disable=too-many-arguments
     """Generate S2F recipe for `edge_population` using `strategies`.
 
     Args:
@@ -168,6 +184,7 @@ def generate_recipe(edge_population, atlas_path, strategies, jobs, base_seed):
             If 1 is given, no parallel computing code is used at all.
             For n_jobs below -1, (n_cpus + 1 + n_jobs) are used.
         base_seed: Base seed used to initialize the seed in the subprocesses.
+        backend: Name of the parallel backend used by default by the strategies.
 
     Returns:
         The recipe generated, i.e. a dictionary containing (pre_mtype, post_mtype) as key,
@@ -177,7 +194,7 @@ def generate_recipe(edge_population, atlas_path, strategies, jobs, base_seed):
 
     L.info("Execute strategies")
     task_results = execute_strategies(
-        edge_population, atlas_path, strategies, jobs=jobs, base_seed=base_seed
+        edge_population, atlas_path, strategies, jobs=jobs, base_seed=base_seed, backend=backend
     )
 
     L.info("Assemble the recipe")
@@ -207,7 +224,9 @@ def write_recipe(output_path, recipe, comment=None):
         tree.write(f, pretty_print=True, xml_declaration=True, encoding="utf-8")
 
 
-def main(circuit, edge_population, atlas_path, strategies, output, seed, jobs):
+def main(
+    circuit, edge_population, atlas_path, strategies, output, seed, jobs, backend=None
+):  # pylint: disable=too-many-arguments
     """Generate and write the recipe."""
     comment = (
         f"\nGenerated by s2f-recipe=={__version__}"
@@ -220,7 +239,9 @@ def main(circuit, edge_population, atlas_path, strategies, output, seed, jobs):
     np.random.seed(seed)
 
     edge_population = Circuit(circuit).edges[edge_population]
-    recipe = generate_recipe(edge_population, atlas_path, strategies, jobs, base_seed=seed)
+    recipe = generate_recipe(
+        edge_population, atlas_path, strategies, jobs, base_seed=seed, backend=backend
+    )
     write_recipe(output, recipe, comment=comment)
 
 
@@ -241,6 +262,26 @@ def main(circuit, edge_population, atlas_path, strategies, output, seed, jobs):
     help="Maximum number of concurrently running jobs (if -1 all CPUs are used)",
     show_default=True,
 )
+@click.option(
+    "--backend",
+    type=click.Choice(PARALLEL_BACKENDS),
+    default=DEFAULT_PARALLEL_BACKEND,
+    help="Backend used to run the jobs in parallel",
+    show_default=True,
+)
+@click.option(
+    "--executor-config",
+    type=EXISTING_FILE_PATH,
+    default=None,
+    help="Path to the executor config file (YAML), used only with the submitit backend",
+    show_default=True,
+)
+@click.option(
+    "--cluster",
+    default=None,
+    help="Submitit cluster, used only with the submitit backend ('local' to run locally)",
+    show_default=True,
+)
 @click.option(
     "--skip-validation",
     is_flag=True,
@@ -248,8 +289,19 @@ def main(circuit, edge_population, atlas_path, strategies, output, seed, jobs):
 )
 @runalone
 def app(
-    circuit, edge_population, atlas_path, strategies, output, verbose, seed, jobs, skip_validation
-):  # noqa: D301, pylint: disable=too-many-arguments
+    circuit,
+    edge_population,
+    atlas_path,
+    strategies,
+    output,
+    verbose,
+    seed,
+    jobs,
+    backend,
+    executor_config,
+    cluster,
+    skip_validation,
+):  # noqa: D301, pylint: disable=too-many-arguments,too-many-positional-arguments
     """S2F recipe generation.
 
     See the official documentation for more information
@@ -261,12 +313,18 @@ def app(
     """
     level = {0: logging.WARN, 1: logging.INFO, 2: logging.DEBUG}[verbose]
     setup_logging(level=level)
-    L.info("Configuration: circuit=%s, seed=%s, jobs=%s", circuit, seed, jobs)
+    L.info("Configuration: circuit=%s, seed=%s, jobs=%s, backend=%s", circuit, seed, jobs, backend)
     strategies = load_yaml(strategies)
+    executor_params = None
+    if executor_config is not None:
+        executor_config = load_yaml(executor_config)
+        executor_params = executor_config["executor"]
     if not skip_validation:
         validate_config(strategies, schema_name="strategies")
+        if executor_config is not None:
+            validate_config(executor_config, schema_name="executor_config")
     else:
         L.warning("Skipped configuration validation as requested")
 
-    with timed(L, "Recipe generation"):
-        main(circuit, edge_population, atlas_path, strategies, output, seed, jobs)
+    with timed(L, "Recipe generation"), submitit_executor(executor_params, cluster):
+        main(circuit, edge_population, atlas_path, strategies, output, seed, jobs, backend)
@@ -0,0 +1,116 @@
+"""Persistent cache of the values computed for each gid."""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+L = logging.getLogger(__name__)
+
+# to be incremented when the format of the files or the meaning of the cached values change
+CACHE_VERSION = 1
+
+
+class PersistentCache:
+    """Values computed for each gid, saved to a .npz file in the cache directory.
+
+    The name of the file is derived from the key, that should contain all the parameters
+    affecting the values. The file is rewritten atomically when new values are added,
+    so it can be shared by several processes: if two processes update the same file at the same
+    time, some values may be lost, and they are computed again when needed.
+    """
+
+    def __init__(self, directory, key):
+        """Initialize the cache, without loading the file.
+
+        Args:
+            directory (str): path to the cache directory, created if it doesn't exist.
+            key (dict): parameters identifying the values, serializable to JSON.
+        """
+        self.directory = str(directory)
+        self.key = json.dumps({"version": CACHE_VERSION, **key}, sort_keys=True)
+        digest = hashlib.sha256(self.key.encode()).hexdigest()[:32]
+        self.path = os.path.join(self.directory, f"{digest}.npz")
+        self._gids = None
+        self._values = None
+
+    def _load(self):
+        """Load the gids and the values from file, if they haven't been loaded yet."""
+        if self._gids is not None:
+            return
+        self._gids, self._values = np.empty(0, dtype=np.int64), np.empty(0)
+        if os.path.exists(self.path):
+            with np.load(self.path) as data:
+                if str(data["key"]) == self.key:
+                    self._gids, self._values = data["gids"], data["values"]
+                else:
+                    L.warning("Ignoring the cache file %s created with a different key", self.path)
+
+    def lookup(self, gids):
+        """Return which gids are cached, and their values (NaN for the gids not cached).
+
+        Args:
+            gids (np.ndarray): array of gids.
+
+        Returns:
+            tuple (found, values) of arrays with the same length of gids.
+        """
+        self._load()
+        gids = np.asarray(gids, dtype=np.int64)
+        if len(self._gids) == 0:
+            return np.zeros(len(gids), dtype=bool), np.full(len(gids), np.nan)
+        # the cached gids are sorted
+        idx = np.minimum(np.searchsorted(self._gids, gids), len(self._gids) - 1)
+        found = self._gids[idx] == gids
+        return found, np.where(found, self._values[idx], np.nan)
+
+    def update(self, gids, values):
+        """Add the values of the given gids, and save the cache to file.
+
+        Args:
+            gids (np.ndarray): array of gids.
+            values (np.ndarray): array of values, with the same length of gids.
+        """
+        # reload the file, to keep the values added by other processes in the meantime
+        self._gids = None
+        self._load()
+        gids = np.concatenate([self._gids, np.asarray(gids, dtype=np.int64)])
+        values = np.concatenate([self._values, np.asarray(values, dtype=np.float64)])
+        # keep the first occurrence of each gid, sorted by gid
+        self._gids, idx = np.unique(gids, return_index=True)
+        self._values = values[idx]
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".npz", delete=False) as f:
+            np.savez(f, key=self.key, gids=self._gids, values=self._values)
+        os.replace(f.name, self.path)
+
+
+def cached_values(compute, gids, caches):
+    """Return the values of the gids, computing only the gids missing from any of the caches.
+
+    Args:
+        compute: function called with an array of gids, and returning an array of values
+            with one row for each gid, and one value for each cache in each row
+            (the trailing dimensions are flattened).
+        gids (np.ndarray): array of gids.
+        caches (list): list of PersistentCache instances, one for each column of the values.
+
+    Returns:
+        np.ndarray: array of values, with shape (len(gids), len(caches)).
+    """
+    gids = np.asarray(gids, dtype=np.int64)
+    values = np.empty((len(gids), len(caches)))
+    missing = np.zeros(len(gids), dtype=bool)
+    for i, cache in enumerate(caches):
+        found, values[:, i] = cache.lookup(gids)
+        missing |= ~found
+    L.info("Found %s cached gids, computing %s gids", len(gids) - missing.sum(), missing.sum())
+    if missing.any():
+        computed = np.reshape(compute(gids[missing]), (np.count_nonzero(missing), len(caches)))
+        values[missing] = computed
+        for cache, column in zip(caches, computed.T):
+            cache.update(gids[missing], column)
+    return values
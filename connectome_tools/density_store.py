@@ -0,0 +1,116 @@
+"""Keys and persistent caches of the bouton densities computed for each gid."""
+
+import os
+
+import numpy as np
+
+from connectome_tools.cache import PersistentCache, cached_values
+from connectome_tools.morphology import morphology_container, morphology_dirs
+
+# values computed for each gid, neurite type and mask, in the order of the last dimension
+DENSITY_VALUES = ("synapse_count", "segment_length", "density")
+
+
+def _morphology_paths(node_population):
+    """Return the absolute paths of the morphology directories and container of the population."""
+    container = morphology_container(node_population)
+    paths = [path for _, path in morphology_dirs(node_population)]
+    return [os.path.abspath(path) for path in paths + ([container] if container else [])]
+
+
+def density_key(edge_population, circuit_config, synapses_per_bouton, synapse_positions=False):
+    """Return the parameters identifying the density values, independent from types and masks.
+
+    Args:
+        edge_population: edge population instance
+        circuit_config (str): path to the circuit config, or None if not available.
+        synapses_per_bouton (float): assumed number of synapses per bouton
+        synapse_positions (bool): True if the synapses inside the masks are counted by position.
+
+    Returns:
+        dict: the parameters, serializable to JSON.
+    """
+    edges_path = os.path.abspath(edge_population.h5_filepath)
+    # the key is unchanged when counting by segment, so that the existing caches remain valid
+    extra = {"synapse_positions": True} if synapse_positions else {}
+    return {
+        "circuit": os.path.abspath(circuit_config) if circuit_config else None,
+        "edges": edges_path,
+        # the saved densities are invalidated when the edge file is modified
+        "edges_mtime": os.path.getmtime(edges_path),
+        "edge_population": edge_population.name,
+        "node_population": edge_population.source.name,
+        # the saved values are not invalidated when the content of the morphologies changes
+        "morphologies": _morphology_paths(edge_population.source),
+        "synapses_per_bouton": float(synapses_per_bouton),
+        **extra,
+    }
+
+
+def distributed_density_key(key, neurite_type, mask, atlas_path):
+    """Return the parameters identifying the density values computed in distributed mode.
+
+    Args:
+        key (dict): parameters returned by ``density_key``.
+        neurite_type (str|list): neurite type, or list of neurite types.
+        mask (str|list): mask name, or list of mask names.
+        atlas_path (str): path to the atlas directory.
+
+    Returns:
+        dict: the parameters, serializable to JSON.
+    """
+    return {
+        **key,
+        "neurite_type": neurite_type or "axon",
+        "mask": mask,
+        "atlas": os.path.abspath(atlas_path) if mask is not None and atlas_path else None,
+        "values": list(DENSITY_VALUES),
+    }
+
+
+def density_caches(cache_dir, key, neurite_types, mask_names, atlas_path):
+    """Return the persistent caches of the density values, one for each type, mask and value.
+
+    The caches are returned in the same order of the flattened columns of the values,
+    iterating over the masks for each neurite type, and over DENSITY_VALUES for each mask.
+
+    Args:
+        cache_dir (str): path to the cache directory.
+        key (dict): parameters returned by ``density_key``.
+        neurite_types (list): neurite types (None is the axon).
+        mask_names (list): mask names (None to consider the whole neurites).
+        atlas_path (str): path to the atlas directory.
+
+    Returns:
+        list: list of PersistentCache instances.
+    """
+    return [
+        PersistentCache(
+            cache_dir,
+            {
+                **key,
+                "neurite_type": neurite_type or "axon",
+                "mask": mask_name,
+                "atlas": os.path.abspath(atlas_path) if mask_name and atlas_path else None,
+                "value": value,
+            },
+        )
+        for neurite_type in neurite_types
+        for mask_name in mask_names
+        for value in DENSITY_VALUES
+    ]
+
+
+def cached_densities(compute, gids, caches, shape):
+    """Return the density values of the given gids, reading and updating the caches.
+
+    Args:
+        compute: function called with the gids missing from the caches (see ``cached_values``).
+        gids (np.ndarray): array of gids.
+        caches (list): list of PersistentCache instances, returned by ``density_caches``.
+        shape (tuple): shape of the values of each gid, with DENSITY_VALUES as last dimension.
+
+    Returns:
+        np.ndarray: array of values, with shape (len(gids), *shape).
+    """
+    return np.reshape(cached_values(compute, gids, caches), (len(gids), *shape))
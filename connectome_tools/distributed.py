@@ -0,0 +1,143 @@
+"""Distributed computation of the values of each gid, split in shards executed as Slurm jobs."""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime
+from functools import cached_property
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from connectome_tools.slurm import execute_pending_tasks
+from connectome_tools.utils import setup_logging
+
+L = logging.getLogger(__name__)
+
+SHARDS_DIR = "shards"  # relative to the directory of the key, fixed
+SLURM_DIR = "slurm"  # relative to the directory of the key, fixed
+DEFAULT_SHARD_SIZE = 1000
+
+
+@dataclass(frozen=True, eq=False)
+class ComputeShard:
+    """Task that computes and saves the values of a shard of gids."""
+
+    func: Callable
+    gids: np.ndarray
+    base_path: Path
+    log_level: int
+
+    @cached_property
+    def name(self):
+        """Return the task name based on the gids."""
+        return f"gids:{self.gids[0]}-{self.gids[-1]},size:{len(self.gids)}"
+
+    @cached_property
+    def checksum(self):
+        """Return a checksum of the gids."""
+        return hashlib.md5(np.ascontiguousarray(self.gids, dtype=np.int64).tobytes()).hexdigest()
+
+    @cached_property
+    def output(self):
+        """Return the path to the file of the shard."""
+        return self.base_path / f"shard_{self.checksum}.npz"
+
+    def run(self):
+        """Run the task to compute and save the values of the shard."""
+        # setup logging in the new process
+        setup_logging(level=self.log_level)
+        L.info("Running sub task %r with output %s", self.name, self.output)
+        values = np.asarray(self.func(self.gids))
+        # the file is written atomically, so that only complete shards are found when resuming
+        with tempfile.NamedTemporaryFile(dir=self.base_path, suffix=".npz", delete=False) as f:
+            np.savez(f, gids=self.gids, values=values)
+        os.replace(f.name, self.output)
+
+    def complete(self):
+        """Return True if the shard has been already computed and saved."""
+        return self.output.is_file()
+
+
+def _load_shards(path):
+    """Return the sorted gids and the corresponding values saved in the shards in path."""
+    gids, values = [], []
+    for shard_path in sorted(path.glob("shard_*.npz")):
+        with np.load(shard_path) as data:
+            gids.append(data["gids"])
+            values.append(data["values"])
+    if not gids:
+        return np.empty(0, dtype=np.int64), None
+    gids, idx = np.unique(np.concatenate(gids), return_index=True)
+    return gids, np.concatenate(values)[idx]
+
+
+def _shard_tasks(func, gids, shards_path, shard_size):
+    """Return the tasks computing the given gids, split in shards of at most shard_size gids."""
+    n_shards = -(-len(gids) // shard_size)
+    return [
+        ComputeShard(func, shard, shards_path, L.getEffectiveLevel())
+        for shard in np.array_split(gids, n_shards)
+    ]
+
+
+def _slurm_folder(path):
+    """Return a new folder for the logs of the Slurm jobs."""
+    folder = path / SLURM_DIR / f"{datetime.now():%Y%m%dT%H%M%S}"
+    L.info("Slurm folder: %s", folder)
+    return folder
+
+
+def compute_distributed(
+    func, gids, workdir, key, shard_size=DEFAULT_SHARD_SIZE, executor_params=None, cluster=None
+):  # pylint: disable=too-many-arguments
+    """Return the values of the gids, computed by an array of Slurm jobs.
+
+    The missing gids are split in shards, and each shard is computed by a job that saves the values
+    to a file in the working directory. The shards already computed are found in the directory,
+    so the execution can be resumed after any failure, computing only the missing gids.
+
+    Args:
+        func: function called with an array of gids, and returning an array of values
+            with one row for each gid. It must be picklable, to be sent to the jobs.
+        gids (np.ndarray): array of gids.
+        workdir (str|Path): working directory, shared with the nodes executing the jobs.
+        key (dict): parameters identifying the values, serializable to JSON.
+            The shards are saved in a subdirectory of workdir that depends on the key.
+        shard_size (int): maximum number of gids computed by each job.
+        executor_params (dict): configuration parameters for the submitit executor.
+        cluster (str): Forces AutoExecutor to use the given environment.
+            Use "local" to run jobs locally, "debug" to run jobs in the same process.
+
+    Returns:
+        np.ndarray: array of values, with one row for each gid.
+
+    Raises:
+        RuntimeError: if some jobs failed.
+    """
+    gids = np.asarray(gids, dtype=np.int64)
+    key = json.dumps(key, sort_keys=True)
+    path = Path(workdir, hashlib.sha256(key.encode()).hexdigest()[:32])
+    shards_path = path / SHARDS_DIR
+    shards_path.mkdir(parents=True, exist_ok=True)
+    (path / "key.json").write_text(key, encoding="utf-8")
+
+    done, values = _load_shards(shards_path)
+    missing = np.setdiff1d(gids, done)
+    L.info("Found %s computed gids, computing %s gids", len(gids) - len(missing), len(missing))
+    if len(missing) > 0:
+        tasks = _shard_tasks(func, missing, shards_path, shard_size)
+        failures = execute_pending_tasks(
+            tasks, executor_params or {}, _slurm_folder(path), cluster=cluster
+        )
+        if failures:
+            raise RuntimeError(
+                f"{failures} of {len(tasks)} jobs didn't complete successfully, "
+                "run again to compute only the missing shards"
+            )
+        done, values = _load_shards(shards_path)
+    return values[np.searchsorted(done, gids)]
@@ -0,0 +1,286 @@
+"""Region of interest masks."""
+
+import os
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+from voxcell import ROIMask
+from voxcell.nexus.voxelbrain import Atlas
+
+# number of positions looked up at once, so that the temporary arrays fit in the cpu cache
+LOOKUP_BLOCK_SIZE = 1 << 15
+
+
+class CompactMask:
+    """Boolean mask cropped to the bounding box of its nonzero voxels.
+
+    The lookup returns the same values as ``VoxelData.lookup`` for the full mask, but only the
+    voxels inside the bounding box are kept in memory, and the positions outside the bounding box
+    are rejected without accessing the voxel data.
+    """
+
+    def __init__(self, raw, start, shape, voxel_dimensions, offset):
+        """Initialize the mask.
+
+        Args:
+            raw (np.ndarray): boolean voxel data of the cropped mask.
+            start (tuple): index of the first voxel of raw in the full mask.
+            shape (tuple): number of voxels in each dimension of the full mask.
+            voxel_dimensions (tuple): size of each voxel in space.
+            offset (tuple): offset of the full mask from the atlas origin.
+        """
+        self.raw = raw
+        self.start = np.asarray(start, dtype=np.int64)
+        self.shape = tuple(int(n) for n in shape)
+        self.voxel_dimensions = np.asarray(voxel_dimensions, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+        # computed as in voxcell, to reject the same positions at the upper bound of the atlas
+        self._upper_bound = self.offset + self.voxel_dimensions * self.shape
+        # bounding box of the cropped voxels in space, enlarged by one voxel on each side
+        # so that the rejection is conservative with respect to the rounding of the indices
+        corners = self.offset + self.voxel_dimensions * np.array(
+            [self.start - 1, self.start + self.raw.shape + 1], dtype=np.float64
+        )
+        self._box = np.sort(corners, axis=0).astype(np.float32)
+        # with negative voxel dimensions, voxcell clips the indices beyond the last voxel
+        # without considering them outside, so the positions can't be rejected along that axis
+        negative = self.voxel_dimensions < 0
+        self._box[0, negative], self._box[1, negative] = -np.inf, np.inf
+        if self.raw.size == 0:
+            # reject all the positions
+            self._box[0], self._box[1] = np.inf, -np.inf
+
+    @classmethod
+    def from_voxel_data(cls, voxel_data):
+        """Build the mask from the voxel data of the full mask.
+
+        Args:
+            voxel_data (voxcell.VoxelData): full mask, usually loaded as ``voxcell.ROIMask``.
+
+        Returns:
+            CompactMask: the new instance.
+        """
+        raw = voxel_data.raw
+        ndim = raw.ndim
+        start, stop = [], []
+        for axis in range(ndim):
+            nonzero = np.flatnonzero(np.any(raw, axis=tuple(a for a in range(ndim) if a != axis)))
+            start.append(nonzero[0] if len(nonzero) else 0)
+            stop.append(nonzero[-1] + 1 if len(nonzero) else 0)
+        selection = tuple(slice(i, j) for i, j in zip(start, stop))
+        return cls(
+            raw=np.ascontiguousarray(raw[selection], dtype=bool),
+            start=start,
+            shape=raw.shape,
+            voxel_dimensions=voxel_data.voxel_dimensions,
+            offset=voxel_data.offset,
+        )
+
+    @property
+    def nbytes(self):
+        """Return the number of bytes used by the cropped voxel data."""
+        return self.raw.nbytes
+
+    def intersects_spheres(self, centers, radii):
+        """Return which spheres may contain positions inside the mask.
+
+        The test is conservative: False is returned only for the spheres that don't intersect
+        the bounding box of the cropped voxels, enlarged by one voxel on each side.
+
+        Args:
+            centers (np.ndarray): array of centers (x, y, z).
+            radii (np.ndarray): array of radii.
+
+        Returns:
+            np.ndarray: boolean array, True for the spheres intersecting the bounding box.
+        """
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, len(self.shape))
+        # distance from the box along each axis, 0 if the center is inside the box along the axis
+        distances = np.maximum(np.maximum(self._box[0] - centers, centers - self._box[1]), 0)
+        return np.sum(distances**2, axis=1) <= np.asarray(radii, dtype=np.float64) ** 2
+
+    def lookup(self, positions, outer_value=False):
+        """Return the values of the voxels corresponding to the given positions.
+
+        Args:
+            positions (np.ndarray): array of positions (x, y, z).
+            outer_value: value to be returned for the positions outside the full mask.
+
+        Returns:
+            np.ndarray: boolean array with the values of the voxels.
+        """
+        positions = np.asarray(positions)
+        flat_positions = positions.reshape(-1, len(self.shape))
+        result = np.empty(len(flat_positions), dtype=bool)
+        for start in range(0, len(flat_positions), LOOKUP_BLOCK_SIZE):
+            block = slice(start, start + LOOKUP_BLOCK_SIZE)
+            result[block] = self._lookup_block(flat_positions[block], outer_value)
+        return result.reshape(positions.shape[:-1])
+
+    def _lookup_block(self, positions, outer_value):
+        """Return the values of the voxels corresponding to a block of positions."""
+        # the coordinates are arranged by axis, so that each axis is processed as a contiguous array
+        coords = np.ascontiguousarray(positions.transpose())
+        # fast rejection of the positions far from the cropped voxels
+        candidates = np.flatnonzero(
+            np.all(
+                (coords >= self._box[0, :, np.newaxis]) & (coords <= self._box[1, :, np.newaxis]),
+                axis=0,
+            )
+        )
+        if len(candidates) == len(positions):
+            result = self._lookup_coords(coords)
+        else:
+            result = np.zeros(len(positions), dtype=bool)
+            if len(candidates) > 0:
+                result[candidates] = self._lookup_coords(coords.take(candidates, axis=1))
+        if outer_value:
+            result[self._indices(coords)[1]] = outer_value
+        return result
+
+    def _indices(self, coords):
+        """Return the voxel indices in the full mask, and which positions are outside the mask."""
+        # calculated in the same way as voxcell.VoxelData.positions_to_indices
+        indices = (coords - self.offset[:, np.newaxis]) / self.voxel_dimensions[:, np.newaxis]
+        indices[np.abs(indices) < 1e-7] = 0.0
+        indices = np.floor(indices).astype(np.int64)
+        clipped = np.minimum(indices, np.array(self.shape)[:, np.newaxis] - 1)
+        # the indices beyond the last voxel are clipped, unless beyond the upper bound of the atlas
+        outer = np.any(indices < 0, axis=0) | np.any(
+            (indices > clipped) & (coords >= self._upper_bound[:, np.newaxis]), axis=0
+        )
+        return clipped, outer
+
+    def _lookup_coords(self, coords):
+        """Return the values of the voxels corresponding to the coordinates arranged by axis."""
+        indices, outer = self._indices(coords)
+        indices -= self.start[:, np.newaxis]
+        # the negative indices are converted to large unsigned integers, and rejected
+        inside = ~outer & np.all(
+            indices.view(np.uint64) < np.array(self.raw.shape)[:, np.newaxis], axis=0
+        )
+        # look up all the positions with flat indices, using the first voxel for the rejected ones
+        flat = np.where(inside, np.ravel_multi_index(indices, self.raw.shape, mode="clip"), 0)
+        return inside & self.raw.reshape(-1)[flat]
+
+
+@dataclass(frozen=True)
+class SharedMask:
+    """CompactMask saved to a .npy file, that can be memory-mapped by several processes."""
+
+    path: str
+    start: tuple
+    shape: tuple
+    voxel_dimensions: tuple
+    offset: tuple
+
+    @classmethod
+    def save(cls, mask, path):
+        """Save the voxel data of the mask to a .npy file.
+
+        Args:
+            mask (CompactMask): mask to be saved.
+            path (str): path to the .npy file.
+
+        Returns:
+            SharedMask: the new instance, that can be sent to other processes.
+        """
+        np.save(path, mask.raw)
+        return cls(
+            path=str(path),
+            start=tuple(mask.start.tolist()),
+            shape=mask.shape,
+            voxel_dimensions=tuple(mask.voxel_dimensions.tolist()),
+            offset=tuple(mask.offset.tolist()),
+        )
+
+    def load(self):
+        """Return the CompactMask, memory-mapping the voxel data read-only."""
+        return CompactMask(
+            np.load(self.path, mmap_mode="r"),
+            self.start,
+            self.shape,
+            self.voxel_dimensions,
+            self.offset,
+        )
+
+
+def load_mask(mask, atlas_path):
+    """Return the CompactMask corresponding to the given mask.
+
+    Args:
+        mask (str|CompactMask|SharedMask): name of the mask in the atlas, or mask instance.
+            If None, None is returned.
+        atlas_path (str): path to the atlas directory, used only if mask is a name.
+
+    Returns:
+        CompactMask: the mask, cropped to the bounding box of the region of interest.
+
+    Raises:
+        ValueError: if the mask is given by name and atlas_path is not given.
+    """
+    if mask is None or isinstance(mask, CompactMask):
+        return mask
+    elif isinstance(mask, SharedMask):
+        # the raw data are memory-mapped read-only and shared by all the processes
+        return mask.load()
+    elif atlas_path:
+        atlas = Atlas.open(atlas_path)
+        # keep only the bounding box of the region of interest
+        return CompactMask.from_voxel_data(atlas.load_data(mask, cls=ROIMask))
+
+    raise ValueError("Missing atlas path: using a mask requires atlas path to be defined")
+
+
+@contextmanager
+def shared_masks(mask, atlas_path):
+    """Save the masks to temporary files, and yield the corresponding shared masks.
+
+    Args:
+        mask (str|list): mask, or list of masks (see ``load_mask``), or None.
+        atlas_path (str): path to the atlas directory.
+
+    Yields:
+        SharedMask, or list of SharedMask if mask is a list, or None if mask is None.
+    """
+    if mask is None:
+        yield None
+        return
+    masks = mask if isinstance(mask, (list, tuple)) else [mask]
+    # the directory can be changed with the env variable TMPDIR
+    with tempfile.TemporaryDirectory(prefix="connectome_tools_masks_") as tmp_dir:
+        shared = [
+            SharedMask.save(load_mask(name, atlas_path), os.path.join(tmp_dir, f"mask_{i}.npy"))
+            for i, name in enumerate(masks)
+        ]
+        yield shared if isinstance(mask, (list, tuple)) else shared[0]
+
+
+@lru_cache(maxsize=2)
+def load_masks(masks, atlas_path):
+    """Load the tuple of masks once per process."""
+    return tuple(load_mask(mask, atlas_path) for mask in masks)
+
+
+def lookup_segments(mask, tables):
+    """Return which segments have both endpoints inside the mask, for each SegmentTable.
+
+    Args:
+        mask (CompactMask): mask instance.
+        tables (list): list of SegmentTable instances.
+
+    Returns:
+        list: list of boolean arrays, one for each table.
+    """
+    # the endpoints of all the tables are looked up with a single call to the mask
+    sizes = [len(table) for table in tables]
+    total = sum(sizes)
+    if total == 0:
+        return [np.zeros(0, dtype=bool) for _ in tables]
+    points = np.concatenate([table.starts for table in tables] + [table.ends for table in tables])
+    inside = mask.lookup(points, outer_value=False)
+    inside = inside[:total] & inside[total:]
+    return np.split(inside, np.cumsum(sizes)[:-1])
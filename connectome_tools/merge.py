@@ -4,10 +4,8 @@ import dataclasses
 import hashlib
 import json
 import logging
-import os
 import shutil
 import sys
-import time
 from dataclasses import dataclass
 from datetime import datetime
 from functools import cached_property
@@ -15,14 +13,13 @@ from pathlib import Path
 from typing import Dict, List
 from urllib.parse import quote_plus
 
-import importlib_resources
 import lxml.etree as ET
-import submitit
 import yaml
 
 from connectome_tools import __version__
 from connectome_tools.apps import s2f_recipe
-from connectome_tools.utils import DEFAULT_CONFIG_PATH, load_yaml, setup_logging, validate_config
+from connectome_tools.slurm import execute_pending_tasks
+from connectome_tools.utils import setup_logging
 
 L = logging.getLogger(__name__)
 
@@ -67,55 +64,6 @@ def _write_xml_tree(path, tree):
         tree.write(f, pretty_print=True, xml_declaration=True, encoding="utf-8")
 
 
-def _default_executor_params():
-    """Return the default parameters to be used when launching slurm jobs."""
-    ref = importlib_resources.files(__package__) / DEFAULT_CONFIG_PATH / "executor_config.yaml"
-    with importlib_resources.as_file(ref) as path:
-        executor_config = load_yaml(path)
-    validate_config(executor_config, schema_name="executor_config")
-    return executor_config["executor"]
-
-
-def execute_pending_tasks(pending_tasks, executor_params, folder, cluster=None):
-    """Submit the specified tasks to Slurm and wait for their completion.
-
-    Args:
-        pending_tasks (list): list of tasks to be executed.
-        executor_params (dict): configuration parameters for the executor.
-        folder (Path): folder where the executor logs will be saved.
-        cluster (str): Forces AutoExecutor to use the given environment.
-            Use "local" to run jobs locally, "debug" to run jobs in the same process.
-
-    Returns:
-        int: number of failed tasks.
-    """
-    executor = submitit.AutoExecutor(folder=folder, cluster=cluster)
-    executor.update_parameters(**_default_executor_params())
-    executor.update_parameters(**executor_params)
-    L.info("Submitting jobs...")
-    jobs = executor.map_array(lambda t: t.run(), pending_tasks)
-    L.info("Waiting for %s jobs to complete...", len(jobs))
-    # initial delay to allow sacct to return the status of the submitted jobs [NSETM-1678]
-    initial_sleep = float(os.getenv("SUBMIT_JOBS_INITIAL_SLEEP", "10"))
-    poll_frequency = float(os.getenv("SUBMIT_JOBS_POLL_FREQUENCY", "10"))
-    L.debug("SUBMIT_JOBS_INITIAL_SLEEP=%s", initial_sleep)
-    L.debug("SUBMIT_JOBS_POLL_FREQUENCY=%s", poll_frequency)
-    time.sleep(initial_sleep)
-    failures = 0
-    for n, job in enumerate(submitit.helpers.as_completed(jobs, poll_frequency=poll_frequency), 1):
-        try:
-            # don't need the result, but check if the job is successful
-            job.results()
-            result = "DONE"
-        except Exception as ex:  # pylint: disable=broad-except
-            result = f"FAILED [reason: {ex}]"
-            failures += 1
-        (task,) = job.submission().args
-        name = task.name
-        L.info("Completed job %s/%s, id=%s, name=%r: %s", n, len(jobs), job.job_id, name, result)
-    return failures
-
-
 def delete_temporary_dirs(workdir):
     """Delete the directories used for partial recipes and slurm logs.
 
@@ -0,0 +1,690 @@
+"""Morphology access and segment tables."""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache, partial
+
+import morphio
+import numpy as np
+from bluepysnap import BluepySnapError
+from bluepysnap.sonata_constants import Node
+
+from connectome_tools.utils import Task, run_parallel
+
+L = logging.getLogger(__name__)
+
+# extensions of the morphology files, in order of preference
+MORPHOLOGY_EXTENSIONS = ("h5", "asc", "swc")
+
+NEURITE_TYPES = {
+    "axon": morphio.SectionType.axon,
+    "basal_dendrite": morphio.SectionType.basal_dendrite,
+    "apical_dendrite": morphio.SectionType.apical_dendrite,
+}
+
+
+@dataclass(frozen=True, eq=False)
+class SegmentTable:
+    """Segments of a morphology, stored as contiguous arrays.
+
+    Each row ``i`` describes the segment going from ``starts[i]`` to ``ends[i]``.
+    The section ids are the ids assigned by MorphIO, that doesn't consider the soma a section:
+    they must be incremented by 1 to match the section ids stored in the edge files.
+    """
+
+    starts: np.ndarray
+    ends: np.ndarray
+    section_ids: np.ndarray
+    segment_ids: np.ndarray
+    section_types: np.ndarray
+
+    @classmethod
+    def from_morphology(cls, morph, section_type=None):
+        """Build the table from the flat arrays of an immutable MorphIO morphology.
+
+        Args:
+            morph (morphio.Morphology): morphology of interest.
+            section_type (morphio.SectionType): if not None, consider only this type of sections.
+
+        Returns:
+            SegmentTable: the segments of the morphology.
+        """
+        points = morph.points
+        offsets = morph.section_offsets.astype(np.int64)
+        types = morph.section_types
+        section_ids = np.arange(len(types))
+        if section_type is not None:
+            section_ids = section_ids[types == int(section_type)]
+        # each section with k points contributes k - 1 segments
+        counts = np.diff(offsets)[section_ids] - 1
+        total = counts.sum()
+        first_segment = np.repeat(np.cumsum(counts) - counts, counts)
+        segment_ids = np.arange(total) - first_segment
+        start_idx = np.repeat(offsets[section_ids], counts) + segment_ids
+        section_ids = np.repeat(section_ids, counts)
+        return cls(
+            starts=points[start_idx],
+            ends=points[start_idx + 1],
+            section_ids=section_ids,
+            segment_ids=segment_ids,
+            section_types=types[section_ids],
+        )
+
+    def __len__(self):
+        """Return the number of segments."""
+        return len(self.section_ids)
+
+    @property
+    def empty(self):
+        """Return True if the table doesn't contain any segment."""
+        return len(self) == 0
+
+    def lengths(self):
+        """Return the length of each segment."""
+        return np.linalg.norm(self.ends.astype(np.float64) - self.starts, axis=1)
+
+    def of_type(self, section_type):
+        """Return a new table with the segments of the given section type, or list of types."""
+        if isinstance(section_type, (list, tuple)):
+            return self.select(np.isin(self.section_types, [int(t) for t in section_type]))
+        return self.select(self.section_types == int(section_type))
+
+    def select(self, selection):
+        """Return a new table with the segments selected by a boolean mask or by indices."""
+        return SegmentTable(
+            starts=self.starts[selection],
+            ends=self.ends[selection],
+            section_ids=self.section_ids[selection],
+            segment_ids=self.segment_ids[selection],
+            section_types=self.section_types[selection],
+        )
+
+
+def transform_tables(tables, rotations, translations):
+    """Return the tables with the points rotated and translated, each one with its own transform.
+
+    The segments of all the tables are transformed with a single batched matrix multiplication,
+    instead of one multiplication per table. The transformed points are stored with the same
+    precision used by MorphIO, as if the morphologies were transformed before building the tables.
+
+    Args:
+        tables (list): list of SegmentTable instances.
+        rotations (np.ndarray): array of shape (len(tables), 3, 3) of rotation matrices.
+        translations (np.ndarray): array of shape (len(tables), 3) of translation vectors.
+
+    Returns:
+        list: the transformed SegmentTable instances.
+    """
+    sizes = [len(table) for table in tables]
+    if sum(sizes) == 0:
+        return list(tables)
+    dtype = tables[0].starts.dtype
+    # the start and end points of each segment, with shape (n_segments, 2, 3)
+    points = np.stack(
+        [
+            np.concatenate([table.starts for table in tables]),
+            np.concatenate([table.ends for table in tables]),
+        ],
+        axis=1,
+    ).astype(np.float64)
+    idx = np.repeat(np.arange(len(tables)), sizes)
+    rotations = np.asarray(rotations, dtype=np.float64).transpose(0, 2, 1)
+    translations = np.asarray(translations, dtype=np.float64)
+    points = (np.matmul(points, rotations[idx]) + translations[idx, np.newaxis]).astype(dtype)
+    return [
+        SegmentTable(
+            starts=starts,
+            ends=ends,
+            section_ids=table.section_ids,
+            segment_ids=table.segment_ids,
+            section_types=table.section_types,
+        )
+        for table, starts, ends in zip(
+            tables,
+            np.split(points[:, 0], np.cumsum(sizes)[:-1]),
+            np.split(points[:, 1], np.cumsum(sizes)[:-1]),
+        )
+    ]
+
+
+class MorphologyIndex:
+    """Extension of the morphology file to be used for each morphology name.
+
+    The index is built by listing the morphology directories once, so that the files
+    can be resolved without checking their existence one by one.
+    """
+
+    def __init__(self, extensions=None):
+        """Initialize the index.
+
+        Args:
+            extensions (dict): dict of morphology names and extensions.
+        """
+        self._extensions = dict(extensions or {})
+
+    @classmethod
+    def from_directories(cls, directories):
+        """Build the index listing the content of the given directories.
+
+        Args:
+            directories (list): list of tuples (extension, directory), in order of preference.
+                If a morphology is available with more than one extension,
+                the first extension in the list is used.
+
+        Returns:
+            MorphologyIndex: the new instance.
+        """
+        extensions = {}
+        for extension, directory in reversed(directories):
+            suffix = f".{extension}"
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.name.endswith(suffix) and entry.is_file():
+                            extensions[entry.name[: -len(suffix)]] = extension
+            except FileNotFoundError:
+                L.warning("Morphology directory not found: %s", directory)
+        return cls(extensions)
+
+    def subset(self, names):
+        """Return a new index containing only the given names, if available."""
+        return MorphologyIndex(
+            {name: self._extensions[name] for name in names if name in self._extensions}
+        )
+
+    def extension(self, name):
+        """Return the extension of the given morphology, or None if it's not indexed."""
+        return self._extensions.get(name)
+
+    def __contains__(self, name):
+        """Return True if the morphology is indexed."""
+        return name in self._extensions
+
+    def __len__(self):
+        """Return the number of indexed morphologies."""
+        return len(self._extensions)
+
+
+class MorphologyCache:
+    """LRU cache of morphology data, keyed by morphology name.
+
+    Hits and misses are counted, to be able to evaluate the effectiveness of the cache.
+    The cache can be used from multiple threads, but the same value may be loaded more than once
+    if it's requested concurrently.
+    """
+
+    def __init__(self, maxsize):
+        """Initialize the cache.
+
+        Args:
+            maxsize (int): maximum number of items kept in the cache (0 to disable the cache).
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Return the value cached for `key`, calling `load()` to get the value if missing.
+
+        Args:
+            key: hashable key identifying the morphology.
+            load: callable without arguments, returning the value to be cached.
+
+        Returns:
+            The cached or loaded value.
+        """
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+        # the value is loaded without holding the lock
+        value = load()
+        if self.maxsize > 0:
+            with self._lock:
+                self._data[key] = value
+                if len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def lookup(self, key):
+        """Return the value cached for `key`, or None if missing.
+
+        A miss isn't counted, since it's expected to be followed by a call to ``get``.
+
+        Args:
+            key: hashable key identifying the morphology.
+
+        Returns:
+            The cached value, or None.
+        """
+        with self._lock:
+            if key not in self._data:
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def clear(self):
+        """Remove all the items and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        """Return the number of cached items."""
+        return len(self._data)
+
+    def __repr__(self):
+        """Return a summary of the cache usage."""
+        return (
+            f"MorphologyCache(hits={self.hits}, misses={self.misses}, "
+            f"size={len(self)}, maxsize={self.maxsize})"
+        )
+
+
+class MorphologyLengths:
+    """Total and per-section lengths of a set of morphologies, indexed by morphology name.
+
+    The extent of each neurite type is stored as well, as the maximum distance of its points
+    from the origin of the morphology. Since it doesn't depend on the orientation of the cell,
+    it can be used to find the cells that cannot reach a region of interest.
+
+    The lengths can be saved to and loaded from a single .npz file, so that they can be
+    precomputed once for all the morphologies of a circuit.
+    """
+
+    def __init__(
+        self,
+        names,
+        neurite_types,
+        totals,
+        section_offsets,
+        section_lengths=None,
+        path=None,
+        extents=None,
+    ):  # pylint: disable=too-many-arguments
+        """Initialize the object.
+
+        Args:
+            names (np.ndarray): morphology names.
+            neurite_types (np.ndarray): neurite type names, corresponding to the columns of totals.
+            totals (np.ndarray): total length for each morphology and each neurite type.
+            section_offsets (np.ndarray): offsets of the sections of each morphology in
+                section_lengths, with length equal to len(names) + 1.
+            section_lengths (np.ndarray): concatenated lengths of the sections of the morphologies.
+                If None, they are loaded from path when accessed for the first time.
+            path (str|Path): path to the .npz file containing the data, if any.
+            extents (np.ndarray): maximum distance from the origin for each morphology and
+                each neurite type, or None if not available.
+        """
+        self.names = np.asarray(names, dtype=str)
+        self.neurite_types = np.asarray(neurite_types, dtype=str)
+        self.totals = np.asarray(totals, dtype=np.float64)
+        self.section_offsets = np.asarray(section_offsets, dtype=np.int64)
+        self._section_lengths = section_lengths
+        self._path = path
+        self.extents = None if extents is None else np.asarray(extents, dtype=np.float64)
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self._type_index = {name: i for i, name in enumerate(self.neurite_types)}
+
+    @classmethod
+    def from_segments(cls, items, neurite_types):
+        """Build the object from the segments of the morphologies.
+
+        Args:
+            items: iterable of tuples (name, segments, n_sections), where segments is the
+                SegmentTable of the morphology, and n_sections the number of its sections.
+            neurite_types (dict): dict of neurite type names and MorphIO section types.
+
+        Returns:
+            MorphologyLengths: the new instance.
+        """
+        names, totals, extents, section_lengths = [], [], [], []
+        for name, segments, n_sections in items:
+            lengths = segments.lengths()
+            distances = np.maximum(
+                np.linalg.norm(segments.starts, axis=1), np.linalg.norm(segments.ends, axis=1)
+            )
+            names.append(name)
+            totals.append(
+                [lengths[segments.section_types == int(t)].sum() for t in neurite_types.values()]
+            )
+            extents.append(
+                [
+                    distances[segments.section_types == int(t)].max(initial=0.0)
+                    for t in neurite_types.values()
+                ]
+            )
+            section_lengths.append(
+                np.bincount(segments.section_ids, weights=lengths, minlength=n_sections)
+            )
+        offsets = np.cumsum([0] + [len(item) for item in section_lengths])
+        return cls(
+            names=names,
+            neurite_types=list(neurite_types),
+            totals=np.reshape(totals, (len(names), len(neurite_types))),
+            section_offsets=offsets,
+            section_lengths=np.concatenate(section_lengths) if section_lengths else np.empty(0),
+            extents=np.reshape(extents, (len(names), len(neurite_types))),
+        )
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Concatenate several instances, having the same neurite types.
+
+        Args:
+            parts (list): list of MorphologyLengths instances.
+
+        Returns:
+            MorphologyLengths: the new instance.
+        """
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for part in parts:
+            offsets.append(part.section_offsets[1:] + offsets[-1][-1])
+        return cls(
+            names=np.concatenate([part.names for part in parts]),
+            neurite_types=parts[0].neurite_types,
+            totals=np.concatenate([part.totals for part in parts]),
+            section_offsets=np.concatenate(offsets),
+            section_lengths=np.concatenate([part.section_lengths for part in parts]),
+            extents=(
+                np.concatenate([part.extents for part in parts])
+                if all(part.extents is not None for part in parts)
+                else None
+            ),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load the lengths from a .npz file.
+
+        The lengths of the sections are loaded only when accessed for the first time.
+        The extents are not available if the file has been created by a previous version.
+
+        Args:
+            path (str|Path): path to the file.
+
+        Returns:
+            MorphologyLengths: the loaded instance.
+        """
+        with np.load(path) as data:
+            return cls(
+                names=data["names"],
+                neurite_types=data["neurite_types"],
+                totals=data["totals"],
+                section_offsets=data["section_offsets"],
+                path=path,
+                extents=data["extents"] if "extents" in data else None,
+            )
+
+    @property
+    def section_lengths(self):
+        """Return the concatenated lengths of the sections of all the morphologies."""
+        if self._section_lengths is None:
+            with np.load(self._path) as data:
+                self._section_lengths = data["section_lengths"]
+        return self._section_lengths
+
+    def save(self, path):
+        """Save the lengths to a .npz file.
+
+        Args:
+            path (str|Path): path to the file.
+        """
+        optional = {} if self.extents is None else {"extents": self.extents}
+        np.savez(
+            path,
+            names=self.names,
+            neurite_types=self.neurite_types,
+            totals=self.totals,
+            section_offsets=self.section_offsets,
+            section_lengths=self.section_lengths,
+            **optional,
+        )
+
+    def total_length(self, name, neurite_type):
+        """Return the total length of the given neurite type, for the given morphology.
+
+        Args:
+            name (str): morphology name.
+            neurite_type (str): neurite type name.
+
+        Returns:
+            float: the total length.
+        """
+        return self.totals[self._index[name], self._type_index[neurite_type]]
+
+    def extent(self, name, neurite_type):
+        """Return the maximum distance from the origin of the points of the given neurite type.
+
+        Args:
+            name (str): morphology name.
+            neurite_type (str): neurite type name.
+
+        Returns:
+            float: the extent, or inf if the extents are not available.
+        """
+        if self.extents is None:
+            return np.inf
+        return self.extents[self._index[name], self._type_index[neurite_type]]
+
+    def section_lengths_of(self, name):
+        """Return the lengths of the sections of the given morphology, indexed by section id.
+
+        Args:
+            name (str): morphology name.
+
+        Returns:
+            np.ndarray: the lengths of the sections.
+        """
+        i = self._index[name]
+        start, end = self.section_offsets[i], self.section_offsets[i + 1]
+        return self.section_lengths[start:end]
+
+    def __contains__(self, name):
+        """Return True if the morphology is present."""
+        return name in self._index
+
+    def __len__(self):
+        """Return the number of morphologies."""
+        return len(self.names)
+
+
+def morphology_dirs(node_population):
+    """Return the morphology directories of the population, in the order they are tried."""
+    config = node_population.config
+    alternate = config.get("alternate_morphologies") or {}
+    directories = {
+        "h5": alternate.get("h5v1"),
+        "asc": alternate.get("neurolucida-asc"),
+        "swc": config.get("morphologies_dir"),
+    }
+    if morphology_container(node_population):
+        # the h5 morphologies are read from the container, not from a directory
+        del directories["h5"]
+    return tuple((ext, directories[ext]) for ext in MORPHOLOGY_EXTENSIONS if directories.get(ext))
+
+
+def morphology_container(node_population):
+    """Return the path to the merged HDF5 morphology container of the population, or None."""
+    # a container is used when the h5v1 alternate morphology path is a file, not a directory
+    path = (node_population.config.get("alternate_morphologies") or {}).get("h5v1")
+    if path and _is_file(path):
+        return path
+    return None
+
+
+@lru_cache(maxsize=None)
+def _is_file(path):
+    """Return True if the path is a file, checking it once per process."""
+    return os.path.isfile(path)
+
+
+_CONTAINER_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=4)
+def _open_container(path):
+    """Open the merged HDF5 morphology container once per process."""
+    return morphio.Collection(str(path))
+
+
+@lru_cache(maxsize=4)
+def _morphology_index(directories):
+    """Return the index of the given morphology directories, listing them once per process."""
+    index = MorphologyIndex.from_directories(directories)
+    L.info("Indexed %s morphologies", len(index))
+    return index
+
+
+def sample_morphology_index(node_population, gids, lengths=None):
+    """Return the index of the morphology files, restricted to the morphologies of `gids`.
+
+    Args:
+        node_population: node population instance
+        gids: node ids
+        lengths (MorphologyLengths): optional precomputed lengths. The morphologies found in
+            lengths are not indexed, because they don't need to be loaded.
+
+    Returns:
+        MorphologyIndex: the index, or None if no morphology directory is defined,
+        or if all the morphologies are found in lengths.
+    """
+    # The returned index is small enough to be sent to the subprocesses together with the gids.
+    directories = morphology_dirs(node_population)
+    if not directories:
+        return None
+    names = np.unique(node_population.get(gids, properties=Node.MORPHOLOGY))
+    if lengths is not None:
+        names = [name for name in names if name not in lengths]
+        if not names:
+            # the morphology directories are not listed
+            return None
+    return _morphology_index(directories).subset(names)
+
+
+@lru_cache(maxsize=None)
+def morphology_cache():
+    """Return the morphology cache shared by all the tasks executed in the current process.
+
+    The maximum number of cached morphologies can be set with the env variable MORPH_CACHE_SIZE.
+
+    Returns:
+        MorphologyCache: the cache instance.
+    """
+    return MorphologyCache(maxsize=int(os.getenv("MORPH_CACHE_SIZE", "100")))
+
+
+def load_lengths(lengths):
+    """Return the MorphologyLengths instance, loading it from file if a path is given.
+
+    Args:
+        lengths (str|MorphologyLengths): path to the file, or instance, or None.
+
+    Returns:
+        MorphologyLengths: the instance, or None if lengths is None.
+    """
+    if lengths is None or isinstance(lengths, MorphologyLengths):
+        return lengths
+    return _load_lengths_file(str(lengths))
+
+
+@lru_cache(maxsize=4)
+def _load_lengths_file(path):
+    """Load the morphology lengths once per process."""
+    return MorphologyLengths.load(path)
+
+
+def compute_morphology_lengths(node_population, n_jobs=1):
+    """Compute the lengths of all the morphologies used by the nodes of a population.
+
+    Args:
+        node_population: node population instance
+        n_jobs (int): number of parallel jobs (1 for single process, -1 to use all the cpus)
+
+    Returns:
+        MorphologyLengths with the total length of each type in NEURITE_TYPES,
+        and the length of each section, for each morphology.
+    """
+    # keep only the first node id for each morphology
+    morphs = node_population.get(properties=Node.MORPHOLOGY).drop_duplicates()
+    L.info("Computing the lengths of %s morphologies", len(morphs))
+    if n_jobs == 1:
+        index = sample_morphology_index(node_population, morphs.index.to_numpy())
+        return _morphology_lengths_task(node_population, morphs.index.to_numpy(), index)
+    n_chunks = min(n_jobs if n_jobs > 0 else os.cpu_count() or 1, len(morphs)) or 1
+    tasks = [
+        Task(
+            _morphology_lengths_task,
+            node_population,
+            chunk,
+            sample_morphology_index(node_population, chunk),
+            task_group="compute_morphology_lengths",
+        )
+        for chunk in np.array_split(morphs.index.to_numpy(), n_chunks)
+    ]
+    results = run_parallel(tasks, n_jobs, base_seed=None)
+    return MorphologyLengths.concatenate([result.value for result in results])
+
+
+def _morphology_lengths_task(node_population, gids, index=None):
+    """Compute the lengths of the morphologies of the given gids."""
+
+    def _iter_segments():
+        for gid in gids:
+            morph = get_morph(node_population, gid, index=index)
+            name = node_population.get(gid, properties=Node.MORPHOLOGY)
+            yield name, SegmentTable.from_morphology(morph), len(morph.section_types)
+
+    return MorphologyLengths.from_segments(_iter_segments(), NEURITE_TYPES)
+
+
+def get_morph(node_population, gid, index=None):
+    """Return the untransformed morphology of `gid`."""
+    name = node_population.get(gid, properties=Node.MORPHOLOGY)
+    return morph_loader(node_population, gid, name, index)()
+
+
+def morph_loader(node_population, gid, name, index=None):
+    """Return a callable loading the untransformed morphology `name` of `gid`."""
+    # the file is resolved immediately, so that the callable can be called in background
+    container = morphology_container(node_population)
+    if container is not None:
+        return partial(_load_morph_from_container, container, name)
+    if index is not None:
+        # resolve the file without checking the existence of each file
+        ext = index.extension(name)
+        if ext is not None:
+            return partial(load_morph_file, node_population.morph.get_filepath(gid, extension=ext))
+    for ext in MORPHOLOGY_EXTENSIONS:
+        try:
+            filepath = node_population.morph.get_filepath(gid, extension=ext)
+            if filepath.is_file():
+                return partial(load_morph_file, filepath)
+        except BluepySnapError:  # raised, if morph dir not defined for extension in circuit config
+            continue
+
+    raise RuntimeError(f"Couldn't find morphology for node ({node_population.name}, {gid})")
+
+
+def load_morph_file(filepath):
+    """Load the untransformed morphology from file, in the same way as bluepysnap."""
+    return morphio.mut.Morphology(filepath).as_immutable()
+
+
+def _load_morph_from_container(container, name):
+    """Load the untransformed morphology from the merged HDF5 container."""
+    # Load as mutable to get the same section ordering as the morphologies
+    # loaded from single files with bluepysnap.
+    # The lock is needed because the container can be read from multiple threads.
+    with _CONTAINER_LOCK:
+        morph = _open_container(container).load(name, mutable=True)
+    return morph.as_immutable()
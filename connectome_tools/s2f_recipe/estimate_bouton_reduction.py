@@ -13,7 +13,7 @@ import numpy as np
 from connectome_tools.dataset import read_bouton_density
 from connectome_tools.s2f_recipe import BOUTON_REDUCTION_FACTOR
 from connectome_tools.s2f_recipe.utils import BaseExecutor
-from connectome_tools.stats import sample_bouton_density
+from connectome_tools.stats import sample_bouton_density_groups
 from connectome_tools.utils import Task
 
 L = logging.getLogger(__name__)
@@ -23,7 +23,7 @@ class Executor(BaseExecutor):
     """Executor class for estimate_bouton_reduction strategy."""
 
     # is_parallel is False because `_execute` needs to be executed in the main process,
-    # while the function `sample_bouton_density` will make use of subprocesses
+    # while the function `sample_bouton_density_groups` will make use of subprocesses
     is_parallel = False
 
     def prepare(self, edge_population, bio_data, atlas_path, sample=None, neurite_type=None):
@@ -51,11 +51,14 @@ class Executor(BaseExecutor):
             sample,
             neurite_type,
             n_jobs=self.jobs,
+            seed=self.base_seed,
             task_group=__name__,
         )
 
 
-def _execute(edge_population, atlas_path, bio_data, sample, neurite_type, n_jobs):
+def _execute(
+    edge_population, atlas_path, bio_data, sample, neurite_type, n_jobs, seed=None
+):  # pylint: disable=too-many-arguments
     if isinstance(bio_data, float):
         ref_value = bio_data
     else:
@@ -68,15 +71,21 @@ def _execute(edge_population, atlas_path, bio_data, sample, neurite_type, n_jobs
     else:
         if sample is None:
             sample = {}
-        values = sample_bouton_density(
+        (values,) = sample_bouton_density_groups(
             edge_population=edge_population,
             n=sample.get("size", 100),
+            groups=[sample.get("node_set", None)],
             atlas_path=atlas_path,
             neurite_type=neurite_type,
-            group=sample.get("node_set", None),
             mask=sample.get("mask", None),
             synapses_per_bouton=sample.get("assume_syns_bouton", 1.0),
+            lengths=sample.get("lengths", None),
+            rel_error=sample.get("rel_error", None),
+            batch_size=sample.get("batch_size", 100),
+            cache_dir=sample.get("cache_dir", None),
+            synapse_positions=sample.get("synapse_positions", False),
             n_jobs=n_jobs,
+            seed=seed,
         )
         value = np.nanmean(values)
 
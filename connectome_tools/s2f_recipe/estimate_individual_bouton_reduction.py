@@ -8,7 +8,6 @@ will be used for all m-types.
 """
 
 import logging
-from functools import partial
 
 import numpy as np
 import pandas as pd
@@ -16,7 +15,7 @@ import pandas as pd
 from connectome_tools.dataset import read_bouton_density
 from connectome_tools.s2f_recipe import BOUTON_REDUCTION_FACTOR
 from connectome_tools.s2f_recipe.utils import BaseExecutor
-from connectome_tools.stats import sample_bouton_density
+from connectome_tools.stats import sample_bouton_density_groups
 from connectome_tools.utils import Task, cell_group, get_edge_population_mtypes
 
 L = logging.getLogger(__name__)
@@ -26,7 +25,7 @@ class Executor(BaseExecutor):
     """Executor class for estimate_individual_bouton_reduction strategy."""
 
     # is_parallel is False because `_execute` needs to be executed in the main process,
-    # while the function `sample_bouton_density` will make use of subprocesses
+    # while the function `sample_bouton_density_groups` will make use of subprocesses
     is_parallel = False
 
     def prepare(self, edge_population, bio_data, atlas_path, sample=None, neurite_type=None):
@@ -61,8 +60,9 @@ class Executor(BaseExecutor):
         else:
             if sample is None:
                 sample = {}
-            estimate = partial(
-                _estimate_bouton_density,
+            # the samples of all the mtypes are processed at once, in a single pass
+            estimate = _estimate_bouton_densities(
+                mtypes=list(bio_data["mtype"].unique()),
                 node_set=sample.get("node_set", None),
                 edge_population=edge_population,
                 atlas_path=atlas_path,
@@ -70,8 +70,14 @@ class Executor(BaseExecutor):
                 neurite_type=neurite_type,
                 mask=sample.get("mask", None),
                 synapses_per_bouton=sample.get("assume_syns_bouton", 1.0),
+                lengths=sample.get("lengths", None),
+                rel_error=sample.get("rel_error", None),
+                batch_size=sample.get("batch_size", 100),
+                cache_dir=sample.get("cache_dir", None),
+                synapse_positions=sample.get("synapse_positions", False),
                 n_jobs=self.jobs,
-            )
+                seed=self.base_seed,
+            ).get
         for _, row in bio_data.iterrows():
             yield Task(_execute, row, estimate, task_group=__name__)
 
@@ -79,7 +85,7 @@ class Executor(BaseExecutor):
 def _execute(row, estimate):
     """Return a list of one tuple (pathway, params) for a single mtype."""
     mtype, ref_value = row["mtype"], row["mean"]
-    value = estimate(mtype=mtype)
+    value = estimate(mtype)
     if np.isnan(value):
         L.warning("Could not estimate '%s' bouton density, skipping", mtype)
         return []
@@ -87,8 +93,8 @@ def _execute(row, estimate):
     return [((mtype, "*"), {BOUTON_REDUCTION_FACTOR: ref_value / value})]
 
 
-def _estimate_bouton_density(mtype, node_set, **kwargs):
-    """Return the mean bouton density for the given mtype."""
-    group = cell_group(mtype, node_set=node_set)
-    values = sample_bouton_density(group=group, **kwargs)
-    return np.nanmean(values)
+def _estimate_bouton_densities(mtypes, node_set, **kwargs):
+    """Return a dict with the mean bouton density for each of the given mtypes."""
+    groups = [cell_group(mtype, node_set=node_set) for mtype in mtypes]
+    samples = sample_bouton_density_groups(groups=groups, **kwargs)
+    return {mtype: np.nanmean(values) for mtype, values in zip(mtypes, samples)}
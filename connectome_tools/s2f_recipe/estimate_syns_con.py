@@ -29,7 +29,9 @@ def _choose_formula(formulae, pathway, syn_class_map):
     return formulae[custom] or formulae[("*", "*")]
 
 
-def _estimate_nsyn(edge_population, pathway, sample_size, pre, post):
+def _estimate_nsyn(
+    edge_population, pathway, sample_size, pre, post, rel_error=None, batch_size=100, seed=None
+):  # pylint: disable=too-many-arguments
     """Mean nsyn for given mtype."""
     pre_mtype, post_mtype = pathway
     values = sample_pathway_synapse_count(
@@ -37,7 +39,11 @@ def _estimate_nsyn(edge_population, pathway, sample_size, pre, post):
         n=sample_size,
         pre=cell_group(pre_mtype, node_set=pre),
         post=cell_group(post_mtype, node_set=post),
+        rel_error=rel_error,
+        batch_size=batch_size,
+        seed=seed,
     )
+    L.debug("Sampled %s connections for pathway %s", values.size, pathway)
     # avoid RuntimeWarning: Mean of empty slice.
     return values.mean() if values.size else np.nan
 
@@ -98,6 +104,10 @@ class Executor(BaseExecutor):
                 sample_size=sample.get("size", 100),
                 pre=sample.get("pre", None),
                 post=sample.get("post", None),
+                rel_error=sample.get("rel_error", None),
+                batch_size=sample.get("batch_size", 100),
+                # the sample of each pathway doesn't depend on the task executing it
+                seed=self.base_seed,
             )
 
         syn_class_map = _get_syn_class_map(edge_population)
@@ -3,7 +3,13 @@
 import logging
 from abc import ABC, abstractmethod
 
-from connectome_tools.utils import run_parallel, run_sequential, timed
+from connectome_tools.utils import (
+    parallel_backend,
+    run_parallel,
+    run_sequential,
+    submitit_executor,
+    timed,
+)
 
 L = logging.getLogger(__name__)
 
@@ -11,15 +17,21 @@ L = logging.getLogger(__name__)
 class BaseExecutor(ABC):
     """Abstract class that can be subclassed for each strategy."""
 
-    def __init__(self, jobs=None, base_seed=None):
+    def __init__(self, jobs=None, base_seed=None, backend=None, executor_params=None):
         """Create a new executor.
 
         Args:
             jobs: number of concurrent jobs, only for parallel executions.
             base_seed: initial random seed, only for parallel executions.
+            backend: name of the parallel backend (see ``utils.PARALLEL_BACKENDS``),
+                or None to use the default backend.
+            executor_params: parameters of the executor of the submitit backend,
+                or None to use the default parameters.
         """
         self.jobs = jobs
         self.base_seed = base_seed
+        self.backend = backend
+        self.executor_params = executor_params
 
     @property
     @abstractmethod
@@ -32,7 +44,10 @@ class BaseExecutor(ABC):
 
     def run(self, *args, **kwargs):
         """Run the executor."""
-        with timed(L, f"Executed strategy {self.name}"):
+        # the backend is used also by the functions called in the main process by the tasks
+        backend = parallel_backend(self.backend)
+        executor = submitit_executor(self.executor_params)
+        with timed(L, f"Executed strategy {self.name}"), backend, executor:
             L.info("Preparing strategy '%s'...", self.name)
             tasks = self.prepare(*args, **kwargs)
             if self.is_parallel:
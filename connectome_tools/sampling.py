@@ -0,0 +1,134 @@
+"""Adaptive sampling of statistics."""
+
+import logging
+
+import numpy as np
+
+L = logging.getLogger(__name__)
+
+# quantile of the standard normal distribution, for the 95% confidence interval of the mean
+Z_95 = 1.959963984540054
+
+
+class RunningStats:
+    """Running mean and variance of the values added in batches, ignoring NaN.
+
+    The statistics are calculated independently for each column of the values, if any.
+    """
+
+    def __init__(self):
+        """Initialize the object without any value."""
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, values):
+        """Add a batch of values, combining the statistics of the batch with the current ones.
+
+        Args:
+            values (np.ndarray): array of values, with one row for each sample.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        count = np.count_nonzero(valid, axis=0)
+        zeros = np.where(valid, values, 0.0)
+        mean = np.divide(zeros.sum(axis=0), count, out=np.zeros(count.shape), where=count > 0)
+        m2 = np.where(valid, (values - mean) ** 2, 0.0).sum(axis=0)
+        total = self.count + count
+        delta = mean - self.mean
+        # parallel algorithm of Chan et al., to merge the statistics of two sets of values
+        self.mean = self.mean + np.divide(
+            delta * count, total, out=np.zeros(np.shape(total)), where=total > 0
+        )
+        self._m2 = (
+            self._m2
+            + m2
+            + np.divide(
+                delta**2 * self.count * count, total, out=np.zeros(np.shape(total)), where=total > 0
+            )
+        )
+        self.count = total
+
+    @property
+    def variance(self):
+        """Return the sample variance, or NaN if there are less than 2 values."""
+        count = np.asarray(self.count)
+        return np.divide(self._m2, count - 1, out=np.full(count.shape, np.nan), where=count > 1)
+
+    def rel_half_width(self):
+        """Return the half-width of the 95% confidence interval of the mean, relative to the mean.
+
+        Returns:
+            The relative half-width, or NaN if there are less than 2 values.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return Z_95 * np.sqrt(self.variance / self.count) / np.abs(self.mean)
+
+    def converged(self, rel_error):
+        """Return True if the relative half-width is below rel_error, for all the columns."""
+        return bool(np.all(self.rel_half_width() <= rel_error))
+
+
+def sample_adaptively(samples, compute, rel_error=None, batch_size=100):
+    """Calculate a statistic for the items of several samples, in batches.
+
+    The items in common to more than one sample are processed only once, and the items of all the
+    samples are processed together in each batch, in order of first occurrence.
+
+    If rel_error is None, all the items are processed in a single batch.
+    Otherwise, the items of each sample are processed in batches of batch_size items,
+    until the relative half-width of the 95% confidence interval of the mean is below rel_error,
+    or until all the items of the sample have been processed.
+
+    Args:
+        samples (list): list of arrays of items (for example, node ids), in random order.
+        compute: function called with an array of unique items, and returning an array
+            with the values calculated for each item, with one row for each item.
+        rel_error (float): target relative half-width of the confidence interval, or None.
+        batch_size (int): number of items processed for each sample in each batch.
+
+    Returns:
+        list of arrays of values, one for each sample. The number of rows is the number of items
+        that have been processed for each sample.
+    """
+    if rel_error is None:
+        batch_size = max((len(sample) for sample in samples), default=0)
+    items = np.empty(0, dtype=np.int64)
+    values = []
+    sizes = [0] * len(samples)
+    running = [RunningStats() for _ in samples]
+    active = [len(sample) > 0 for sample in samples]
+    while any(active):
+        batches = [
+            sample[size:][:batch_size] if is_active else sample[:0]
+            for sample, size, is_active in zip(samples, sizes, active)
+        ]
+        new_items = np.concatenate([np.empty(0, dtype=np.int64), *batches])
+        # keep the order of the first occurrence, and skip the items already processed
+        _, first = np.unique(new_items, return_index=True)
+        new_items = new_items[np.sort(first)]
+        new_items = new_items[~np.isin(new_items, items)]
+        if len(new_items) > 0:
+            values.append(compute(new_items))
+            items = np.concatenate([items, new_items])
+        for i, batch in enumerate(batches):
+            if not active[i]:
+                continue
+            sizes[i] += len(batch)
+            if sizes[i] == len(samples[i]):
+                active[i] = False
+            elif rel_error is not None:
+                running[i].update(_select(items, values, batch))
+                if running[i].converged(rel_error):
+                    L.info("Sample %s converged after %s of %s items", i, sizes[i], len(samples[i]))
+                    active[i] = False
+    if not values:
+        return [np.empty(0) for _ in samples]
+    return [_select(items, values, sample[:size]) for sample, size in zip(samples, sizes)]
+
+
+def _select(items, values, selection):
+    """Return the values corresponding to the selected items."""
+    values = np.concatenate(values)
+    order = np.argsort(items, kind="stable")
+    return values[order[np.searchsorted(items, selection, sorter=order)]]
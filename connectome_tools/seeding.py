@@ -0,0 +1,51 @@
+"""Random number generators independent of the order of execution."""
+
+import hashlib
+import json
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def _key_entropy(key):
+    """Return a non-negative integer identifying the key, serializable to JSON."""
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).digest()
+    return int.from_bytes(digest[:16], "little")
+
+
+def item_rng(seed, *key):
+    """Return the random number generator of the item identified by key.
+
+    The stream of random numbers depends only on the seed and on the key, so the same values
+    are drawn for the same item regardless of the order in which the items are processed,
+    of the number of jobs, and of the way the items are split in chunks.
+
+    Args:
+        seed (int): non-negative base seed.
+        *key: values identifying the item (for example, a pathway or a cell group),
+            serializable to JSON.
+
+    Returns:
+        np.random.Generator: the random number generator.
+    """
+    return np.random.default_rng(np.random.SeedSequence([seed, _key_entropy(key)]))
+
+
+@contextmanager
+def legacy_random_state(rng):
+    """Context manager to seed the global numpy random state from the given generator.
+
+    It can be used with the libraries using the global random state, and it's restored on exit.
+
+    Args:
+        rng (np.random.Generator): random number generator.
+
+    Yields:
+        None, the previous random state is restored when exiting the context.
+    """
+    state = np.random.get_state()
+    np.random.seed(rng.integers(2**32, dtype=np.uint64))
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
@@ -0,0 +1,51 @@
+"""Submission of tasks to Slurm with submitit."""
+
+import logging
+import os
+import time
+
+import submitit
+
+from connectome_tools.utils import default_executor_params
+
+L = logging.getLogger(__name__)
+
+
+def execute_pending_tasks(pending_tasks, executor_params, folder, cluster=None):
+    """Submit the specified tasks to Slurm and wait for their completion.
+
+    Args:
+        pending_tasks (list): list of tasks to be executed.
+        executor_params (dict): configuration parameters for the executor.
+        folder (Path): folder where the executor logs will be saved.
+        cluster (str): Forces AutoExecutor to use the given environment.
+            Use "local" to run jobs locally, "debug" to run jobs in the same process.
+
+    Returns:
+        int: number of failed tasks.
+    """
+    executor = submitit.AutoExecutor(folder=folder, cluster=cluster)
+    executor.update_parameters(**default_executor_params())
+    executor.update_parameters(**executor_params)
+    L.info("Submitting jobs...")
+    jobs = executor.map_array(lambda t: t.run(), pending_tasks)
+    L.info("Waiting for %s jobs to complete...", len(jobs))
+    # initial delay to allow sacct to return the status of the submitted jobs [NSETM-1678]
+    initial_sleep = float(os.getenv("SUBMIT_JOBS_INITIAL_SLEEP", "10"))
+    poll_frequency = float(os.getenv("SUBMIT_JOBS_POLL_FREQUENCY", "10"))
+    L.debug("SUBMIT_JOBS_INITIAL_SLEEP=%s", initial_sleep)
+    L.debug("SUBMIT_JOBS_POLL_FREQUENCY=%s", poll_frequency)
+    time.sleep(initial_sleep)
+    failures = 0
+    for n, job in enumerate(submitit.helpers.as_completed(jobs, poll_frequency=poll_frequency), 1):
+        try:
+            # don't need the result, but check if the job is successful
+            job.results()
+            result = "DONE"
+        except Exception as ex:  # pylint: disable=broad-except
+            result = f"FAILED [reason: {ex}]"
+            failures += 1
+        (task,) = job.submission().args
+        name = task.name
+        L.info("Completed job %s/%s, id=%s, name=%r: %s", n, len(jobs), job.job_id, name, result)
+    return failures
@@ -3,158 +3,275 @@
 import itertools
 import logging
 import os
+import threading
+import time
+from contextlib import nullcontext
+from functools import lru_cache, partial
 
 import numpy as np
-import pandas as pd
-from bluepysnap import BluepySnapError
-from morphio import SectionType
-from voxcell import ROIMask
-from voxcell.nexus.voxelbrain import Atlas
-
-from connectome_tools.utils import Properties, Task, run_parallel
+from bluepysnap import Circuit
+from bluepysnap.sonata_constants import Node
+
+from connectome_tools.density_store import (
+    DENSITY_VALUES,
+    cached_densities,
+    density_caches,
+    density_key,
+    distributed_density_key,
+)
+from connectome_tools.distributed import DEFAULT_SHARD_SIZE, compute_distributed
+from connectome_tools.mask import load_mask, load_masks, lookup_segments, shared_masks
+from connectome_tools.morphology import (
+    NEURITE_TYPES,
+    SegmentTable,
+    load_lengths,
+    morph_loader,
+    morphology_cache,
+    sample_morphology_index,
+    transform_tables,
+)
+from connectome_tools.sampling import RunningStats, sample_adaptively
+from connectome_tools.seeding import item_rng, legacy_random_state
+from connectome_tools.synapses import (
+    EfferentSynapses,
+    efferent_synapse_counts,
+    segment_keys,
+    use_synapse_positions,
+)
+from connectome_tools.utils import (
+    Task,
+    cost_balanced_chunks,
+    get_parallel_backend,
+    log_straggler_time,
+    prefetch,
+    run_parallel,
+)
 
 L = logging.getLogger(__name__)
 
-SEGMENT_START_COLS = [Properties.SEGMENT_X1, Properties.SEGMENT_Y1, Properties.SEGMENT_Z1]
-SEGMENT_END_COLS = [Properties.SEGMENT_X2, Properties.SEGMENT_Y2, Properties.SEGMENT_Z2]
-NEURITE_TYPES = {
-    "axon": SectionType.axon,
-    "basal_dendrite": SectionType.basal_dendrite,
-    "apical_dendrite": SectionType.apical_dendrite,
-}
-
+# The edge and node populations are shared by the tasks running in threads of the same process
+# with the threading backend, and reading them is not thread-safe, so the reads are serialized.
+# The morphologies are still loaded concurrently, since the callables passed to prefetch
+# don't access the populations.
+_POPULATION_LOCK = threading.Lock()
 
-def _segment_lengths(segments):
-    """Find segment lengths given a DataFrame returned by morph.spatial_index() query."""
-    return np.linalg.norm(
-        segments[SEGMENT_START_COLS].values - segments[SEGMENT_END_COLS].values, axis=1
-    )
 
+def _segment_points_loader(node_population, gid, neurite_type, cache=None, index=None):
+    """Return a callable returning the untransformed segments of the given type for `gid`."""
+    # The node properties are read immediately, and the morphology is loaded only when calling
+    # the returned callable, that doesn't access the node population (not thread-safe)
+    # and can be called from a background thread.
+    load_segments = _load_segments_loader(node_population, gid, cache, index)
+    return lambda: load_segments().of_type(neurite_type)
 
-def _segment_points(morph, neurite_type):
-    """Get segment points for given `morph`.
 
-    This code is a modified version of `bluepy.morphology.MorphHelper.segment_points`.
+def _cell_placements(node_population, gids):
+    """Return the rotation matrices and the positions of the given gids, read in bulk.
 
     Args:
-        morph (morphio.Morphology): morphology of interest
-        neurite_type (morphio.SectionType): neurite type
+        node_population: node population instance
+        gids: node ids
 
     Returns:
-        pandas DataFrame multi-indexed by (Properties.SECTION_ID, Properties.SEGMENT_ID);
-        and SEGMENT_START_COLS + SEGMENT_END_COLS as columns.
+        tuple of arrays with shape (len(gids), 3, 3) and (len(gids), 3).
     """
-    index = []
-    chunks = []
-
-    for sec in morph.iter():
-        if sec.type == neurite_type:
-            pts = sec.points
-            chunk = np.zeros((len(pts) - 1, 6))
-            chunk[:, 0:3] = pts[:-1]
-            chunk[:, 3:6] = pts[1:]
-            chunks.append(chunk)
-
-            # MorphIO doesn't consider the soma a section; makes sure we match the
-            # section ids from the edge file
-            index.extend((sec.id + 1, seg_id) for seg_id in range(len(pts) - 1))
-
-    if index:
-        return pd.DataFrame(
-            data=np.concatenate(chunks),
-            index=pd.MultiIndex.from_tuples(
-                index, names=[Properties.SECTION_ID, Properties.SEGMENT_ID]
-            ),
-            columns=[*SEGMENT_START_COLS, *SEGMENT_END_COLS],
-        )
-
-    return pd.DataFrame()
-
-
-def _load_mask(mask, atlas_path):
-    if mask is None:
+    gids = np.asarray(gids)
+    with _POPULATION_LOCK:
+        orientations = list(node_population.orientations(gids))
+        translations = node_population.positions(gids).to_numpy(dtype=np.float64)
+    rotations = np.reshape(np.asarray(orientations, dtype=np.float64), (-1, 3, 3))
+    return rotations, translations
+
+
+def _load_segments_loader(node_population, gid, cache=None, index=None):
+    """Return a callable returning the untransformed segments of all the neurites of `gid`."""
+    with _POPULATION_LOCK:
+        name = node_population.get(gid, properties=Node.MORPHOLOGY)
+        if cache is not None:
+            key = (node_population.h5_filepath, node_population.name, name)
+            cached = cache.lookup(key)
+            if cached is not None:
+                return lambda: cached
+        load_morph = morph_loader(node_population, gid, name, index)
+
+    def load():
+        return SegmentTable.from_morphology(load_morph())
+
+    if cache is None:
+        return load
+    return partial(cache.get, key, load)
+
+
+def _edge_population_ref(edge_population):
+    """Return the circuit config and the name of the edge population, or None if not available."""
+    # The returned tuple can be sent to the subprocesses instead of the edge population,
+    # so that the circuit is opened only once in each subprocess.
+    # pylint: disable=protected-access
+    circuit = getattr(edge_population, "_circuit", None)
+    # bluepysnap pickles the circuit as its config, and opens it again when unpickled
+    config = getattr(circuit, "_circuit_config_path", None)
+    if not isinstance(config, (str, os.PathLike)):
         return None
-    elif atlas_path:
-        atlas = Atlas.open(atlas_path)
-        return atlas.load_data(mask, cls=ROIMask)
-
-    raise ValueError("Missing atlas path: using a mask requires atlas path to be defined")
-
+    return str(config), edge_population.name
+
+
+@lru_cache(maxsize=4)
+def _open_edge_population(circuit_config, population_name):
+    """Open the edge population once per process."""
+    return Circuit(circuit_config).edges[population_name]
+
+
+def _total_lengths_loader(
+    node_population, gid, neurite_types, morph_cache=None, lengths=None, morph_index=None
+):  # pylint: disable=too-many-arguments
+    """Return a callable returning the total length of each neurite type for `gid`."""
+    # if the precomputed lengths are available, the morphology isn't loaded
+    if lengths is not None:
+        with _POPULATION_LOCK:
+            name = node_population.get(gid, properties=Node.MORPHOLOGY)
+        if name in lengths:
+            result = [lengths.total_length(name, neurite_type) for neurite_type in neurite_types]
+            return lambda: result
+        L.warning("Morphology %s not found in the precomputed lengths", name)
+    section_types = [NEURITE_TYPES[neurite_type] for neurite_type in neurite_types]
+    load_segments = _segment_points_loader(
+        node_population, gid, section_types, cache=morph_cache, index=morph_index
+    )
 
-def _get_morph(node_population, gid, transform):
-    """Helper function to get morphology from node population."""
-    for ext in ("h5", "asc", "swc"):
-        try:
-            if node_population.morph.get_filepath(gid, extension=ext).is_file():
-                return node_population.morph.get(gid, transform=transform, extension=ext)
-        except BluepySnapError:  # raised, if morph dir not defined for extension in circuit config
-            continue
+    def load():
+        segments = load_segments()
+        segment_lengths = segments.lengths()
+        return [segment_lengths[segments.section_types == int(t)].sum() for t in section_types]
 
-    raise RuntimeError(f"Couldn't find morphology for node ({node_population.name}, {gid})")
+    return load
 
 
-def _calc_bouton_density(edge_population, gid, neurite_type, synapses_per_bouton, mask):
+def _calc_bouton_density(
+    edge_population,
+    gid,
+    neurite_type,
+    synapses_per_bouton,
+    mask,
+    morph_cache=None,
+    lengths=None,
+    synapse_positions=False,
+):  # pylint: disable=too-many-arguments
     """Calculate bouton density for a given `gid`."""
-    if mask is None:
-        # count all efferent synapses and total segment length
-        synapse_count = sum(
-            n for *_, n in edge_population.iter_connections(source=gid, return_edge_count=True)
-        )
-        # total length of the segments
-        all_pts = _segment_points(
-            _get_morph(edge_population.source, gid, transform=False),
-            NEURITE_TYPES[neurite_type or "axon"],
-        )
-        segment_length = _segment_lengths(all_pts).sum()
-    else:
+    neurite_types = [neurite_type or "axon"]
+    if mask is not None:
         # Find all segments which endpoints fall into the region of interest.
-        all_pts = _segment_points(
-            _get_morph(edge_population.source, gid, transform=True),
-            NEURITE_TYPES[neurite_type or "axon"],
+        (((values,),),) = _masked_bouton_density_rows(
+            edge_population,
+            np.array([gid]),
+            neurite_types,
+            synapses_per_bouton,
+            [mask],
+            lengths,
+            morph_cache,
+            morph_index=None,
+            count_positions=use_synapse_positions(
+                edge_population, synapse_positions, neurite_types
+            ),
         )
-        mask1 = mask.lookup(all_pts[SEGMENT_START_COLS].values, outer_value=False)
-        mask2 = mask.lookup(all_pts[SEGMENT_END_COLS].values, outer_value=False)
-        filtered = all_pts[mask1 & mask2]
-
-        if filtered.empty:
-            L.warning(
-                "No %s segments found inside region of interest for GID %d", neurite_type, gid
-            )
-            return np.nan
-
-        # total length for those filtered segments
-        segment_length = _segment_lengths(filtered).sum()
+        return values[-1]
+    # count all efferent synapses, and the total length of the segments of each type
+    (density,) = _unmasked_bouton_densities(
+        efferent_synapse_counts(edge_population, [gid])[0],
+        synapses_per_bouton,
+        _total_lengths_loader(edge_population.source, gid, neurite_types, morph_cache, lengths)(),
+    )
+    return density
 
-        # Find axon segments with synapses; count synapses per each such segment.
-        cols = [Properties.PRE_SECTION_ID, Properties.PRE_SEGMENT_ID]
-        syn_per_segment = edge_population.efferent_edges(gid, properties=cols).groupby(cols).size()
 
-        # The section ids of the MultiIndex in the DataFrame returned by ``_segment_points``
-        # are returned in the same order they are read from file, but skipping the soma
-        # because MorphIO never considers the soma as a section.
-        #
-        # For this reason, assuming that the soma has section id 0 in the file,
-        # the resulting section ids of all the other sections is 1 less than the ones in the file.
-        #
-        # As a consequence, the section ids of the filtered points need to be incremented
-        # to be consistent with the values returned by ``edge_population.efferent_edges``,
-        # that are loaded using libsonata.
-        df = filtered.index.to_frame(index=False)
-        df[Properties.SECTION_ID] += 1
-        index = pd.MultiIndex.from_frame(df)
+def _unmasked_bouton_densities(synapse_count, synapses_per_bouton, segment_lengths):
+    """Calculate bouton density for each neurite type, without mask."""
+    return [
+        (1.0 * synapse_count / synapses_per_bouton) / segment_length
+        for segment_length in segment_lengths
+    ]
 
-        # count synapses on filtered segments
-        synapse_count = syn_per_segment.loc[syn_per_segment.index.intersection(index)].sum()
 
-    return (1.0 * synapse_count / synapses_per_bouton) / segment_length
+def _reachable_gids(node_population, gids, neurite_types, masks, lengths=None):
+    """Return which gids may have segments inside at least one of the masks."""
+    # The gids are rejected if the sphere centered in the soma, with radius equal to the
+    # precomputed extent of the morphology, doesn't intersect any mask.
+    # If the extents are not available, all the gids are considered reachable.
+    gids = np.asarray(gids)
+    if lengths is None or lengths.extents is None or len(gids) == 0:
+        return np.ones(len(gids), dtype=bool)
+    # the node properties of all the gids are read at once
+    with _POPULATION_LOCK:
+        names = np.asarray(node_population.get(gids, properties=Node.MORPHOLOGY))
+        positions = node_population.positions(gids).to_numpy()
+    radii = np.array(
+        [
+            (
+                max(lengths.extent(name, neurite_type) for neurite_type in neurite_types)
+                if name in lengths
+                else np.inf
+            )
+            for name in names
+        ]
+    )
+    return np.any([mask.intersects_spheres(positions, radii) for mask in masks], axis=0)
+
+
+def _masked_bouton_values(
+    gid, neurite_type, synapses_per_bouton, filtered, synapses, synapse_count=None
+):  # pylint: disable=too-many-arguments
+    """Calculate the DENSITY_VALUES of `gid`, using only the segments inside the mask."""
+    # if given, synapse_count is used instead of counting the synapses on the filtered segments
+    if filtered.empty:
+        L.warning("No %s segments found inside region of interest for GID %d", neurite_type, gid)
+        return [0, 0.0, np.nan]
+
+    # total length for those filtered segments
+    segment_length = filtered.lengths().sum()
+    if synapse_count is not None:
+        density = (1.0 * synapse_count / synapses_per_bouton) / segment_length
+        return [synapse_count, segment_length, density]
+
+    # The section ids in the SegmentTable returned by ``_segment_points_loader`` are assigned
+    # by MorphIO in the same order they are read from file, but skipping the soma
+    # because MorphIO never considers the soma as a section.
+    #
+    # For this reason, assuming that the soma has section id 0 in the file,
+    # the resulting section ids of all the other sections is 1 less than the ones in the file.
+    #
+    # As a consequence, the section ids of the filtered segments need to be incremented
+    # to be consistent with the values returned by ``edge_population.efferent_edges``,
+    # that are loaded using libsonata.
+    keys = segment_keys(filtered.section_ids, filtered.segment_ids, section_offset=1)
+
+    # count synapses on filtered segments
+    synapse_count = np.count_nonzero(np.isin(synapses.segment_keys(gid), keys))
+
+    density = (1.0 * synapse_count / synapses_per_bouton) / segment_length
+    return [synapse_count, segment_length, density]
 
 
 def bouton_density(
-    edge_population, gid, neurite_type=None, synapses_per_bouton=1.0, mask=None, atlas_path=None
-):
+    edge_population,
+    gid,
+    neurite_type=None,
+    synapses_per_bouton=1.0,
+    mask=None,
+    atlas_path=None,
+    lengths=None,
+    synapse_positions=False,
+):  # pylint: disable=too-many-arguments
     """Calculate bouton density for a given `gid`."""
-    mask = _load_mask(mask, atlas_path)
-    return _calc_bouton_density(edge_population, gid, neurite_type, synapses_per_bouton, mask)
+    mask = load_mask(mask, atlas_path)
+    lengths = load_lengths(lengths)
+    return _calc_bouton_density(
+        edge_population,
+        gid,
+        neurite_type,
+        synapses_per_bouton,
+        mask,
+        lengths=lengths,
+        synapse_positions=synapse_positions,
+    )
 
 
 def sample_bouton_density(
@@ -166,7 +283,14 @@ def sample_bouton_density(
     mask=None,
     atlas_path=None,
     n_jobs=1,
-):
+    lengths=None,
+    rel_error=None,
+    batch_size=100,
+    cache_dir=None,
+    distributed=None,
+    seed=None,
+    synapse_positions=False,
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments
     """Sample bouton density.
 
     Args:
@@ -174,25 +298,294 @@ def sample_bouton_density(
         n: sample size
         neurite_type: Type of neurite to parse for button density. It can be axon,
             basal_dendrite, or apical_dendrite. By default (i.e. None) parses the local axon.
+            If a list of types is given, each morphology is loaded only once,
+            and the density is calculated for each type.
         group: cell group
         synapses_per_bouton: assumed number of synapses per bouton
-        mask (str): region of interest mask
+        mask (str|list): region of interest mask, or list of masks. If a list is given,
+            each morphology is loaded only once, and the density is calculated in each mask.
         atlas_path (str): Path to the atlas directory
         n_jobs (int): number of parallel jobs (1 for single process, -1 to use all the cpus)
+        lengths (str|MorphologyLengths): optional precomputed morphology lengths, or path to
+            the file containing them. If provided, and if mask is None, the morphologies
+            are not loaded. If mask is not None, the morphologies that cannot reach any mask
+            according to their precomputed extent are not loaded, and their density is NaN.
+        rel_error (float): if not None, the cells are sampled in batches of batch_size cells,
+            until the half-width of the 95% confidence interval of the mean density,
+            relative to the mean, is below rel_error, or until n cells have been sampled.
+        batch_size (int): number of cells sampled in each batch, if rel_error is not None.
+        cache_dir (str): optional directory of the persistent cache of the densities. If given,
+            the densities already computed with the same circuit, edge and node population,
+            morphology directories, neurite type, mask and synapses per bouton are read from the
+            cache, and only the other densities are computed and added to the cache, together
+            with the synapse counts and the segment lengths used to calculate them.
+        distributed (dict): if given, the densities are computed by an array of Slurm jobs,
+            each one using n_jobs, and saved to the working directory, so that the execution
+            can be resumed computing only the missing gids. The dict can contain the keys:
+            ``workdir`` (required), the working directory shared with the jobs;
+            ``shard_size``, the maximum number of gids for each job;
+            ``executor``, the parameters of the submitit executor;
+            ``cluster``, the submitit cluster (use "local" to run the jobs on the current node).
+        seed (int): if given, the cells of each group are drawn from a random stream depending
+            only on the seed and on the group, so the sample doesn't depend on the other groups,
+            on the number of jobs, or on the execution order. Otherwise, the global numpy random
+            state is used.
+        synapse_positions (bool): if True, and if the edge population stores the efferent
+            positions of the synapses, the synapses inside the mask are counted by looking up
+            their positions, instead of matching them with the segments inside the mask.
+            The efferent positions are on the axon, so only the axon density uses them:
+            the synapses are matched by segment for the other neurite types, with a warning.
 
     Returns:
         numpy array of length min(n, N) with bouton density per cell,
         where N is the total number cells in the specified cell group.
+        If rel_error is not None, the length can be lower, and it's the number of sampled cells.
+        If neurite_type is a list, a dimension of length len(neurite_type) is added,
+        with one column for each neurite type.
+        If mask is a list, a dimension of length len(mask) is added,
+        with one column for each mask.
     """
-    gids = edge_population.source.ids(group)
+    # ValueError is raised if neurite_type or mask is an empty list, or if mask contains None
+    return sample_bouton_density_groups(
+        edge_population,
+        n,
+        [group],
+        neurite_type=neurite_type,
+        synapses_per_bouton=synapses_per_bouton,
+        mask=mask,
+        atlas_path=atlas_path,
+        n_jobs=n_jobs,
+        lengths=lengths,
+        rel_error=rel_error,
+        batch_size=batch_size,
+        cache_dir=cache_dir,
+        distributed=distributed,
+        seed=seed,
+        synapse_positions=synapse_positions,
+    )[0]
+
+
+def sample_bouton_density_groups(
+    edge_population,
+    n,
+    groups,
+    neurite_type=None,
+    synapses_per_bouton=1.0,
+    mask=None,
+    atlas_path=None,
+    n_jobs=1,
+    lengths=None,
+    rel_error=None,
+    batch_size=100,
+    cache_dir=None,
+    distributed=None,
+    seed=None,
+    synapse_positions=False,
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """Sample bouton density for several cell groups at once.
+
+    The samples of all the groups are drawn before calculating any density, in the same order
+    of the groups. The gids present in more than one sample are processed only once,
+    and all the gids are processed in a single pass, using the same subprocesses.
+    If rel_error is not None, the gids of all the groups are processed in batches, and the
+    sampling of each group stops when the target relative error is reached.
+
+    Args:
+        edge_population: edge population instance
+        n: sample size for each group
+        groups (list): list of cell groups
+        neurite_type: Type of neurite, or list of types (see ``sample_bouton_density``)
+        synapses_per_bouton: assumed number of synapses per bouton
+        mask (str|list): region of interest mask, or list of masks
+        atlas_path (str): Path to the atlas directory
+        n_jobs (int): number of parallel jobs (1 for single process, -1 to use all the cpus)
+        lengths (str|MorphologyLengths): optional precomputed morphology lengths, or path to
+            the file containing them.
+        rel_error (float): target relative half-width of the 95% confidence interval of the mean
+            density of each group, or None to sample n cells
+        batch_size (int): number of cells sampled in each batch for each group
+        cache_dir (str): optional directory of the persistent cache of the densities
+            (see ``sample_bouton_density``)
+        distributed (dict): optional parameters to compute the densities with an array of
+            Slurm jobs (see ``sample_bouton_density``)
+        seed (int): optional seed of the random stream of each group
+            (see ``sample_bouton_density``)
+        synapse_positions (bool): if True, count the synapses inside the mask using their
+            positions, when available (see ``sample_bouton_density``)
+
+    Returns:
+        list of numpy arrays, one for each group, with the same shape returned by
+        ``sample_bouton_density`` for the group.
+
+    Raises:
+        ValueError: if neurite_type is an empty list,
+            or if mask is an empty list, or if it contains None,
+            or if cache_dir or distributed is given and the masks are not given by name.
+    """
+    if isinstance(neurite_type, (list, tuple)) and len(neurite_type) == 0:
+        raise ValueError("The list of neurite types must be non-empty")
+    if isinstance(mask, (list, tuple)) and (len(mask) == 0 or None in mask):
+        raise ValueError("The list of masks must be non-empty and cannot contain None")
+    if (cache_dir is not None or distributed is not None) and not all(
+        item is None or isinstance(item, str) for item in _mask_names(mask)
+    ):
+        raise ValueError(
+            "Caching or distributing the densities requires the masks to be given by name"
+        )
+    return _sample_density_groups(
+        edge_population.source,
+        n,
+        groups,
+        _density_compute(
+            edge_population,
+            neurite_type,
+            synapses_per_bouton,
+            mask,
+            atlas_path,
+            lengths,
+            n_jobs,
+            cache_dir,
+            distributed,
+            synapse_positions,
+        ),
+        shape=_output_shape(0, neurite_type, mask)[1:],
+        rel_error=rel_error,
+        batch_size=batch_size,
+        seed=seed,
+    )
+
+
+def _density_compute(
+    edge_population,
+    neurite_type,
+    synapses_per_bouton,
+    mask,
+    atlas_path,
+    lengths,
+    n_jobs,
+    cache_dir,
+    distributed,
+    synapse_positions,
+):  # pylint: disable=too-many-arguments
+    """Return the function calculating the bouton density of an array of gids."""
+    # The synapse count and the segment length used to calculate the density of each gid
+    # are computed, cached and distributed together with the density, and dropped at the end.
+    # resolved once, so that the same counting method is used by all the jobs and in the keys
+    synapse_positions = mask is not None and use_synapse_positions(
+        edge_population, synapse_positions, _neurite_types(neurite_type)
+    )
+    compute = partial(
+        _sample_bouton_density_gids,
+        edge_population,
+        neurite_type=neurite_type,
+        synapses_per_bouton=synapses_per_bouton,
+        mask=mask,
+        atlas_path=atlas_path,
+        lengths=lengths,
+        n_jobs=n_jobs,
+        synapse_positions=synapse_positions,
+    )
+    if distributed is None and cache_dir is None:
+        return partial(_select_densities, compute)
+    population_ref = _edge_population_ref(edge_population)
+    key = density_key(
+        edge_population,
+        population_ref[0] if population_ref else None,
+        synapses_per_bouton,
+        synapse_positions,
+    )
+    if distributed is not None:
+        # the gids are processed by an array of Slurm jobs, each one using n_jobs
+        compute = partial(
+            compute_distributed,
+            compute,
+            workdir=distributed["workdir"],
+            key=distributed_density_key(key, neurite_type, mask, atlas_path),
+            shard_size=distributed.get("shard_size", DEFAULT_SHARD_SIZE),
+            executor_params=distributed.get("executor", None),
+            cluster=distributed.get("cluster", None),
+        )
+    if cache_dir is not None:
+        # only the gids missing from the persistent cache are processed
+        compute = partial(
+            cached_densities,
+            compute,
+            caches=density_caches(
+                cache_dir,
+                key,
+                neurite_type if isinstance(neurite_type, (list, tuple)) else [neurite_type],
+                _mask_names(mask),
+                atlas_path,
+            ),
+            shape=(*_output_shape(0, neurite_type, mask)[1:], len(DENSITY_VALUES)),
+        )
+    return partial(_select_densities, compute)
+
+
+def _select_densities(compute, gids):
+    """Return the densities of the gids, dropping the other DENSITY_VALUES returned by compute."""
+    return compute(gids)[..., DENSITY_VALUES.index("density")]
+
+
+def _sample_density_groups(
+    node_population, n, groups, compute, shape, rel_error, batch_size, seed
+):  # pylint: disable=too-many-arguments
+    """Sample the gids of each group, and calculate their densities with compute."""
+    # the gids are shuffled in adaptive mode, so that each batch is a random sample
+    samples = [
+        _sample_gids(
+            node_population,
+            n,
+            group,
+            shuffle=rel_error is not None,
+            rng=None if seed is None else item_rng(seed, "bouton_density", group),
+        )
+        for group in groups
+    ]
+    if sum(len(sample) for sample in samples) == 0:
+        return [np.empty((0, *shape)) for _ in samples]
+    results = sample_adaptively(samples, compute, rel_error=rel_error, batch_size=batch_size)
+    L.info("Sampled %s gids for %s groups", [len(result) for result in results], len(groups))
+    return results
+
+
+def _sample_gids(node_population, n, group, shuffle=False, rng=None):
+    """Return a random sample of at most n gids from the given group."""
+    # the gids are drawn using rng if given, or the global numpy random state otherwise
+    rng = np.random if rng is None else rng
+    gids = np.asarray(node_population.ids(group), dtype=np.int64)
     if len(gids) > n:
-        gids = np.random.choice(gids, size=n, replace=False)
+        gids = rng.choice(gids, size=n, replace=False)
     elif len(gids) == 0:
         L.warning("No GID matching selection for group '%s'", group)
-        return np.empty(0)
+    elif shuffle:
+        gids = rng.permutation(gids)
+    return gids
+
+
+def _sample_bouton_density_gids(
+    edge_population,
+    gids,
+    neurite_type,
+    synapses_per_bouton,
+    mask,
+    atlas_path,
+    lengths=None,
+    n_jobs=1,
+    synapse_positions=False,
+):  # pylint: disable=too-many-arguments
+    """Calculate the DENSITY_VALUES of the given gids, in a single process or in parallel."""
     if n_jobs == 1:
         return _sample_bouton_density_task(
-            edge_population, gids, neurite_type, synapses_per_bouton, mask, atlas_path
+            edge_population,
+            gids,
+            neurite_type,
+            synapses_per_bouton,
+            mask,
+            atlas_path,
+            lengths,
+            _sample_morphology_index(edge_population.source, gids, mask, lengths),
+            synapse_positions=synapse_positions,
         )
     else:
         return _sample_bouton_density_parallel(
@@ -202,21 +595,228 @@ def sample_bouton_density(
             synapses_per_bouton,
             mask,
             atlas_path,
+            lengths=lengths,
             n_jobs=n_jobs,
+            synapse_positions=synapse_positions,
         )
 
 
+def _sample_morphology_index(node_population, gids, mask, lengths):
+    """Return the index of the morphologies of the gids that need to be loaded, or None."""
+    # The morphology directories are listed only once, in the main process, and not at all
+    # when no mask is used and the lengths of all the morphologies are precomputed.
+    return sample_morphology_index(
+        node_population, gids, lengths=load_lengths(lengths) if mask is None else None
+    )
+
+
+def _iter_masked_bouton_density(
+    edge_population,
+    gids,
+    neurite_types,
+    synapses_per_bouton,
+    masks,
+    morph_cache,
+    synapses,
+    morph_index=None,
+    count_positions=False,
+):  # pylint: disable=too-many-arguments,too-many-locals
+    """Yield the DENSITY_VALUES of each gid for each neurite type and mask.
+
+    The segments of consecutive gids are accumulated until MASK_LOOKUP_SEGMENTS is reached,
+    so that the cells are placed with a single batched transformation of the cached segments,
+    and the mask is looked up with a few large calls instead of two calls per gid.
+
+    Args:
+        edge_population: edge population instance
+        gids: source node ids
+        neurite_types (list): neurite type names
+        synapses_per_bouton: assumed number of synapses per bouton
+        masks (list): CompactMask instances
+        morph_cache (MorphologyCache): cache of untransformed segments
+        synapses (EfferentSynapses): efferent synapses of the gids
+        morph_index (MorphologyIndex): optional index of the morphology files
+        count_positions (bool): if True, the synapses on the axon inside each mask are counted
+            by position, and synapses must have been loaded with positions. The synapses are
+            matched by segment for the other neurite types.
+
+    Yields:
+        nested lists of values, indexed by neurite type, mask and value, for each gid.
+    """
+    batch_size = int(os.getenv("MASK_LOOKUP_SEGMENTS", "1000000"))
+    section_types = [NEURITE_TYPES[neurite_type] for neurite_type in neurite_types]
+    # the placement of all the cells is read at once, and applied to the cached segments
+    rotations, translations = _cell_placements(edge_population.source, gids)
+    # the positions of all the synapses are looked up at once, for each mask
+    synapse_counts = (
+        [synapses.counts_inside(mask, gids) for mask in masks]
+        if count_positions
+        else [[None] * len(gids) for _ in masks]
+    )
+    loaders = (
+        _segment_points_loader(
+            edge_population.source,
+            gid,
+            section_types,
+            cache=morph_cache,
+            index=morph_index,
+        )
+        for gid in gids
+    )
+    batch_start, batch_gids, batch_tables, n_segments = 0, [], [], 0
+    # the next morphologies are loaded in background while the current one is processed
+    for n, (gid, table) in enumerate(zip(gids, prefetch(loaders, _prefetch_size())), 1):
+        batch_gids.append(gid)
+        batch_tables.append(table)
+        n_segments += len(table)
+        if n_segments >= batch_size or n == len(gids):
+            batch_tables = transform_tables(
+                batch_tables, rotations[batch_start:n], translations[batch_start:n]
+            )
+            # each morphology is loaded once, and matched with all the types and masks
+            inside = [lookup_segments(mask, batch_tables) for mask in masks]
+            for i, (batch_gid, table) in enumerate(zip(batch_gids, batch_tables)):
+                yield [
+                    [
+                        _masked_bouton_values(
+                            batch_gid,
+                            neurite_type,
+                            synapses_per_bouton,
+                            table.select(mask_inside[i] & (table.section_types == int(t))),
+                            synapses,
+                            synapse_count=(
+                                mask_counts[batch_start + i] if neurite_type == "axon" else None
+                            ),
+                        )
+                        for mask_inside, mask_counts in zip(inside, synapse_counts)
+                    ]
+                    for neurite_type, t in zip(neurite_types, section_types)
+                ]
+            batch_start, batch_gids, batch_tables, n_segments = n, [], [], 0
+
+
+def _prefetch_size():
+    """Return the number of morphologies to be loaded in background threads."""
+    return int(os.getenv("MORPH_PREFETCH_SIZE", "4"))
+
+
+def _output_shape(n, neurite_type, mask):
+    """Return the shape of the densities of n gids, for the given neurite types and masks."""
+    shape = (n,)
+    if isinstance(neurite_type, (list, tuple)):
+        shape += (len(neurite_type),)
+    if isinstance(mask, (list, tuple)):
+        shape += (len(mask),)
+    return shape
+
+
 def _sample_bouton_density_task(
-    edge_population, gids, neurite_type=None, synapses_per_bouton=1.0, mask=None, atlas_path=None
-):
-    """Sample bouton density task."""
-    mask = _load_mask(mask, atlas_path)
-    return np.array(
-        [
-            _calc_bouton_density(edge_population, gid, neurite_type, synapses_per_bouton, mask)
+    edge_population,
+    gids,
+    neurite_type=None,
+    synapses_per_bouton=1.0,
+    mask=None,
+    atlas_path=None,
+    lengths=None,
+    morph_index=None,
+    synapse_positions=False,
+):  # pylint: disable=too-many-arguments
+    """Sample bouton density task, with synapse_positions resolved by the caller."""
+    # the DENSITY_VALUES of each gid are returned in the last dimension of the result
+    gids = np.asarray(gids)
+    neurite_types = _neurite_types(neurite_type)
+    lengths = load_lengths(lengths)
+    morph_cache = morphology_cache()
+    if mask is None:
+        # only the number of synapses is needed, read from the source index of the edge file
+        with _POPULATION_LOCK:
+            synapse_counts = efferent_synapse_counts(edge_population, gids)
+        loaders = (
+            _total_lengths_loader(
+                edge_population.source, gid, neurite_types, morph_cache, lengths, morph_index
+            )
             for gid in gids
+        )
+        # the next morphologies are loaded in background while the current one is processed
+        result = [
+            [
+                [[synapse_count, segment_length, density]]
+                for segment_length, density in zip(
+                    segment_lengths,
+                    _unmasked_bouton_densities(synapse_count, synapses_per_bouton, segment_lengths),
+                )
+            ]
+            for synapse_count, segment_lengths in zip(
+                synapse_counts, prefetch(loaders, _prefetch_size())
+            )
         ]
+    else:
+        result = _masked_bouton_density_rows(
+            edge_population,
+            gids,
+            neurite_types,
+            synapses_per_bouton,
+            [load_mask(item, atlas_path) for item in _mask_names(mask)],
+            lengths,
+            morph_cache,
+            morph_index,
+            count_positions=synapse_positions and "axon" in neurite_types,
+        )
+    # drop the dimensions of the types and masks, if they haven't been passed as lists
+    result = np.reshape(
+        result, (*_output_shape(len(gids), neurite_type, mask), len(DENSITY_VALUES))
     )
+    L.info("Sampled %s gids, %s", len(gids), morph_cache)
+    return result
+
+
+def _neurite_types(neurite_type):
+    """Return the list of neurite types, from a neurite type or a list of neurite types."""
+    if isinstance(neurite_type, (list, tuple)):
+        return list(neurite_type)
+    return [neurite_type or "axon"]
+
+
+def _masked_bouton_density_rows(
+    edge_population,
+    gids,
+    neurite_types,
+    synapses_per_bouton,
+    masks,
+    lengths,
+    morph_cache,
+    morph_index,
+    count_positions,
+):  # pylint: disable=too-many-arguments
+    """Return the DENSITY_VALUES of the gids, for each neurite type and mask."""
+    # the gids that cannot reach any mask are skipped without loading morphologies or edges
+    reachable = _reachable_gids(edge_population.source, gids, neurite_types, masks, lengths)
+    L.info("Skipped %s gids outside the regions of interest", np.count_nonzero(~reachable))
+    # no synapse and no segment inside the masks
+    result = np.tile([0.0, 0.0, np.nan], (len(gids), len(neurite_types), len(masks), 1))
+    if reachable.any():
+        with _POPULATION_LOCK:
+            synapses = EfferentSynapses.load(
+                edge_population,
+                gids[reachable],
+                # the segments are needed for the neurite types not counted by position
+                with_segments=not count_positions or any(t != "axon" for t in neurite_types),
+                with_positions=count_positions,
+            )
+        result[reachable] = list(
+            _iter_masked_bouton_density(
+                edge_population,
+                gids[reachable],
+                neurite_types,
+                synapses_per_bouton,
+                masks,
+                morph_cache,
+                synapses,
+                morph_index,
+                count_positions=count_positions,
+            )
+        )
+    return result
 
 
 def _sample_bouton_density_parallel(
@@ -226,39 +826,127 @@ def _sample_bouton_density_parallel(
     synapses_per_bouton=1.0,
     mask=None,
     atlas_path=None,
+    lengths=None,
     n_jobs=-1,
-):
+    synapse_positions=False,
+):  # pylint: disable=too-many-arguments,too-many-locals
     """Sample bouton density in parallel."""
+    gids = np.asarray(gids)
     # The gids are split in chunks to reduce the number of tasks submitted to the subprocesses.
-    n_chunks = n_jobs if n_jobs > 0 else os.cpu_count() or 1
+    n_workers = n_jobs if n_jobs > 0 else os.cpu_count() or 1
+    # number of chunks for each job: if greater than 1, the chunks are balanced by estimated cost
+    chunks_per_job = int(os.getenv("CHUNKS_PER_JOB", "1"))
     # minimum number of gids to be processed in a single job
     min_gids_per_job = int(os.getenv("MIN_GIDS_PER_JOB", "1"))
-    n_chunks = min(n_chunks, len(gids) // min_gids_per_job)
+    n_chunks = max(1, min(n_workers * chunks_per_job, len(gids) // min_gids_per_job))
     L.info(
         "Sampling bouton density using jobs=%s and splitting %s gids in %s chunks",
         n_jobs,
         len(gids),
         n_chunks,
     )
-    tasks = [
-        Task(
-            _sample_bouton_density_task,
-            edge_population,
-            chunk,
-            neurite_type=neurite_type,
-            synapses_per_bouton=synapses_per_bouton,
-            mask=mask,
-            atlas_path=atlas_path,
-            task_group="sample_bouton_density",
+    if chunks_per_job > 1:
+        # the most expensive gids are submitted first, and the workers pull the next chunk
+        # as soon as they are free, so that the slow chunks don't delay the end of the run
+        chunks = cost_balanced_chunks(efferent_synapse_counts(edge_population, gids), n_chunks)
+    else:
+        chunks = np.array_split(np.arange(len(gids)), n_chunks)
+    with _task_masks(mask, atlas_path) as task_mask:
+        func, population, initializer, initargs = _sample_bouton_density_workers(
+            edge_population, task_mask, atlas_path
         )
-        for chunk in np.array_split(gids, n_chunks)
-    ]
-    # base_seed is None because the RNG is not used in the subprocesses
-    results = run_parallel(tasks, n_jobs, base_seed=None)
-    return np.concatenate([result.value for result in results])
+        tasks = [
+            Task(
+                func,
+                population,
+                gids[chunk],
+                neurite_type=neurite_type,
+                synapses_per_bouton=synapses_per_bouton,
+                mask=task_mask,
+                atlas_path=atlas_path,
+                lengths=lengths,
+                # each task receives only the index of the morphologies of its gids
+                morph_index=_sample_morphology_index(
+                    edge_population.source, gids[chunk], mask, lengths
+                ),
+                synapse_positions=synapse_positions,
+                task_group="sample_bouton_density",
+            )
+            for chunk in chunks
+        ]
+        start_time = time.monotonic()
+        # base_seed is None because the RNG is not used in the subprocesses
+        results = run_parallel(
+            tasks, n_jobs, base_seed=None, initializer=initializer, initargs=initargs
+        )
+        log_straggler_time(results, time.monotonic() - start_time, min(n_workers, n_chunks))
+    values = np.concatenate([result.value for result in results])
+    # restore the original order of the gids
+    result = np.empty_like(values)
+    result[np.concatenate(chunks)] = values
+    return result
+
+
+def _task_masks(mask, atlas_path):
+    """Return the context manager yielding the masks to be sent to the parallel tasks."""
+    if get_parallel_backend() == "submitit":
+        # the jobs can run on other nodes, without access to the local temporary files,
+        # so they receive the names of the masks and load them from the atlas
+        return nullcontext(mask)
+    # the masks are loaded only once in the main process, and memory-mapped by the subprocesses
+    return shared_masks(mask, atlas_path)
+
+
+def _sample_bouton_density_workers(edge_population, mask, atlas_path):
+    """Return the task function, its population argument, the initializer and its arguments."""
+    population_ref = _edge_population_ref(edge_population)
+    if population_ref is None:
+        # the edge population is pickled with each task
+        return _sample_bouton_density_task, edge_population, None, ()
+    # the tasks contain only the gids and the parameters, while the circuit and the masks
+    # are loaded only once in each subprocess by the initializer
+    return (
+        _sample_bouton_density_worker_task,
+        population_ref,
+        _init_sample_bouton_density_worker,
+        (population_ref, _mask_names(mask), atlas_path),
+    )
+
+
+def _mask_names(mask):
+    """Return the tuple of mask names, that can be used as a cache key."""
+    return tuple(mask) if isinstance(mask, (list, tuple)) else (mask,)
+
 
+def _init_sample_bouton_density_worker(population_ref, masks, atlas_path):
+    """Open the edge population and load the masks in the current subprocess."""
+    _open_edge_population(*population_ref)
+    load_masks(masks, atlas_path)
 
-def sample_pathway_synapse_count(edge_population, n, pre=None, post=None, unique_gids=False):
+
+def _sample_bouton_density_worker_task(population_ref, gids, mask=None, atlas_path=None, **kwargs):
+    """Sample bouton density task, using the edge population and masks loaded in the process."""
+    edge_population = _open_edge_population(*population_ref)
+    masks = list(load_masks(_mask_names(mask), atlas_path))
+    return _sample_bouton_density_task(
+        edge_population,
+        gids,
+        mask=masks if isinstance(mask, (list, tuple)) else masks[0],
+        atlas_path=atlas_path,
+        **kwargs,
+    )
+
+
+def sample_pathway_synapse_count(
+    edge_population,
+    n,
+    pre=None,
+    post=None,
+    unique_gids=False,
+    rel_error=None,
+    batch_size=100,
+    seed=None,
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments
     """Sample synapse count for pathway connections.
 
     Args:
@@ -267,12 +955,40 @@ def sample_pathway_synapse_count(edge_population, n, pre=None, post=None, unique
         pre: presynaptic cell group
         post: postsynaptic cell group
         unique_gids(bool): don't use one GID more than once
+        rel_error (float): if not None, the connections are sampled in batches of batch_size
+            connections, until the half-width of the 95% confidence interval of the mean,
+            relative to the mean, is below rel_error, or until n connections have been sampled.
+        batch_size (int): number of connections sampled in each batch, if rel_error is not None.
+        seed (int): if given, the connections are shuffled using a random stream depending
+            only on the seed and on the pathway. Otherwise, the global numpy random state is used.
 
     Returns:
         numpy array of length min(n, N) with synapse number per connection,
         where N is the total number of connections satisfying the constraints.
+        If rel_error is not None, the length can be lower, and it's the number of sampled
+        connections.
     """
-    it = edge_population.iter_connections(
-        pre, post, shuffle=True, unique_node_ids=unique_gids, return_edge_count=True
+    if seed is not None:
+        # the connections are shuffled by bluepysnap using the global random state
+        with legacy_random_state(item_rng(seed, "pathway_synapse_count", pre, post)):
+            return sample_pathway_synapse_count(
+                edge_population, n, pre, post, unique_gids, rel_error, batch_size
+            )
+    it = iter(
+        edge_population.iter_connections(
+            pre, post, shuffle=True, unique_node_ids=unique_gids, return_edge_count=True
+        )
     )
-    return np.array([p[2] for p in itertools.islice(it, n)])
+    if rel_error is None:
+        return np.array([p[2] for p in itertools.islice(it, n)])
+    values, running = [], RunningStats()
+    while len(values) < n:
+        batch = [p[2] for p in itertools.islice(it, min(batch_size, n - len(values)))]
+        if not batch:
+            break
+        values.extend(batch)
+        running.update(batch)
+        if running.converged(rel_error):
+            L.info("Sampling converged after %s connections", len(values))
+            break
+    return np.array(values)
@@ -0,0 +1,220 @@
+"""Efferent synapses read in bulk from the edge files."""
+
+import logging
+
+import numpy as np
+from bluepysnap.sonata_constants import Edge
+
+from connectome_tools.utils import Properties
+
+L = logging.getLogger(__name__)
+
+# properties containing the position of the synapses on the efferent (presynaptic) morphology
+POSITION_PROPERTIES = [Properties.PRE_CENTER_X, Properties.PRE_CENTER_Y, Properties.PRE_CENTER_Z]
+
+
+def segment_keys(section_ids, segment_ids, section_offset=0):
+    """Encode section and segment ids as a single int64 key per segment.
+
+    The section id is stored in the high 32 bits and the segment id in the low 32 bits,
+    so that the keys can be compared with NumPy kernels instead of pandas MultiIndex.
+
+    Args:
+        section_ids (np.ndarray): section ids.
+        segment_ids (np.ndarray): segment ids.
+        section_offset (int): value added to the section ids before encoding.
+
+    Returns:
+        np.ndarray: array of int64 keys.
+    """
+    section_ids = np.asarray(section_ids, dtype=np.int64) + section_offset
+    return (section_ids << 32) | np.asarray(segment_ids, dtype=np.int64)
+
+
+class EfferentSynapses:
+    """Efferent synapses of a set of gids, read in bulk from the edge file."""
+
+    def __init__(self, sources, section_ids=None, segment_ids=None, positions=None):
+        """Initialize the object.
+
+        Args:
+            sources (np.ndarray): source node id of each synapse.
+            section_ids (np.ndarray): efferent section id of each synapse, or None.
+            segment_ids (np.ndarray): efferent segment id of each synapse, or None.
+            positions (np.ndarray): efferent position (x, y, z) of each synapse, or None.
+        """
+        order = np.argsort(sources, kind="stable")
+        self._gids, self._starts, self._counts = np.unique(
+            sources[order], return_index=True, return_counts=True
+        )
+        self._section_ids = None if section_ids is None else section_ids[order]
+        self._segment_ids = None if segment_ids is None else segment_ids[order]
+        self._positions = None if positions is None else positions[order]
+        self._keys = None
+        if section_ids is not None:
+            self._keys = segment_keys(self._section_ids, self._segment_ids)
+
+    @staticmethod
+    def has_positions(edge_population):
+        """Return True if the edge population stores the efferent positions of the synapses."""
+        return set(POSITION_PROPERTIES).issubset(edge_population.property_names)
+
+    @classmethod
+    def load(cls, edge_population, gids, with_segments=False, with_positions=False):
+        """Load the efferent synapses of all the given gids at once.
+
+        The synapses are selected using the source index of the edge file,
+        so that a few large reads replace many small reads. The source node id of all the
+        synapses is always read, so ``efferent_synapse_counts`` should be used instead
+        when only the number of synapses is needed.
+
+        Args:
+            edge_population: edge population instance
+            gids: source node ids
+            with_segments (bool): if True, load also the section and segment ids of the synapses.
+            with_positions (bool): if True, load also the efferent positions of the synapses.
+
+        Returns:
+            EfferentSynapses: the new instance.
+        """
+        properties = [Edge.SOURCE_NODE_ID]
+        if with_segments:
+            properties += [Properties.PRE_SECTION_ID, Properties.PRE_SEGMENT_ID]
+        if with_positions:
+            properties += POSITION_PROPERTIES
+        df = edge_population.efferent_edges(np.unique(gids), properties=properties)
+        ids = [
+            df[prop].to_numpy(dtype=np.int64)
+            for prop in properties
+            if prop not in POSITION_PROPERTIES
+        ]
+        positions = df[POSITION_PROPERTIES].to_numpy(dtype=np.float32) if with_positions else None
+        return cls(*ids, positions=positions)
+
+    def counts(self, gids):
+        """Return the number of efferent synapses of each gid.
+
+        Args:
+            gids: source node ids
+
+        Returns:
+            np.ndarray: array of counts, in the same order as gids.
+        """
+        return self._per_gid(self._counts, gids)
+
+    def count(self, gid):
+        """Return the number of efferent synapses of a single gid."""
+        return self.counts([gid])[0]
+
+    def counts_inside(self, mask, gids):
+        """Return the number of efferent synapses of each gid with position inside the mask.
+
+        The positions of the synapses of all the gids are looked up with a single call.
+
+        Args:
+            mask: mask instance, providing ``lookup(positions, outer_value=False)``.
+            gids: source node ids
+
+        Returns:
+            np.ndarray: array of counts, in the same order as gids.
+
+        Raises:
+            ValueError: if the synapses have been loaded without positions.
+        """
+        if self._positions is None:
+            raise ValueError("The synapses have been loaded without positions")
+        if len(self._gids) == 0:
+            return np.zeros(len(gids), dtype=np.int64)
+        inside = mask.lookup(self._positions, outer_value=False)
+        # the synapses are sorted by gid, and each gid has at least one synapse
+        return self._per_gid(np.add.reduceat(inside.astype(np.int64), self._starts), gids)
+
+    def _per_gid(self, values, gids):
+        """Return the values of the given gids, or 0 for the gids without synapses."""
+        gids = np.asarray(gids)
+        result = np.zeros(len(gids), dtype=np.int64)
+        idx = np.searchsorted(self._gids, gids)
+        found = idx < len(self._gids)
+        found[found] = self._gids[idx[found]] == gids[found]
+        result[found] = values[idx[found]]
+        return result
+
+    def segments(self, gid):
+        """Return the section ids and the segment ids of the efferent synapses of `gid`.
+
+        Args:
+            gid: source node id
+
+        Returns:
+            tuple of arrays (efferent_section_id, efferent_segment_id).
+        """
+        selection = self._selection(gid)
+        return self._section_ids[selection], self._segment_ids[selection]
+
+    def segment_keys(self, gid):
+        """Return the keys of the segments of the efferent synapses of `gid`.
+
+        See ``segment_keys`` for the encoding of section and segment ids.
+
+        Args:
+            gid: source node id
+
+        Returns:
+            np.ndarray: array of int64 keys, one for each synapse.
+        """
+        return self._keys[self._selection(gid)]
+
+    def _selection(self, gid):
+        """Return the slice selecting the synapses of `gid` from the sorted arrays."""
+        if self._section_ids is None:
+            raise ValueError("The synapses have been loaded without section and segment ids")
+        i = np.searchsorted(self._gids, gid)
+        if i == len(self._gids) or self._gids[i] != gid:
+            return slice(0, 0)
+        return slice(self._starts[i], self._starts[i] + self._counts[i])
+
+
+def efferent_synapse_counts(edge_population, gids):
+    """Return the number of efferent synapses of each gid, reading only the source index.
+
+    The number of synapses of each gid is the total size of its ranges of edge ids in the
+    source index of the edge file, so no property of the synapses is read.
+
+    Args:
+        edge_population: edge population instance
+        gids: source node ids
+
+    Returns:
+        numpy array of counts, in the same order as gids.
+    """
+    # the selections with the ranges of edge ids are returned only by libsonata
+    population = edge_population._population  # pylint: disable=protected-access
+    return np.array([population.efferent_edges(int(gid)).flat_size for gid in gids], dtype=np.int64)
+
+
+def use_synapse_positions(edge_population, synapse_positions, neurite_types):
+    """Return True if the synapses on the axon inside a mask should be counted by position.
+
+    The efferent positions lie on the axon, so the synapses of the other neurite types
+    are always matched by segment.
+
+    Args:
+        edge_population: edge population instance
+        synapse_positions (bool): True if the positions have been requested.
+        neurite_types (list): neurite type names.
+
+    Returns:
+        bool: True if the positions are requested and available, and the axon is included.
+    """
+    if not synapse_positions:
+        return False
+    if not EfferentSynapses.has_positions(edge_population):
+        L.warning("The positions of the synapses are not available, they are matched by segment")
+        return False
+    other_types = [t for t in neurite_types if t != "axon"]
+    if other_types:
+        L.warning(
+            "The efferent positions are on the axon, the synapses are matched by segment for %s",
+            ", ".join(other_types),
+        )
+    return len(other_types) < len(neurite_types)
@@ -1,11 +1,14 @@
 """Common utilities."""
 
 import logging
+import multiprocessing
 import os
 import sys
+import threading
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import contextmanager
 from functools import partial, wraps
 from pathlib import Path
@@ -16,6 +19,7 @@ import importlib_resources
 import jsonschema
 import numpy as np
 import psutil
+import submitit
 import yaml
 from bluepysnap.query import NODE_SET_KEY
 from joblib import Parallel, delayed
@@ -46,6 +50,10 @@ class Properties:
     PRE_SECTION_ID = "efferent_section_id"
     PRE_SEGMENT_ID = "efferent_segment_id"
 
+    PRE_CENTER_X = "efferent_center_x"
+    PRE_CENTER_Y = "efferent_center_y"
+    PRE_CENTER_Z = "efferent_center_z"
+
     SECTION_ID = "section_id"
     SEGMENT_ID = "segment_id"
 
@@ -114,24 +122,312 @@ def setup_logging(level):
     logging.basicConfig(format=logformat, level=level)
 
 
-def run_parallel(tasks, jobs, base_seed):
-    """Run tasks in parallel."""
-    level = L.getEffectiveLevel()
-    setup_task_logging = partial(setup_logging, level=level)
+# keys of the worker initializers already called in the current process
+_INITIALIZED_WORKERS = set()
+_INITIALIZED_WORKERS_LOCK = threading.Lock()
+
+# names of the backends that can be used to run the tasks in parallel (see _POOLS)
+PARALLEL_BACKENDS = ("loky", "threading", "fork", "submitit")
+DEFAULT_PARALLEL_BACKEND = "loky"
+
+# backend used by run_parallel when not specified, set with the context manager parallel_backend
+_default_backend = DEFAULT_PARALLEL_BACKEND
+
+# executor parameters and cluster used by the submitit backend, set with submitit_executor
+_SubmititExecutor = namedtuple("_SubmititExecutor", ["params", "cluster"])
+_submitit_executor = _SubmititExecutor({}, None)
+
+
+def _initialize_worker(initializer, initargs):
+    """Call initializer(*initargs), only if not already called in the current process."""
+    key = (initializer, initargs)
+    # the lock is needed when the tasks are executed in threads of the same process
+    with _INITIALIZED_WORKERS_LOCK:
+        if key not in _INITIALIZED_WORKERS:
+            initializer(*initargs)
+            _INITIALIZED_WORKERS.add(key)
+
+
+def _check_backend(backend):
+    """Return the name of the backend, or raise ValueError if the backend is not valid."""
+    if backend not in PARALLEL_BACKENDS:
+        raise ValueError(f"Invalid backend {backend!r}, expected one of {PARALLEL_BACKENDS}")
+    return backend
+
+
+@contextmanager
+def parallel_backend(backend):
+    """Context manager to set the backend used by run_parallel when not specified.
+
+    Args:
+        backend (str): name of the backend in PARALLEL_BACKENDS,
+            or None to keep the current backend.
+
+    Yields:
+        None, the backend is restored when exiting the context.
+    """
+    global _default_backend  # pylint: disable=global-statement
+    if backend is not None:
+        _check_backend(backend)
+    previous = _default_backend
+    _default_backend = backend or previous
+    try:
+        yield
+    finally:
+        _default_backend = previous
+
+
+def get_parallel_backend():
+    """Return the backend used by run_parallel when not specified."""
+    return _default_backend
+
+
+@contextmanager
+def submitit_executor(executor_params=None, cluster=None):
+    """Context manager to set the executor used by the submitit backend.
+
+    Args:
+        executor_params (dict): configuration parameters for the executor, overriding the
+            default parameters, or None to keep the current parameters.
+        cluster (str): Forces AutoExecutor to use the given environment, or None to keep the
+            current cluster. Use "local" to run jobs locally, "debug" to run jobs in the same
+            process.
+
+    Yields:
+        None, the executor configuration is restored when exiting the context.
+    """
+    global _submitit_executor  # pylint: disable=global-statement
+    previous = _submitit_executor
+    _submitit_executor = _SubmititExecutor(
+        params=previous.params if executor_params is None else executor_params,
+        cluster=cluster or previous.cluster,
+    )
+    try:
+        yield
+    finally:
+        _submitit_executor = previous
+
+
+def default_executor_params():
+    """Return the default parameters to be used when launching slurm jobs."""
+    ref = importlib_resources.files(__package__) / DEFAULT_CONFIG_PATH / "executor_config.yaml"
+    with importlib_resources.as_file(ref) as path:
+        executor_config = load_yaml(path)
+    validate_config(executor_config, schema_name="executor_config")
+    return executor_config["executor"]
+
+
+def _effective_jobs(jobs):
+    """Return the number of workers, interpreting negative values as joblib does."""
+    n_cpus = os.cpu_count() or 1
+    return max(1, jobs if jobs > 0 else n_cpus + 1 + jobs)
+
+
+def _call(func):
+    return func()
+
+
+@contextmanager
+def _joblib_pool(backend, jobs, verbose):
+    """Yield a function running the callables in the pool of workers of joblib."""
+    # the workers are reused by all the calls made inside the context
+    with Parallel(n_jobs=jobs, backend=backend, verbose=verbose) as parallel:
+        yield lambda funcs: parallel(delayed(func)() for func in funcs)
+
+
+@contextmanager
+def _fork_pool(jobs, verbose):  # pylint: disable=unused-argument
+    """Yield a function running the callables in a pool of forked processes."""
+    # the objects already loaded in the main process are inherited by the subprocesses,
+    # although the arguments of each callable are still pickled
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=_effective_jobs(jobs), mp_context=context) as executor:
+        yield lambda funcs: list(executor.map(_call, funcs))
+
+
+def _submit_job_array(executor, funcs):
+    """Submit the callables as a job array, and return the results."""
+    submitted = executor.map_array(_call, list(funcs))
+    L.info("Waiting for %s jobs to complete...", len(submitted))
+    return [job.result() for job in submitted]
+
+
+@contextmanager
+def _submitit_pool(jobs, verbose):  # pylint: disable=unused-argument
+    """Yield a function running the callables as a job array, using submitit.
+
+    The executor is configured as in slurm.execute_pending_tasks, with the default parameters
+    updated with the parameters set with submitit_executor. The folder of the logs can be set
+    with the env variable SUBMITIT_FOLDER, and the cluster, if not set with submitit_executor,
+    with the env variable SUBMITIT_CLUSTER (for example "local" or "debug").
+
+    Args:
+        jobs (int): maximum number of jobs running at the same time, if greater than 0.
+        verbose (int): verbosity level, ignored.
+
+    Yields:
+        function running a list of callables, and returning the list of results.
+    """
+    clean_slurm_env()
+    executor = submitit.AutoExecutor(
+        folder=os.getenv("SUBMITIT_FOLDER", ".submitit"),
+        cluster=_submitit_executor.cluster or os.getenv("SUBMITIT_CLUSTER") or None,
+    )
+    executor.update_parameters(**default_executor_params())
+    if jobs > 0:
+        executor.update_parameters(slurm_array_parallelism=jobs)
+    executor.update_parameters(**_submitit_executor.params)
+    yield partial(_submit_job_array, executor)
+
+
+_POOLS = {
+    # reusable pool of processes
+    "loky": partial(_joblib_pool, "loky"),
+    # pool of threads, useful when the tasks release the GIL, for example when reading morphologies
+    "threading": partial(_joblib_pool, "threading"),
+    "fork": _fork_pool,
+    "submitit": _submitit_pool,
+}
+
+# pool used by run_parallel, set with the context manager worker_pool
+_active_pool = None
+
+_ActivePool = namedtuple("_ActivePool", ["backend", "jobs", "thread_id", "executor", "run"])
+
+
+def _verbosity():
+    """Return the verbosity of joblib corresponding to the current logging level."""
     # If verbose is more than 10, all iterations are printed to stderr.
     # Above 50, the output is sent to stdout.
-    verbose = 0 if level >= logging.WARNING else 10
-    parallel = Parallel(n_jobs=jobs, backend="loky", verbose=verbose)
-    return parallel(
-        [
-            delayed(task)(
-                task_id=i,
-                seed=None if base_seed is None else base_seed + i,
-                setup_task_logging=setup_task_logging,
-            )
-            for i, task in enumerate(tasks)
-        ]
+    return 0 if L.getEffectiveLevel() >= logging.WARNING else 10
+
+
+@contextmanager
+def worker_pool(jobs, backend=None):
+    """Context manager to run all the calls to run_parallel with the same pool of workers.
+
+    The workers are started only once, so the cost of their initialization (imports, circuit
+    opening, and worker initializers) is paid only once for all the tasks executed in the context.
+    The pool is used by the calls to run_parallel with the same backend and number of jobs,
+    made in the same thread, while the other calls create a new pool as usual.
+
+    Args:
+        jobs (int): number of workers (if -1 all CPUs are used).
+        backend (str): name of the backend in PARALLEL_BACKENDS, or None to use the backend
+            set with parallel_backend. It's used also as default backend in the context.
+
+    Yields:
+        None, the workers are stopped when exiting the context.
+    """
+    global _active_pool  # pylint: disable=global-statement
+    backend = _check_backend(backend or _default_backend)
+    previous = _active_pool
+    with parallel_backend(backend), _POOLS[backend](jobs, _verbosity()) as run:
+        L.debug("Started the pool of workers with backend=%s and jobs=%s", backend, jobs)
+        _active_pool = _ActivePool(backend, jobs, threading.get_ident(), _submitit_executor, run)
+        try:
+            yield
+        finally:
+            _active_pool = previous
+
+
+def run_parallel(tasks, jobs, base_seed, initializer=None, initargs=(), backend=None):
+    """Run tasks in parallel, using the given backend or the one set with parallel_backend."""
+    # If initializer is given, it's called with initargs once in each worker process,
+    # before the first task executed by the process. The initializer and initargs must be
+    # picklable and hashable, because they are sent with each task to be executed only once.
+    backend = _check_backend(backend or _default_backend)
+    setup_task_logging = partial(setup_logging, level=L.getEffectiveLevel())
+    initialize_worker = (
+        None if initializer is None else partial(_initialize_worker, initializer, tuple(initargs))
     )
+    funcs = [
+        partial(
+            task,
+            task_id=i,
+            seed=None if base_seed is None else base_seed + i,
+            setup_task_logging=setup_task_logging,
+            initialize_worker=initialize_worker,
+        )
+        for i, task in enumerate(tasks)
+    ]
+    pool = _active_pool
+    # the pool cannot be used by the tasks running in other threads of the same pool,
+    # or when the configuration of the submitit executor has been changed
+    if (
+        pool is not None
+        and pool[:3] == (backend, jobs, threading.get_ident())
+        and (backend != "submitit" or pool.executor == _submitit_executor)
+    ):
+        L.debug("Running %s tasks in the active pool of workers", len(funcs))
+        return pool.run(funcs)
+    L.debug("Running %s tasks with backend=%s and jobs=%s", len(funcs), backend, jobs)
+    with _POOLS[backend](jobs, _verbosity()) as run:
+        return run(funcs)
+
+
+def cost_balanced_chunks(costs, n_chunks):
+    """Split the indices of the gids in chunks of similar cost, in order of decreasing gid cost."""
+    # a constant is added to the cost of each gid, to account for the loading of the morphology
+    order = np.argsort(-np.asarray(costs), kind="stable")
+    cumulative = np.cumsum(np.asarray(costs)[order] + 1.0)
+    chunks, start = [], 0
+    for remaining_chunks in range(n_chunks, 0, -1):
+        if start == len(order):
+            break
+        # the target is recomputed, because the most expensive gids may exceed the average cost
+        done = cumulative[start - 1] if start > 0 else 0.0
+        target = done + (cumulative[-1] - done) / remaining_chunks
+        end = max(start + 1, int(np.searchsorted(cumulative, target, side="right")))
+        if remaining_chunks == 1:
+            end = len(order)
+        chunks.append(order[start:end])
+        start = end
+    return chunks
+
+
+def log_straggler_time(results, elapsed, n_workers):
+    """Log the time spent waiting for the slowest tasks, compared to a perfect load balance."""
+    total = sum(result.elapsed for result in results)
+    longest = max(result.elapsed for result in results)
+    L.info(
+        "Executed %s tasks in %.2f seconds: total task time %.2f seconds, "
+        "longest task %.2f seconds, straggler time %.2f seconds",
+        len(results),
+        elapsed,
+        total,
+        longest,
+        max(0.0, elapsed - total / n_workers),
+    )
+
+
+def prefetch(funcs, size):
+    """Yield the result of each callable in order, calling up to `size` callables ahead.
+
+    The callables ahead are called in background threads, so that I/O bound operations
+    can overlap with the processing of the current result in the calling thread.
+    The iterable of callables is consumed in the calling thread, so any operation
+    that isn't thread-safe can be done when creating the callables.
+
+    Args:
+        funcs: iterable of callables without arguments.
+        size (int): maximum number of callables called ahead (0 to call them sequentially).
+
+    Yields:
+        The results of the callables, in the same order.
+    """
+    if size <= 0:
+        for func in funcs:
+            yield func()
+        return
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        futures = deque()
+        for func in funcs:
+            futures.append(executor.submit(func))
+            if len(futures) > size:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
 
 
 def run_sequential(tasks):
@@ -154,13 +450,14 @@ class Task:
         self._func = partial(func, *args, **kwargs)
         self.group = task_group
 
-    def __call__(self, task_id=None, seed=None, setup_task_logging=None):
+    def __call__(self, task_id=None, seed=None, setup_task_logging=None, initialize_worker=None):
         """Execute the task.
 
         Args:
             task_id: Task id, should be unique.
             seed: Seed to initialize the random number generator in the subprocess.
             setup_task_logging: If not None, it must be a callable to configure logging.
+            initialize_worker: If not None, it must be a callable to initialize the subprocess.
 
         Returns:
             The task result (it should be serializable to be returned from different processes).
@@ -169,6 +466,8 @@ class Task:
             start_time = time.monotonic()
             if setup_task_logging:
                 setup_task_logging()
+            if initialize_worker:
+                initialize_worker()
             if seed is not None:
                 np.random.seed(seed)
             result = self._func()
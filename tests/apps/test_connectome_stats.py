@@ -1,4 +1,7 @@
+import numpy as np
 from click.testing import CliRunner
+from mock import patch
+from utils import tmp_cwd
 
 from connectome_tools.apps import connectome_stats as test_module
 
@@ -8,3 +11,106 @@ def test_app_help():
     result = runner.invoke(test_module.app, ["--help"], catch_exceptions=False)
     assert result.exit_code == 0
     assert result.output.startswith("Usage")
+
+
+@patch(test_module.__name__ + ".compute_morphology_lengths")
+@patch(test_module.__name__ + ".Circuit")
+def test_morphology_lengths(mock_circuit, mock_compute):
+    runner = CliRunner()
+    with tmp_cwd():
+        result = runner.invoke(
+            test_module.app,
+            ["morphology-lengths", "-p", "Foo", "-o", "lengths.npz", "-j", "2", "circuit.json"],
+            catch_exceptions=False,
+        )
+
+    assert result.exit_code == 0
+    edge_population = mock_circuit.return_value.edges["Foo"]
+    mock_compute.assert_called_once_with(edge_population.source, n_jobs=2)
+    assert mock_compute.return_value.save.call_count == 1
+
+
+@patch(test_module.__name__ + ".stats.sample_bouton_density_groups")
+@patch(test_module.__name__ + ".get_node_population_mtypes")
+@patch(test_module.__name__ + ".Circuit")
+def test_bouton_density_with_multiple_masks(mock_circuit, mock_mtypes, mock_sample):
+    mock_mtypes.return_value = ["L1_A"]
+    mock_sample.return_value = [np.array([[1.0, 2.0], [3.0, 4.0]])] * 2
+    runner = CliRunner()
+    result = runner.invoke(
+        test_module.app,
+        [
+            "bouton-density",
+            "-p",
+            "Foo",
+            "-a",
+            "atlas",
+            "--mask",
+            "A",
+            "--mask",
+            "B",
+            "-t",
+            "Bar",
+            "-j",
+            "2",
+            "c.json",
+        ],
+        catch_exceptions=False,
+    )
+
+    assert result.exit_code == 0
+    # all the groups are sampled with a single call
+    assert mock_sample.call_count == 1
+    assert mock_sample.call_args[1]["groups"] == ["Bar", {"mtype": "L1_A", "$node_set": "Bar"}]
+    assert mock_sample.call_args[1]["mask"] == ["A", "B"]
+    assert mock_sample.call_args[1]["n_jobs"] == 2
+    assert result.output.splitlines() == [
+        "mtype\tmask\tmean\tstd\tsize\tsample",
+        "*\tA\t2\t1\t2\t1,3",
+        "*\tB\t3\t1\t2\t2,4",
+        "L1_A\tA\t2\t1\t2\t1,3",
+        "L1_A\tB\t3\t1\t2\t2,4",
+    ]
+
+
+@patch(test_module.__name__ + ".stats.sample_bouton_density_groups")
+@patch(test_module.__name__ + ".get_node_population_mtypes")
+@patch(test_module.__name__ + ".Circuit")
+def test_bouton_density_with_multiple_neurite_types_and_masks(
+    mock_circuit, mock_mtypes, mock_sample
+):
+    mock_mtypes.return_value = []
+    mock_sample.return_value = [np.arange(8.0).reshape((2, 2, 2))]
+    runner = CliRunner()
+    result = runner.invoke(
+        test_module.app,
+        [
+            "bouton-density",
+            "-p",
+            "Foo",
+            "-a",
+            "atlas",
+            "--neurite-type",
+            "axon",
+            "--neurite-type",
+            "basal_dendrite",
+            "--mask",
+            "A",
+            "--mask",
+            "B",
+            "--short",
+            "c.json",
+        ],
+        catch_exceptions=False,
+    )
+
+    assert result.exit_code == 0
+    assert mock_sample.call_args[1]["neurite_type"] == ["axon", "basal_dendrite"]
+    assert mock_sample.call_args[1]["mask"] == ["A", "B"]
+    assert result.output.splitlines() == [
+        "mtype\tneurite_type\tmask\tmean\tstd\tsize\tsample",
+        "*\taxon\tA\t2\t2\t2\tN/A",
+        "*\taxon\tB\t3\t2\t2\tN/A",
+        "*\tbasal_dendrite\tA\t4\t2\t2\tN/A",
+        "*\tbasal_dendrite\tB\t5\t2\t2\tN/A",
+    ]
@@ -217,3 +217,29 @@ def test_app(
     # note: stdout is not printed, but it can be accessed in result.output
     assert result.exit_code == 0
     assert actual == expected
+
+
+@patch.object(test_module.estimate_syns_con.Executor, "run", return_value=["result"])
+@patch.object(test_module.estimate_syns_con.Executor, "__init__", return_value=None)
+def test_execute_strategies_with_backend(mock_init, mock_run):
+    population = MagicMock(EdgePopulation)
+    strategies = [
+        {"estimate_syns_con": {"formula": "n"}},
+        {"estimate_syns_con": {"formula": "n", "backend": "threading"}},
+        {"estimate_syns_con": {"formula": "n", "executor": {"slurm_time": 10}}},
+    ]
+
+    result = test_module.execute_strategies(
+        population, "atlas", strategies, jobs=2, base_seed=0, backend="fork"
+    )
+
+    assert result == ["result", "result", "result"]
+    # the backend of the strategy takes precedence over the default backend
+    assert [c[1]["backend"] for c in mock_init.call_args_list] == ["fork", "threading", "fork"]
+    assert [c[1]["executor_params"] for c in mock_init.call_args_list] == [
+        None,
+        None,
+        {"slurm_time": 10},
+    ]
+    # the backend and the executor aren't passed to the executor as parameters of the strategy
+    assert [c[1] for c in mock_run.call_args_list] == [{"formula": "n"}] * 3
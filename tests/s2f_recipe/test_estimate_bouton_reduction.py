@@ -10,7 +10,7 @@ from utils import TEST_DATA_DIR
 import connectome_tools.s2f_recipe.estimate_bouton_reduction as test_module
 
 
-@patch(test_module.__name__ + ".sample_bouton_density", return_value=np.array([1.0, 3.0]))
+@patch(test_module.__name__ + ".sample_bouton_density_groups", return_value=[np.array([1.0, 3.0])])
 def test_1(_):
     population = MagicMock(EdgePopulation)
     expected = {("*", "*"): {"bouton_reduction_factor": 5.0}}
@@ -21,7 +21,7 @@ def test_1(_):
     npt.assert_equal(actual, expected)
 
 
-@patch(test_module.__name__ + ".sample_bouton_density", return_value=np.array([1.0, 3.0]))
+@patch(test_module.__name__ + ".sample_bouton_density_groups", return_value=[np.array([1.0, 3.0])])
 def test_2(_):
     population = MagicMock(EdgePopulation)
     expected = {("*", "*"): {"bouton_reduction_factor": 21.0}}
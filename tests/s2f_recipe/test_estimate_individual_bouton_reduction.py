@@ -10,19 +10,20 @@ from utils import TEST_DATA_DIR
 import connectome_tools.s2f_recipe.estimate_individual_bouton_reduction as test_module
 
 
-def mock_sample_bouton_density(edge_population, **kwargs):
-    mtype = kwargs["group"]["mtype"]
+def mock_sample_bouton_density_groups(edge_population, groups, **kwargs):
     samples = {
         "L1_DAC": np.empty(0),
         "L23_MC": np.array([1.0, 3.0]),
         "L5_TPC": np.array([0.5, 1.5]),
     }
-    return samples[mtype]
+    return [samples[group["mtype"]] for group in groups]
 
 
-@patch.object(test_module, "sample_bouton_density", side_effect=mock_sample_bouton_density)
+@patch.object(
+    test_module, "sample_bouton_density_groups", side_effect=mock_sample_bouton_density_groups
+)
 @patch.object(test_module, "get_edge_population_mtypes")
-def test_1(mock_get_mtypes, _):
+def test_1(mock_get_mtypes, mock_sample):
     population = MagicMock(EdgePopulation)
     mock_get_mtypes.return_value = ["L1_DAC", "L23_MC", "L5_TPC"]
     expected = {
@@ -34,9 +35,13 @@ def test_1(mock_get_mtypes, _):
     actual = dict(chain.from_iterable(item.value for item in result_generator))
 
     npt.assert_equal(actual, expected)
+    # all the mtypes are sampled with a single call
+    assert mock_sample.call_count == 1
 
 
-@patch.object(test_module, "sample_bouton_density", side_effect=mock_sample_bouton_density)
+@patch.object(
+    test_module, "sample_bouton_density_groups", side_effect=mock_sample_bouton_density_groups
+)
 @patch.object(test_module, "get_edge_population_mtypes")
 def test_2(mock_get_mtypes, _):
     population = MagicMock(EdgePopulation)
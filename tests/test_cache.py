@@ -0,0 +1,44 @@
+import numpy as np
+import numpy.testing as npt
+from mock import Mock
+from utils import tmp_cwd
+
+import connectome_tools.cache as test_module
+
+
+def test_persistent_cache():
+    with tmp_cwd() as tmp_dir:
+        cache = test_module.PersistentCache(tmp_dir, {"a": 1})
+        found, values = cache.lookup([3, 1])
+        npt.assert_array_equal(found, [False, False])
+        npt.assert_array_equal(values, [np.nan, np.nan])
+
+        cache.update([5, 1], [0.5, np.nan])
+        cache.update([3, 5], [0.3, 99.0])
+
+        # the values are read from file by a new instance
+        found, values = test_module.PersistentCache(tmp_dir, {"a": 1}).lookup([5, 2, 3, 1, 6])
+        npt.assert_array_equal(found, [True, False, True, True, False])
+        npt.assert_array_equal(values, [0.5, np.nan, 0.3, np.nan, np.nan])
+        # a different key uses a different file
+        found, _ = test_module.PersistentCache(tmp_dir, {"a": 2}).lookup([5, 1])
+        npt.assert_array_equal(found, [False, False])
+
+
+def test_cached_values():
+    compute = Mock(side_effect=lambda gids: np.stack([gids * 1.0, gids * 2.0], axis=1))
+    with tmp_cwd() as tmp_dir:
+        caches = [test_module.PersistentCache(tmp_dir, {"column": i}) for i in range(2)]
+        result = test_module.cached_values(compute, np.array([1, 2]), caches)
+        npt.assert_array_equal(result, [[1, 2], [2, 4]])
+
+        caches = [test_module.PersistentCache(tmp_dir, {"column": i}) for i in range(2)]
+        result = test_module.cached_values(compute, np.array([3, 2, 1]), caches)
+        npt.assert_array_equal(result, [[3, 6], [2, 4], [1, 2]])
+        # only the missing gids are computed
+        assert compute.call_count == 2
+        npt.assert_array_equal(compute.call_args[0][0], [3])
+
+        result = test_module.cached_values(compute, np.array([2, 3]), caches)
+        npt.assert_array_equal(result, [[2, 4], [3, 6]])
+        assert compute.call_count == 2
@@ -0,0 +1,87 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import numpy.testing as npt
+from bluepysnap.edges import EdgePopulation
+from mock import MagicMock, Mock
+from utils import tmp_cwd
+
+import connectome_tools.density_store as test_module
+from connectome_tools.cache import CACHE_VERSION
+
+
+def test_density_key():
+    population = MagicMock(EdgePopulation)
+    population.name = "default"
+    population.source.name = "nodes"
+    with tmp_cwd() as tmp_dir:
+        population.h5_filepath = Path(tmp_dir, "edges.h5")
+        population.h5_filepath.touch()
+        population.source.config = {
+            "morphologies_dir": "/swc",
+            "alternate_morphologies": {"neurolucida-asc": "/asc"},
+        }
+
+        result = test_module.density_key(population, "/circuit.json", 2)
+        with_positions = test_module.density_key(population, None, 2, synapse_positions=True)
+
+    assert result["circuit"] == "/circuit.json"
+    assert result["edges"] == os.path.abspath(population.h5_filepath)
+    assert result["edge_population"] == "default"
+    assert result["node_population"] == "nodes"
+    # the morphology directories, in the order they are tried
+    assert result["morphologies"] == ["/asc", "/swc"]
+    assert result["synapses_per_bouton"] == 2.0
+    assert "synapse_positions" not in result
+    assert with_positions["circuit"] is None
+    assert with_positions["synapse_positions"] is True
+
+
+def test_distributed_density_key():
+    result = test_module.distributed_density_key({"a": 1}, None, "roi", "atlas")
+
+    assert result["a"] == 1
+    assert result["neurite_type"] == "axon"
+    assert result["mask"] == "roi"
+    assert result["atlas"] == os.path.abspath("atlas")
+    assert result["values"] == ["synapse_count", "segment_length", "density"]
+    assert test_module.distributed_density_key({}, "axon", None, "atlas")["atlas"] is None
+
+
+def test_cached_densities():
+    compute = Mock(
+        side_effect=lambda gids: gids[:, np.newaxis, np.newaxis, np.newaxis]
+        * np.arange(1, 19).reshape((1, 2, 3, 3))
+    )
+    with tmp_cwd() as tmp_dir:
+        caches = test_module.density_caches(
+            tmp_dir, {"a": 1}, ["axon", "basal_dendrite"], ["roi1", "roi2", None], "atlas"
+        )
+        # one cache for each neurite type, mask and value
+        assert len(caches) == 18
+        assert len({cache.path for cache in caches}) == 18
+        assert [cache.key for cache in caches[:3]] == [
+            json.dumps(
+                {
+                    "a": 1,
+                    "atlas": os.path.abspath("atlas"),
+                    "mask": "roi1",
+                    "neurite_type": "axon",
+                    "value": value,
+                    "version": CACHE_VERSION,
+                },
+                sort_keys=True,
+            )
+            for value in test_module.DENSITY_VALUES
+        ]
+
+        result = test_module.cached_densities(compute, np.array([3, 1]), caches, shape=(2, 3, 3))
+        npt.assert_array_equal(result, compute.side_effect(np.array([3, 1])))
+        result = test_module.cached_densities(compute, np.array([1, 2]), caches, shape=(2, 3, 3))
+
+    assert result.shape == (2, 2, 3, 3)
+    npt.assert_array_equal(result, compute.side_effect(np.array([1, 2])))
+    assert compute.call_count == 2
+    npt.assert_array_equal(compute.call_args[0][0], [2])
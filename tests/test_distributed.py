@@ -0,0 +1,55 @@
+from pathlib import Path
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from mock import Mock, patch
+from utils import tmp_cwd
+
+import connectome_tools.distributed as test_module
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setenv("SUBMIT_JOBS_INITIAL_SLEEP", "0")
+    monkeypatch.setenv("SUBMIT_JOBS_POLL_FREQUENCY", "0.1")
+
+
+def test_compute_distributed():
+    func = Mock(side_effect=lambda gids: np.stack([gids * 1.0, gids * 2.0], axis=1))
+    with tmp_cwd() as tmp_dir:
+        # execute the jobs in the same process using cluster='debug' because mocks can't be pickled
+        result = test_module.compute_distributed(
+            func, np.array([5, 1, 3]), tmp_dir, key={"a": 1}, shard_size=2, cluster="debug"
+        )
+        npt.assert_array_equal(result, [[5, 10], [1, 2], [3, 6]])
+        assert func.call_count == 2
+        assert len(list(Path(tmp_dir).glob(f"*/{test_module.SHARDS_DIR}/shard_*.npz"))) == 2
+
+        # only the missing gids are computed when resuming
+        result = test_module.compute_distributed(
+            func, np.array([3, 4, 1]), tmp_dir, key={"a": 1}, shard_size=2, cluster="debug"
+        )
+        npt.assert_array_equal(result, [[3, 6], [4, 8], [1, 2]])
+        assert func.call_count == 3
+        npt.assert_array_equal(func.call_args[0][0], [4])
+
+        # a different key uses a different directory
+        test_module.compute_distributed(
+            func, np.array([1]), tmp_dir, key={"a": 2}, shard_size=2, cluster="debug"
+        )
+        assert func.call_count == 4
+
+
+@patch(test_module.__name__ + ".execute_pending_tasks", return_value=1)
+def test_compute_distributed_with_failures(mock_execute):
+    with tmp_cwd() as tmp_dir:
+        with pytest.raises(RuntimeError, match="1 of 2 jobs didn't complete successfully"):
+            test_module.compute_distributed(
+                Mock(), np.array([1, 2, 3]), tmp_dir, key={}, shard_size=2
+            )
+
+    assert mock_execute.call_count == 1
+    tasks = mock_execute.call_args[0][0]
+    assert [task.name for task in tasks] == ["gids:1-2,size:2", "gids:3-3,size:1"]
+    assert not any(task.complete() for task in tasks)
@@ -0,0 +1,172 @@
+from pathlib import Path
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from mock import Mock, patch
+from utils import tmp_cwd
+from voxcell import ROIMask
+
+import connectome_tools.mask as test_module
+from connectome_tools.morphology import SegmentTable
+
+
+def _build_roi_mask():
+    raw = np.zeros((20, 30, 40), dtype=np.uint8)
+    raw[5:8, 10:20, 30:35] = 1
+    raw[6, 12, 31] = 0
+    return ROIMask(raw, voxel_dimensions=(2.5, 2.5, 2.5), offset=(-10.0, 3.3, 100.0))
+
+
+def _random_positions(roi_mask, n=10000):
+    rng = np.random.default_rng(0)
+    lower, upper = roi_mask.bbox
+    margin = 5 * roi_mask.voxel_dimensions
+    positions = rng.uniform(lower - margin, upper + margin, size=(n, 3)).astype(np.float32)
+    # add the positions at the boundaries of the voxels
+    corners = roi_mask.indices_to_positions(np.array([[0, 0, 0], [5, 10, 30], [8, 20, 35]]))
+    return np.concatenate([positions, corners.astype(np.float32), upper[np.newaxis]])
+
+
+def test_compact_mask_from_voxel_data():
+    roi_mask = _build_roi_mask()
+
+    result = test_module.CompactMask.from_voxel_data(roi_mask)
+
+    assert result.raw.shape == (3, 10, 5)
+    assert result.raw.dtype == bool
+    assert result.nbytes == 150
+    npt.assert_array_equal(result.start, [5, 10, 30])
+    assert result.shape == (20, 30, 40)
+
+
+def test_compact_mask_lookup():
+    roi_mask = _build_roi_mask()
+    positions = _random_positions(roi_mask)
+    expected = roi_mask.lookup(positions, outer_value=False)
+    assert 0 < expected.sum() < len(expected)
+
+    result = test_module.CompactMask.from_voxel_data(roi_mask).lookup(positions)
+
+    npt.assert_array_equal(result, expected)
+
+
+def test_compact_mask_lookup_with_outer_value():
+    roi_mask = ROIMask(np.zeros((4, 4, 4), dtype=np.uint8), voxel_dimensions=(1, 1, 1))
+    positions = np.array([[-1.0, 0.0, 0.0], [1.0, 1.0, 1.0], [4.0, 1.0, 1.0]])
+
+    result = test_module.CompactMask.from_voxel_data(roi_mask).lookup(positions, outer_value=True)
+
+    npt.assert_array_equal(result, [True, False, True])
+
+
+def test_shared_mask_save_and_load():
+    roi_mask = _build_roi_mask()
+    positions = _random_positions(roi_mask)
+    mask = test_module.CompactMask.from_voxel_data(roi_mask)
+    with tmp_cwd() as tmp_dir:
+        shared = test_module.SharedMask.save(mask, Path(tmp_dir, "mask.npy"))
+        result = shared.load()
+
+        assert isinstance(result.raw, np.memmap)
+        npt.assert_array_equal(result.lookup(positions), mask.lookup(positions))
+        # the instance can be used as a cache key in the subprocesses
+        assert hash(shared) == hash(test_module.SharedMask(**shared.__dict__))
+
+
+def test_compact_mask_intersects_spheres():
+    roi_mask = _build_roi_mask()
+    mask = test_module.CompactMask.from_voxel_data(roi_mask)
+    # the voxels of the region of interest are between these corners
+    lower, upper = roi_mask.indices_to_positions(np.array([[5, 10, 30], [8, 20, 35]]))
+    centers = [lower, lower - [20, 0, 0], lower - [20, 0, 0], upper + [10, 10, 10]]
+
+    result = mask.intersects_spheres(centers, [0, 10, 30, np.inf])
+
+    npt.assert_array_equal(result, [True, False, True, True])
+    empty = test_module.CompactMask.from_voxel_data(
+        ROIMask(np.zeros((4, 4, 4), dtype=np.uint8), (1, 1, 1))
+    )
+    assert not empty.intersects_spheres([[2, 2, 2]], [100]).any()
+
+
+def test_compact_mask_lookup_with_negative_voxel_dimensions():
+    raw = np.zeros((4, 4, 4), dtype=np.uint8)
+    raw[3, 1, 1] = 1
+    roi_mask = ROIMask(raw, voxel_dimensions=(-1, 1, 1))
+    # the positions beyond the last voxel along x are clipped to the last voxel by voxcell
+    positions = np.array([[-3.5, 1.5, 1.5], [-10.0, 1.5, 1.5], [0.5, 1.5, 1.5]])
+    expected = roi_mask.lookup(positions, outer_value=False)
+
+    result = test_module.CompactMask.from_voxel_data(roi_mask).lookup(positions)
+
+    npt.assert_array_equal(result, expected)
+    assert result.sum() == 2
+
+
+@patch.object(test_module.Atlas, "open")
+def test_load_mask(mock_atlas_open):
+    roi_mask = ROIMask(np.zeros((10, 10, 10), dtype=np.uint8), voxel_dimensions=(1, 1, 1))
+    mock_atlas_open.return_value = mock_atlas = Mock(load_data=Mock(return_value=roi_mask))
+    assert test_module.load_mask(None, "Bar") is None
+    mock_atlas_open.assert_not_called()
+
+    assert isinstance(test_module.load_mask("Foo", "Bar"), test_module.CompactMask)
+    mock_atlas_open.assert_called_once_with("Bar")
+    mock_atlas.load_data.assert_called_once_with("Foo", cls=ROIMask)
+
+    with pytest.raises(ValueError, match="Missing atlas path"):
+        test_module.load_mask("Foo", None)
+
+
+@patch.object(test_module.Atlas, "open")
+def test_shared_masks(mock_atlas_open):
+    raw = np.zeros((3, 4, 5), dtype=np.uint8)
+    raw[1, 2, 3] = 1
+    roi_mask = ROIMask(raw, voxel_dimensions=(2.0, 2.0, 2.0), offset=(10.0, 20.0, 30.0))
+    points = np.array([[13.0, 25.0, 37.0], [11.0, 21.0, 31.0], [0.0, 0.0, 0.0]])
+
+    mock_atlas_open.return_value.load_data.return_value = roi_mask
+
+    with test_module.shared_masks(["Foo"], "Bar") as shared:
+        assert len(shared) == 1
+        assert Path(shared[0].path).is_file()
+        result = test_module.load_mask(shared[0], None)
+
+        assert isinstance(result.raw, np.memmap)
+        npt.assert_array_equal(
+            result.lookup(points, outer_value=False), roi_mask.lookup(points, outer_value=False)
+        )
+    assert not Path(shared[0].path).exists()
+
+    with test_module.shared_masks(None, "Bar") as shared:
+        assert shared is None
+
+
+def _segment_table(starts, ends):
+    n = len(starts)
+    return SegmentTable(
+        starts=np.asarray(starts),
+        ends=np.asarray(ends),
+        section_ids=np.zeros(n, dtype=int),
+        segment_ids=np.arange(n),
+        section_types=np.full(n, 2),
+    )
+
+
+def test_lookup_segments():
+    mask = Mock()
+    mask.lookup.side_effect = lambda points, outer_value: np.all(points > 0, axis=-1)
+    tables = [
+        _segment_table([[1.0, 1.0, 1.0], [1.0, 1.0, 1.0]], [[2.0, 2.0, 2.0], [0.0, 0.0, 0.0]]),
+        _segment_table(np.empty((0, 3)), np.empty((0, 3))),
+        _segment_table([[0.0, 0.0, 0.0], [3.0, 3.0, 3.0]], [[1.0, 1.0, 1.0], [4.0, 4.0, 4.0]]),
+    ]
+
+    result = test_module.lookup_segments(mask, tables)
+
+    assert mask.lookup.call_count == 1
+    assert len(result) == 3
+    npt.assert_array_equal(result[0], [True, False])
+    npt.assert_array_equal(result[1], [])
+    npt.assert_array_equal(result[2], [False, True])
@@ -2,7 +2,7 @@ import logging
 import shutil
 from pathlib import Path
 
-from mock import Mock, patch
+from mock import patch
 from utils import TEST_DATA_DIR, canonicalize_xml, tmp_cwd, xml_to_regular_dict
 
 import connectome_tools.merge as test_module
@@ -11,21 +11,6 @@ from connectome_tools.merge import RECIPES_DIR, SLURM_DIR, WORKDIR
 from connectome_tools.utils import load_yaml
 
 
-def test_execute_pending_tasks_success():
-    pending_tasks = [Mock(), Mock(), Mock()]
-    executor_params = {"timeout_min": 1}
-    with tmp_cwd() as tmp_dir:
-        folder = Path(tmp_dir)
-        # Execute tasks in the same process using cluster='debug' because mocks cannot be pickled.
-        # Do not test failures, because DebugJob.results() would start pdb and wait for stdin.
-        failures = test_module.execute_pending_tasks(
-            pending_tasks, executor_params, folder, cluster="debug"
-        )
-
-    assert failures == 0
-    assert all(task.run.call_count == 1 for task in pending_tasks)
-
-
 def test_delete_temporary_dirs():
     with tmp_cwd() as tmp_dir:
         workdir = Path(tmp_dir) / WORKDIR
@@ -0,0 +1,374 @@
+from pathlib import Path
+
+import morphio
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+from mock import MagicMock, Mock, call, patch
+from utils import tmp_cwd
+
+import connectome_tools.morphology as test_module
+
+
+def _build_morph():
+    morph = morphio.mut.Morphology()
+    axon = morph.append_root_section(
+        morphio.PointLevel([[0, 0, 0], [3, 4, 0], [3, 4, 12]], [1, 1, 1]), morphio.SectionType.axon
+    )
+    axon.append_section(morphio.PointLevel([[3, 4, 12], [3, 4, 13]], [1, 1]))
+    morph.append_root_section(
+        morphio.PointLevel([[0, 0, 0], [0, 0, -2]], [1, 1]), morphio.SectionType.basal_dendrite
+    )
+    return morph.as_immutable()
+
+
+def test_segment_table_from_morphology():
+    result = test_module.SegmentTable.from_morphology(_build_morph())
+
+    assert len(result) == 4
+    assert not result.empty
+    npt.assert_array_equal(result.section_ids, [0, 0, 1, 2])
+    npt.assert_array_equal(result.segment_ids, [0, 1, 0, 0])
+    npt.assert_array_equal(result.section_types, [2, 2, 2, 3])
+    npt.assert_array_equal(result.starts, [[0, 0, 0], [3, 4, 0], [3, 4, 12], [0, 0, 0]])
+    npt.assert_array_equal(result.ends, [[3, 4, 0], [3, 4, 12], [3, 4, 13], [0, 0, -2]])
+    npt.assert_allclose(result.lengths(), [5, 12, 1, 2])
+
+
+def test_segment_table_from_morphology_with_section_type():
+    morph = _build_morph()
+
+    result = test_module.SegmentTable.from_morphology(morph, morphio.SectionType.basal_dendrite)
+    npt.assert_array_equal(result.section_ids, [2])
+    npt.assert_array_equal(result.segment_ids, [0])
+
+    result = test_module.SegmentTable.from_morphology(morph, morphio.SectionType.apical_dendrite)
+    assert len(result) == 0
+    assert result.empty
+    assert result.starts.shape == (0, 3)
+    assert result.lengths().sum() == 0
+
+
+def test_segment_table_select():
+    table = test_module.SegmentTable.from_morphology(_build_morph())
+
+    result = table.select(np.array([False, True, True, False]))
+
+    npt.assert_array_equal(result.section_ids, [0, 1])
+    npt.assert_array_equal(result.segment_ids, [1, 0])
+    npt.assert_allclose(result.lengths(), [12, 1])
+
+
+def test_segment_table_of_type():
+    table = test_module.SegmentTable.from_morphology(_build_morph())
+
+    result = table.of_type(morphio.SectionType.basal_dendrite)
+
+    npt.assert_array_equal(result.section_ids, [2])
+    npt.assert_array_equal(result.starts, [[0, 0, 0]])
+
+
+def test_transform_tables():
+    table = test_module.SegmentTable.from_morphology(_build_morph())
+    tables = [table, table.select([]), table.of_type(morphio.SectionType.basal_dendrite)]
+    rotations = [
+        [[0, 0, 1], [0, 1, 0], [-1, 0, 0]],
+        np.identity(3),
+        [[0, -1, 0], [1, 0, 0], [0, 0, 1]],
+    ]
+    translations = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+
+    result = test_module.transform_tables(tables, rotations, translations)
+
+    assert len(result) == 3
+    npt.assert_allclose(result[0].starts[1], [1, 6, 0])
+    npt.assert_allclose(result[0].ends[1], [13, 6, 0])
+    for item, table, rotation, translation in zip(result, tables, rotations, translations):
+        assert item.starts.dtype == table.starts.dtype
+        npt.assert_allclose(item.starts, table.starts @ np.transpose(rotation) + translation)
+        npt.assert_allclose(item.ends, table.ends @ np.transpose(rotation) + translation)
+        npt.assert_allclose(item.lengths(), table.lengths(), rtol=1e-6)
+        npt.assert_array_equal(item.section_ids, table.section_ids)
+        npt.assert_array_equal(item.segment_ids, table.segment_ids)
+
+
+def test_morphology_index_from_directories():
+    with tmp_cwd() as tmp_dir:
+        for name in ["h5/A.h5", "h5/B.txt", "asc/A.asc", "asc/C.asc", "swc/D.swc", "swc/E.swc/x"]:
+            path = Path(tmp_dir, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        directories = [
+            ("h5", Path(tmp_dir, "h5")),
+            ("asc", Path(tmp_dir, "asc")),
+            ("swc", Path(tmp_dir, "swc")),
+            ("swc", Path(tmp_dir, "missing")),
+        ]
+
+        result = test_module.MorphologyIndex.from_directories(directories)
+
+    assert len(result) == 3
+    assert result.extension("A") == "h5"
+    assert result.extension("C") == "asc"
+    assert result.extension("D") == "swc"
+    assert result.extension("B") is None
+    assert "E" not in result
+
+
+def test_morphology_index_subset():
+    index = test_module.MorphologyIndex({"A": "h5", "B": "asc"})
+
+    result = index.subset(["B", "C"])
+
+    assert len(result) == 1
+    assert result.extension("B") == "asc"
+    assert "A" not in result
+
+
+def test_morphology_cache():
+    cache = test_module.MorphologyCache(maxsize=2)
+    load = Mock(side_effect=lambda: object())
+
+    a = cache.get("A", load)
+    b = cache.get("B", load)
+    assert cache.get("A", load) is a  # A is now the most recently used
+    cache.get("C", load)  # B is evicted
+    assert cache.get("A", load) is a
+    assert cache.get("B", load) is not b
+
+    assert load.call_count == 4
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert len(cache) == 2
+    assert repr(cache) == "MorphologyCache(hits=2, misses=4, size=2, maxsize=2)"
+
+    cache.clear()
+    assert (cache.hits, cache.misses, len(cache)) == (0, 0, 0)
+
+
+def test_morphology_cache_disabled():
+    cache = test_module.MorphologyCache(maxsize=0)
+    load = Mock(side_effect=lambda: object())
+
+    assert cache.get("A", load) is not cache.get("A", load)
+    assert (cache.hits, cache.misses, len(cache)) == (0, 2, 0)
+
+
+@patch.object(test_module, "load_morph_file")
+def test_get_morph(mock_load_morph_file):
+    mock_morph = Mock(get_filepath=MagicMock(), get=Mock())
+    node_population = Mock(morph=mock_morph, config={})
+    result = test_module.get_morph(node_population, 1)
+    mock_morph.get_filepath.assert_called_once_with(1, extension="h5")
+    mock_load_morph_file.assert_called_once_with(mock_morph.get_filepath.return_value)
+    assert result is mock_load_morph_file.return_value
+    mock_load_morph_file.reset_mock()
+
+    def _nonexistent_path(*_, **__):
+        return Path("./does_not_exist")
+
+    mock_morph = Mock(get_filepath=Mock(side_effect=_nonexistent_path), get=Mock())
+    node_population = Mock(morph=mock_morph, config={})
+
+    with pytest.raises(RuntimeError, match="Couldn't find morphology for node"):
+        test_module.get_morph(node_population, 1)
+
+    mock_morph.get_filepath.assert_has_calls(
+        (
+            call(1, extension="h5"),
+            call(1, extension="asc"),
+            call(1, extension="swc"),
+        )
+    )
+    mock_load_morph_file.assert_not_called()
+
+
+@patch.object(test_module, "load_morph_file")
+def test_get_morph_with_index(mock_load_morph_file):
+    mock_path = Mock()
+    mock_morph = Mock(get_filepath=Mock(return_value=mock_path), get=Mock())
+    node_population = Mock(morph=mock_morph, config={})
+    node_population.get.return_value = "morph_A"
+    index = test_module.MorphologyIndex({"morph_A": "asc"})
+
+    test_module.get_morph(node_population, 1, index=index)
+
+    mock_morph.get_filepath.assert_called_once_with(1, extension="asc")
+    mock_load_morph_file.assert_called_once_with(mock_path)
+    # the existence of the file isn't checked
+    mock_path.is_file.assert_not_called()
+
+
+def test_load_morph_file():
+    with tmp_cwd() as tmp_dir:
+        path = Path(tmp_dir, "morph.h5")
+        morphio.mut.Morphology(_build_morph()).write(str(path))
+
+        result = test_module.load_morph_file(path)
+
+    assert isinstance(result, morphio.Morphology)
+    assert len(result.sections) == len(_build_morph().sections)
+
+
+@patch.object(test_module, "_open_container")
+def test_get_morph_from_container(mock_open_container):
+    mock_morph = Mock(get_filepath=Mock(), get=Mock())
+    node_population = Mock(morph=mock_morph)
+    node_population.get.return_value = "morph_A"
+    with tmp_cwd() as tmp_dir:
+        container = Path(tmp_dir, "merged.h5")
+        container.touch()
+        node_population.config = {"alternate_morphologies": {"h5v1": str(container)}}
+
+        result = test_module.get_morph(node_population, 1)
+
+        assert test_module.morphology_dirs(node_population) == ()
+
+    mock_open_container.assert_called_once_with(str(container))
+    mock_collection = mock_open_container.return_value
+    mock_collection.load.assert_called_once_with("morph_A", mutable=True)
+    assert result is mock_collection.load.return_value.as_immutable.return_value
+    mock_morph.get.assert_not_called()
+    mock_morph.get_filepath.assert_not_called()
+
+
+def test_morphology_dirs():
+    node_population = Mock()
+    node_population.config = {
+        "morphologies_dir": "/swc",
+        "alternate_morphologies": {"h5v1": "/h5"},
+    }
+
+    result = test_module.morphology_dirs(node_population)
+
+    assert result == (("h5", "/h5"), ("swc", "/swc"))
+
+
+def test_sample_morphology_index():
+    with tmp_cwd() as tmp_dir:
+        for name in ["h5/morph_A.h5", "swc/morph_A.swc", "swc/morph_B.swc", "swc/morph_C.swc"]:
+            path = Path(tmp_dir, name)
+            path.parent.mkdir(exist_ok=True)
+            path.touch()
+        node_population = Mock()
+        node_population.config = {
+            "morphologies_dir": str(Path(tmp_dir, "swc")),
+            "alternate_morphologies": {"h5v1": str(Path(tmp_dir, "h5"))},
+        }
+        node_population.get.return_value = pd.Series(["morph_A", "morph_B", "morph_A", "morph_D"])
+
+        result = test_module.sample_morphology_index(node_population, [1, 2, 3, 4])
+
+    assert len(result) == 2
+    assert result.extension("morph_A") == "h5"
+    assert result.extension("morph_B") == "swc"
+    assert "morph_C" not in result
+    assert result.extension("morph_D") is None
+
+
+@patch.object(test_module, "_morphology_index")
+def test_sample_morphology_index_with_lengths(mock_index):
+    node_population = Mock()
+    node_population.config = {"morphologies_dir": "/swc"}
+    node_population.get.return_value = pd.Series(["morph_A", "morph_B", "morph_A"])
+    lengths = _build_lengths()
+
+    result = test_module.sample_morphology_index(node_population, [1, 2, 3], lengths)
+
+    # the directories are not listed when all the morphologies are found in lengths
+    assert result is None
+    mock_index.assert_not_called()
+
+    node_population.get.return_value = pd.Series(["morph_A", "morph_C"])
+    result = test_module.sample_morphology_index(node_population, [1, 2], lengths)
+
+    assert result == mock_index.return_value.subset.return_value
+    mock_index.return_value.subset.assert_called_once_with(["morph_C"])
+
+
+def _build_lengths():
+    segments = test_module.SegmentTable.from_morphology(_build_morph())
+    return test_module.MorphologyLengths.from_segments(
+        [("morph_A", segments, 3), ("morph_B", segments.of_type(morphio.SectionType.axon), 2)],
+        {"axon": morphio.SectionType.axon, "basal_dendrite": morphio.SectionType.basal_dendrite},
+    )
+
+
+def test_morphology_lengths():
+    lengths = _build_lengths()
+
+    assert len(lengths) == 2
+    assert "morph_A" in lengths
+    assert "morph_C" not in lengths
+    assert lengths.total_length("morph_A", "axon") == 18
+    assert lengths.total_length("morph_A", "basal_dendrite") == 2
+    assert lengths.total_length("morph_B", "basal_dendrite") == 0
+    npt.assert_allclose(lengths.section_lengths_of("morph_A"), [17, 1, 2])
+    npt.assert_allclose(lengths.section_lengths_of("morph_B"), [17, 1])
+    npt.assert_allclose(lengths.extent("morph_A", "axon"), np.sqrt(194))
+    assert lengths.extent("morph_A", "basal_dendrite") == 2
+    assert lengths.extent("morph_B", "basal_dendrite") == 0
+
+
+def test_morphology_lengths_save_and_load():
+    expected = _build_lengths()
+    with tmp_cwd() as tmp_dir:
+        path = Path(tmp_dir, "lengths.npz")
+        expected.save(path)
+        result = test_module.MorphologyLengths.load(path)
+
+        npt.assert_array_equal(result.names, expected.names)
+        npt.assert_array_equal(result.neurite_types, expected.neurite_types)
+        npt.assert_array_equal(result.totals, expected.totals)
+        npt.assert_array_equal(result.section_lengths, expected.section_lengths)
+        npt.assert_allclose(result.section_lengths_of("morph_B"), [17, 1])
+        npt.assert_array_equal(result.extents, expected.extents)
+
+
+def test_morphology_lengths_load_without_extents():
+    expected = _build_lengths()
+    with tmp_cwd() as tmp_dir:
+        path = Path(tmp_dir, "lengths.npz")
+        expected.extents = None
+        expected.save(path)
+        result = test_module.MorphologyLengths.load(path)
+
+    assert result.extents is None
+    assert result.extent("morph_A", "axon") == np.inf
+
+
+def test_morphology_lengths_concatenate():
+    part = _build_lengths()
+
+    result = test_module.MorphologyLengths.concatenate([part, part])
+
+    npt.assert_array_equal(result.names, ["morph_A", "morph_B", "morph_A", "morph_B"])
+    npt.assert_array_equal(result.section_offsets, [0, 3, 5, 8, 10])
+    npt.assert_allclose(result.section_lengths, [17, 1, 2, 17, 1, 17, 1, 2, 17, 1])
+    npt.assert_allclose(result.totals[:, 0], [18, 18, 18, 18])
+    npt.assert_allclose(result.extents[:, 0], np.sqrt(194))
+
+
+@patch.object(test_module, "get_morph")
+def test_compute_morphology_lengths(mock_get_morph):
+    mock_get_morph.return_value = _build_morph()
+    names = pd.Series(["morph_A", "morph_B", "morph_A"], index=[10, 11, 12])
+    population = Mock()
+    population.config = {}
+    population.get.side_effect = lambda gid=None, properties=None: (
+        names if gid is None else names[gid]
+    )
+
+    result = test_module.compute_morphology_lengths(population)
+
+    npt.assert_array_equal(result.names, ["morph_A", "morph_B"])
+    npt.assert_array_equal(result.neurite_types, list(test_module.NEURITE_TYPES))
+    assert mock_get_morph.call_args_list == [
+        call(population, 10, index=None),
+        call(population, 11, index=None),
+    ]
+    segments = test_module.SegmentTable.from_morphology(mock_get_morph.return_value)
+    for i, section_type in enumerate(test_module.NEURITE_TYPES.values()):
+        expected = segments.of_type(section_type).lengths().sum()
+        npt.assert_almost_equal(result.totals[0, i], expected)
+        npt.assert_almost_equal(result.totals[1, i], expected)
@@ -0,0 +1,67 @@
+import numpy as np
+import numpy.testing as npt
+from mock import Mock
+
+import connectome_tools.sampling as test_module
+
+
+def test_running_stats():
+    rng = np.random.default_rng(0)
+    values = rng.normal(10, 2, size=(100, 3))
+    values[rng.random((100, 3)) < 0.1] = np.nan
+    running = test_module.RunningStats()
+
+    for batch in np.array_split(values, [1, 30, 31, 70]):
+        running.update(batch)
+
+    npt.assert_array_equal(running.count, np.count_nonzero(~np.isnan(values), axis=0))
+    npt.assert_allclose(running.mean, np.nanmean(values, axis=0))
+    npt.assert_allclose(running.variance, np.nanvar(values, axis=0, ddof=1))
+    expected = 1.959963984540054 * np.sqrt(running.variance / running.count) / running.mean
+    npt.assert_allclose(running.rel_half_width(), expected)
+
+
+def test_running_stats_converged():
+    running = test_module.RunningStats()
+    running.update([1.0])
+    # the confidence interval is undefined with a single value
+    assert np.isnan(running.rel_half_width())
+    assert not running.converged(0.5)
+
+    running.update([1.2, 0.8, 1.0])
+
+    assert running.converged(0.5)
+    assert not running.converged(0.01)
+
+
+def test_sample_adaptively():
+    compute = Mock(side_effect=lambda items: items * 10.0)
+    samples = [np.array([3, 1, 4]), np.array([1, 5, 9, 2]), np.array([], dtype=np.int64)]
+
+    result = test_module.sample_adaptively(samples, compute)
+
+    # all the items are processed at once, only once, in order of first occurrence
+    assert compute.call_count == 1
+    npt.assert_array_equal(compute.call_args[0][0], [3, 1, 4, 5, 9, 2])
+    npt.assert_array_equal(result[0], [30, 10, 40])
+    npt.assert_array_equal(result[1], [10, 50, 90, 20])
+    assert len(result[2]) == 0
+
+
+def test_sample_adaptively_with_rel_error():
+    constant = np.arange(101, 201)
+    variable = np.arange(1, 101)
+    values = dict(zip(constant, np.full(100, 5.0)))
+    values.update(zip(variable, np.linspace(0.1, 10, 100)))
+    compute = Mock(side_effect=lambda items: np.array([values[item] for item in items]))
+
+    result = test_module.sample_adaptively(
+        [constant, variable], compute, rel_error=0.2, batch_size=10
+    )
+
+    # the sample with constant values converges after the first batch
+    npt.assert_array_equal(result[0], np.full(10, 5.0))
+    # the other sample converges when the confidence interval is narrow enough
+    npt.assert_array_equal(result[1], np.linspace(0.1, 10, 100)[:40])
+    assert compute.call_args_list[0][0][0].tolist() == [*range(101, 111), *range(1, 11)]
+    assert compute.call_args_list[1][0][0].tolist() == list(range(11, 21))
@@ -0,0 +1,30 @@
+import numpy as np
+import numpy.testing as npt
+
+import connectome_tools.seeding as test_module
+
+
+def test_item_rng():
+    values = test_module.item_rng(0, "A", {"mtype": "L1"}).random(5)
+
+    # the same seed and key always give the same stream
+    npt.assert_array_equal(test_module.item_rng(0, "A", {"mtype": "L1"}).random(5), values)
+    # a different seed or key give a different stream
+    assert not np.array_equal(test_module.item_rng(1, "A", {"mtype": "L1"}).random(5), values)
+    assert not np.array_equal(test_module.item_rng(0, "A", {"mtype": "L2"}).random(5), values)
+    assert not np.array_equal(test_module.item_rng(0, "B", {"mtype": "L1"}).random(5), values)
+
+
+def test_legacy_random_state():
+    np.random.seed(42)
+    expected_global = np.random.random(3)
+
+    np.random.seed(42)
+    with test_module.legacy_random_state(test_module.item_rng(0, "A")):
+        first = np.random.random(3)
+    # the global state is restored
+    npt.assert_array_equal(np.random.random(3), expected_global)
+
+    with test_module.legacy_random_state(test_module.item_rng(0, "A")):
+        second = np.random.random(3)
+    npt.assert_array_equal(first, second)
@@ -0,0 +1,21 @@
+from pathlib import Path
+
+from mock import Mock
+from utils import tmp_cwd
+
+import connectome_tools.slurm as test_module
+
+
+def test_execute_pending_tasks_success():
+    pending_tasks = [Mock(), Mock(), Mock()]
+    executor_params = {"timeout_min": 1}
+    with tmp_cwd() as tmp_dir:
+        folder = Path(tmp_dir)
+        # Execute tasks in the same process using cluster='debug' because mocks cannot be pickled.
+        # Do not test failures, because DebugJob.results() would start pdb and wait for stdin.
+        failures = test_module.execute_pending_tasks(
+            pending_tasks, executor_params, folder, cluster="debug"
+        )
+
+    assert failures == 0
+    assert all(task.run.call_count == 1 for task in pending_tasks)
@@ -1,102 +1,334 @@
+import json
+import os
 from pathlib import Path
 
+import h5py
+import libsonata
 import morphio
 import numpy as np
 import numpy.testing as npt
 import pandas as pd
 import pytest
+from bluepysnap import Circuit
 from bluepysnap.edges import EdgePopulation
 from mock import MagicMock, Mock, call, patch
-from voxcell import ROIMask
+from utils import tmp_cwd
+from voxcell import ROIMask, VoxelData
 
 import connectome_tools.stats as test_module
-from connectome_tools.utils import Properties
+from connectome_tools.mask import CompactMask
+from connectome_tools.morphology import MorphologyCache, MorphologyLengths, SegmentTable
+from connectome_tools.synapses import POSITION_PROPERTIES
+from connectome_tools.utils import Properties, Task, parallel_backend, run_parallel
 
 
 def _get_segment_points(data, index_tuples=None):
-    return pd.DataFrame(
-        data=data,
-        columns=[*test_module.SEGMENT_START_COLS, *test_module.SEGMENT_END_COLS],
-        index=pd.MultiIndex.from_tuples(
-            index_tuples or [(0, i) for i in range(len(data))],
-            names=[Properties.SECTION_ID, Properties.SEGMENT_ID],
-        ),
+    data = np.asarray(data)
+    section_ids, segment_ids = np.array(index_tuples or [(0, i) for i in range(len(data))]).T
+    return SegmentTable(
+        starts=data[:, 0:3],
+        ends=data[:, 3:6],
+        section_ids=section_ids,
+        segment_ids=segment_ids,
+        section_types=np.full(len(data), int(morphio.SectionType.axon)),
     )
 
 
-def test__segment_points():
-    rng = np.random.default_rng(42)
+def _mock_edge_population():
+    # all the cells are placed at the origin without rotation
+    population = MagicMock(EdgePopulation)
+    population.source.orientations.side_effect = lambda gids: pd.Series(
+        [np.identity(3)] * len(gids)
+    )
+    population.source.positions.side_effect = lambda gids: pd.DataFrame(
+        np.zeros((len(gids), 3)), columns=["x", "y", "z"]
+    )
+    return population
 
-    def _section(id_, type_):
-        pts = np.round(rng.random((4, 3)) * 100, 1)
-        return Mock(points=pts, type=type_, id=id_)
 
-    types = rng.integers(1, 5, 10)
-    sections = [_section(i, t) for i, t in enumerate(types)]
-    mock_morph = Mock(iter=Mock(return_value=sections))
-    res = test_module._segment_points(mock_morph, morphio.SectionType.axon)
+def _mock_source_index(population, sources):
+    # the efferent synapses of each gid are counted using only the source index of the edges
+    sources = np.asarray(sources)
+    population._population.efferent_edges.side_effect = lambda gid: libsonata.Selection(
+        [(0, np.count_nonzero(sources == gid))] if gid in sources else []
+    )
 
-    seg_id = np.where(types == 2)[0] + 1  # +1 for the soma-shift (soma = 0)
-    idx = [(i, j) for i in seg_id for j in range(3)]
 
-    expected = pd.DataFrame(
-        {
-            "x1": [83.3, 83.2, 28.8, 66.5, 45.9, 11.5],
-            "y1": [70.0, 80.5, 68.2, 70.5, 56.9, 66.8],
-            "z1": [31.2, 38.7, 14.0, 78.1, 14.0, 47.1],
-            "x2": [83.2, 28.8, 20.0, 45.9, 11.5, 56.5],
-            "y2": [80.5, 68.2, 0.7, 56.9, 66.8, 76.5],
-            "z2": [38.7, 14.0, 78.7, 14.0, 47.1, 63.5],
+def _build_circuit(path):
+    # two cells at the origin, with the same axon of two segments along x
+    path = Path(path)
+    (path / "morphologies").mkdir()
+    (path / "morphologies" / "cell.swc").write_text(
+        "1 1 0 0 0 1 -1\n2 2 0 0 0 0.1 1\n3 2 2 0 0 0.1 2\n4 2 6 0 0 0.1 3\n"
+    )
+    with h5py.File(path / "nodes.h5", "w") as h5:
+        group = h5.create_group("nodes/default")
+        group["node_type_id"] = np.full(2, -1)
+        for name in ["x", "y", "z"]:
+            group[f"0/{name}"] = np.zeros(2)
+        group["0/morphology"] = ["cell", "cell"]
+        group["0/model_type"] = ["biophysical", "biophysical"]
+    # the first cell has one synapse on the second segment, the other ones are on the first
+    with h5py.File(path / "edges.h5", "w") as h5:
+        group = h5.create_group("edges/default")
+        for name, values in [("source_node_id", [0, 0, 0, 1]), ("target_node_id", [1, 1, 1, 0])]:
+            group[name] = values
+            group[name].attrs["node_population"] = "default"
+        group["edge_type_id"] = np.full(4, -1)
+        group["0/efferent_section_id"] = [1, 1, 1, 1]
+        group["0/efferent_segment_id"] = [0, 0, 1, 0]
+    libsonata.EdgePopulation.write_indices(str(path / "edges.h5"), "default", 2, 2)
+    config = {
+        "components": {
+            "morphologies_dir": str(path / "morphologies"),
+            "biophysical_neuron_models_dir": str(path),
+        },
+        "networks": {
+            "nodes": [{"nodes_file": str(path / "nodes.h5"), "populations": {"default": {}}}],
+            "edges": [{"edges_file": str(path / "edges.h5"), "populations": {"default": {}}}],
         },
-        index=pd.MultiIndex.from_tuples(idx, names=["section_id", "segment_id"]),
+    }
+    (path / "circuit_config.json").write_text(json.dumps(config))
+    # the mask contains only the second segment of the axons
+    (path / "atlas").mkdir()
+    raw = np.zeros((10, 3, 3), dtype=np.uint8)
+    raw[1:7, 1, 1] = 1
+    VoxelData(raw, voxel_dimensions=(1, 1, 1), offset=(0.5, -1.5, -1.5)).save_nrrd(
+        str(path / "atlas" / "Foo.nrrd")
+    )
+    return path / "circuit_config.json", path / "atlas"
+
+
+def _build_branching_circuit(path):
+    # two cells placed along x, with an axon of three sections bifurcating at x=4
+    path = Path(path)
+    (path / "morphologies").mkdir()
+    (path / "morphologies" / "cell.swc").write_text(
+        "1 1 0 0 0 1 -1\n2 2 0 0 0 0.1 1\n3 2 2 0 0 0.1 2\n4 2 4 0 0 0.1 3\n"
+        "5 2 6 0 0 0.1 4\n6 2 8 0 0 0.1 5\n7 2 4 2 0 0.1 4\n8 2 4 4 0 0.1 7\n"
+    )
+    with h5py.File(path / "nodes.h5", "w") as h5:
+        group = h5.create_group("nodes/default")
+        group["node_type_id"] = np.full(2, -1)
+        group["0/x"] = [10.0, 14.0]
+        group["0/y"] = np.zeros(2)
+        group["0/z"] = np.zeros(2)
+        group["0/morphology"] = ["cell", "cell"]
+        group["0/model_type"] = ["biophysical", "biophysical"]
+    # (section id, segment id) of the synapses, with the soma as section 0
+    synapses = [
+        (0, [(1, 1), (2, 0), (2, 1), (2, 1), (3, 0), (1, 0)]),
+        (1, [(1, 1), (1, 1), (2, 0)]),
+    ]
+    sources = [gid for gid, ids in synapses for _ in ids]
+    section_ids, segment_ids = np.array([id_ for _, ids in synapses for id_ in ids]).T
+    with h5py.File(path / "edges.h5", "w") as h5:
+        group = h5.create_group("edges/default")
+        for name, values in [("source_node_id", sources), ("target_node_id", np.ones(9, int))]:
+            group[name] = values
+            group[name].attrs["node_population"] = "default"
+        group["edge_type_id"] = np.full(9, -1)
+        group["0/efferent_section_id"] = section_ids
+        group["0/efferent_segment_id"] = segment_ids
+    libsonata.EdgePopulation.write_indices(str(path / "edges.h5"), "default", 2, 2)
+    config = {
+        "components": {
+            "morphologies_dir": str(path / "morphologies"),
+            "biophysical_neuron_models_dir": str(path),
+        },
+        "networks": {
+            "nodes": [{"nodes_file": str(path / "nodes.h5"), "populations": {"default": {}}}],
+            "edges": [{"edges_file": str(path / "edges.h5"), "populations": {"default": {}}}],
+        },
+    }
+    (path / "circuit_config.json").write_text(json.dumps(config))
+    # the mask contains the points on the x axis with 11.5 <= x <= 19.5
+    (path / "atlas").mkdir()
+    raw = np.zeros((30, 7, 3), dtype=np.uint8)
+    raw[12:20, 3, 1] = 1
+    VoxelData(raw, voxel_dimensions=(1, 1, 1), offset=(-0.5, -3.5, -1.5)).save_nrrd(
+        str(path / "atlas" / "Foo.nrrd")
+    )
+    return path / "circuit_config.json", path / "atlas"
+
+
+def _baseline_bouton_density(edge_population, gid, morph_path, mask):
+    # per-section algorithm of the former implementation, applying the soma offset only once
+    morph = morphio.Morphology(morph_path)
+    position = edge_population.source.positions(gid).to_numpy(dtype=float)
+    index = []
+    chunks = []
+    for sec in morph.iter():
+        if sec.type == morphio.SectionType.axon:
+            pts = sec.points + position
+            chunks.append(np.hstack([pts[:-1], pts[1:]]))
+            index.extend((sec.id + 1, seg_id) for seg_id in range(len(pts) - 1))
+    segments = pd.DataFrame(np.concatenate(chunks), index=pd.MultiIndex.from_tuples(index))
+    inside = mask.lookup(segments.values[:, :3], outer_value=False)
+    inside &= mask.lookup(segments.values[:, 3:], outer_value=False)
+    filtered = segments[inside]
+    cols = [Properties.PRE_SECTION_ID, Properties.PRE_SEGMENT_ID]
+    syn_per_segment = edge_population.efferent_edges(gid, properties=cols).groupby(cols).size()
+    synapse_count = syn_per_segment.loc[syn_per_segment.index.intersection(filtered.index)].sum()
+    segment_length = np.linalg.norm(filtered.values[:, :3] - filtered.values[:, 3:], axis=1).sum()
+    return synapse_count / segment_length
+
+
+def _random_morph():
+    rng = np.random.default_rng(42)
+    morph = morphio.mut.Morphology()
+    types = rng.integers(2, 5, 10)
+    for type_ in types:
+        n_points = rng.integers(2, 6)
+        points = np.round(rng.random((n_points, 3)) * 100, 1)
+        morph.append_root_section(
+            morphio.PointLevel(points.tolist(), [1.0] * n_points), morphio.SectionType(type_)
+        )
+    return morph.as_immutable()
+
+
+@patch.object(test_module, "morph_loader")
+def test__segment_points_loader(mock_morph_loader):
+    morph = _random_morph()
+    mock_morph_loader.return_value = Mock(return_value=morph)
+    node_population = Mock()
+
+    res = test_module._segment_points_loader(node_population, 1, morphio.SectionType.axon)()
+    mock_morph_loader.assert_called_once_with(
+        node_population, 1, node_population.get.return_value, None
     )
-    assert res.equals(expected)
 
+    sections = [sec for sec in morph.iter() if sec.type == morphio.SectionType.axon]
+    assert len(sections) > 0
+    npt.assert_array_equal(res.starts, np.concatenate([sec.points[:-1] for sec in sections]))
+    npt.assert_array_equal(res.ends, np.concatenate([sec.points[1:] for sec in sections]))
+    npt.assert_array_equal(
+        res.section_ids, np.concatenate([[sec.id] * (len(sec.points) - 1) for sec in sections])
+    )
+    npt.assert_array_equal(
+        res.segment_ids, np.concatenate([np.arange(len(sec.points) - 1) for sec in sections])
+    )
+    npt.assert_array_equal(res.section_types, int(morphio.SectionType.axon))
+    # the segments are untransformed, and the placement of the cell is not read
+    node_population.orientations.assert_not_called()
+    node_population.positions.assert_not_called()
 
-@patch.object(test_module.Atlas, "open")
-def test__load_mask(mock_atlas_open):
-    mock_atlas_open.return_value = mock_atlas = Mock(load_data=Mock())
-    assert test_module._load_mask(None, "Bar") is None
-    mock_atlas_open.assert_not_called()
 
-    assert test_module._load_mask("Foo", "Bar") is not None
-    mock_atlas_open.assert_called_once_with("Bar")
-    mock_atlas.load_data.assert_called_once_with("Foo", cls=ROIMask)
+@patch.object(test_module, "morph_loader")
+def test__segment_points_loader_with_cache(mock_morph_loader):
+    mock_morph_loader.return_value = Mock(return_value=_random_morph())
+    names = {1: "morph_A", 2: "morph_B", 3: "morph_A"}
+    node_population = Mock(get=Mock(side_effect=lambda gid, properties: names[gid]))
+    cache = MorphologyCache(maxsize=10)
 
-    with pytest.raises(ValueError, match="Missing atlas path"):
-        test_module._load_mask("Foo", None)
+    results = [
+        test_module._segment_points_loader(node_population, gid, morphio.SectionType.axon, cache)()
+        for gid in [1, 2, 3, 1]
+    ]
 
+    assert mock_morph_loader.call_args_list == [
+        call(node_population, 1, "morph_A", None),
+        call(node_population, 2, "morph_B", None),
+    ]
+    assert mock_morph_loader.return_value.call_count == 2
+    npt.assert_array_equal(results[0].starts, results[2].starts)
+    assert (cache.hits, cache.misses) == (2, 2)
 
-def test__get_morph():
-    mock_morph = Mock(get_filepath=MagicMock(), get=Mock())
-    node_population = Mock(morph=mock_morph)
-    test_module._get_morph(node_population, 1, True)
-    mock_morph.get.assert_called_once_with(1, extension="h5", transform=True)
 
-    def _nonexistent_path(*_, **__):
-        return Path("./does_not_exist")
+def test__edge_population_ref():
+    population = Mock(_circuit=Mock(_circuit_config_path="circuit_config.json"))
+    population.name = "Foo"
+    assert test_module._edge_population_ref(population) == ("circuit_config.json", "Foo")
 
-    mock_morph = Mock(get_filepath=Mock(side_effect=_nonexistent_path), get=Mock())
-    node_population = Mock(morph=mock_morph)
+    population = Mock(_circuit=Mock(_circuit_config_path={"networks": {}}))
+    assert test_module._edge_population_ref(population) is None
+    assert test_module._edge_population_ref(MagicMock(EdgePopulation)) is None
 
-    with pytest.raises(RuntimeError, match="Couldn't find morphology for node"):
-        test_module._get_morph(node_population, 1, True)
 
-    mock_morph.get_filepath.assert_has_calls(
-        (
-            call(1, extension="h5"),
-            call(1, extension="asc"),
-            call(1, extension="swc"),
+@patch.object(test_module, "_sample_bouton_density_task")
+@patch("connectome_tools.mask.load_mask")
+@patch.object(test_module, "_open_edge_population")
+def test__sample_bouton_density_worker_task(mock_open, mock_load_mask, mock_task):
+    mock_load_mask.side_effect = lambda mask, atlas_path: f"loaded_{mask}"
+    test_module.load_masks.cache_clear()
+    ref = ("circuit_config.json", "Foo")
+
+    test_module._init_sample_bouton_density_worker(ref, ("A", "B"), "atlas")
+    for gids in [[1, 2], [3]]:
+        test_module._sample_bouton_density_worker_task(
+            ref, gids, mask=["A", "B"], atlas_path="atlas", neurite_type="axon"
         )
+    test_module.load_masks.cache_clear()
+
+    # the masks are loaded only once, by the initializer
+    assert mock_load_mask.call_args_list == [call("A", "atlas"), call("B", "atlas")]
+    assert mock_open.call_args_list == [call(*ref)] * 3
+    mock_task.assert_called_with(
+        mock_open.return_value,
+        [3],
+        mask=["loaded_A", "loaded_B"],
+        atlas_path="atlas",
+        neurite_type="axon",
     )
-    mock_morph.get.assert_not_called()
 
 
-@patch.object(test_module, "_segment_points")
-def test_bouton_density_1_without_mask(mock_segment_points):
+@patch.dict(test_module.os.environ, {"CHUNKS_PER_JOB": "2"})
+@patch.object(test_module, "sample_morphology_index")
+@patch.object(test_module, "efferent_synapse_counts", return_value=np.array([1, 50, 3, 8, 0, 20]))
+@patch.object(test_module, "_sample_bouton_density_task")
+@patch.object(test_module, "run_parallel")
+def test__sample_bouton_density_parallel_with_cost_balanced_chunks(
+    mock_run_parallel, mock_task, mock_counts, mock_index
+):
+    mock_index.side_effect = lambda population, gids, lengths: f"index_{list(gids)}"
+    mock_task.side_effect = lambda population, gids, **kwargs: np.asarray(gids) * 10.0
+    mock_run_parallel.side_effect = lambda tasks, *args, **kwargs: [
+        task(task_id=i) for i, task in enumerate(tasks)
+    ]
+    population = MagicMock(EdgePopulation)
+    gids = np.array([5, 6, 7, 8, 9, 10])
+
+    result = test_module._sample_bouton_density_parallel(population, gids, n_jobs=2)
+
+    # the synapses of all the gids are counted with a bulk read
+    mock_counts.assert_called_once()
+    npt.assert_array_equal(mock_counts.call_args[0][1], gids)
+    assert mock_task.call_count == 4
+    # the gid with the highest cost is sampled first
+    npt.assert_array_equal(mock_task.call_args_list[0][0][1], [6])
+    # each task receives only the index of the morphologies of its gids
+    for args, kwargs in mock_task.call_args_list:
+        assert kwargs["morph_index"] == f"index_{list(args[1])}"
+    # the results are returned in the original order
+    npt.assert_array_equal(result, gids * 10.0)
+
+
+@patch.object(test_module, "shared_masks")
+def test_sample_bouton_density_with_mask_and_submitit(mock_shared_masks, monkeypatch):
+    with tmp_cwd() as tmp_dir:
+        circuit_config, atlas_path = _build_circuit(tmp_dir)
+        population = Circuit(str(circuit_config)).edges["default"]
+        monkeypatch.setenv("SUBMITIT_FOLDER", str(Path(tmp_dir, "submitit")))
+        monkeypatch.setenv("SUBMITIT_CLUSTER", "local")
+        # the local jobs run in new processes, that must import the package also when not installed
+        package_dir = Path(test_module.__file__).resolve().parents[1]
+        monkeypatch.setenv("PYTHONPATH", str(package_dir), prepend=os.pathsep)
+
+        with parallel_backend("submitit"):
+            result = test_module.sample_bouton_density(
+                population, n=2, mask="Foo", atlas_path=str(atlas_path), n_jobs=2
+            )
+
+    # the jobs load the masks from the atlas, instead of the local temporary files
+    mock_shared_masks.assert_not_called()
+    npt.assert_allclose(np.sort(result), [0.0, 0.25])
+
+
+@patch.object(test_module, "_segment_points_loader")
+def test_bouton_density_1_without_mask(mock_segment_points_loader):
     population = MagicMock(EdgePopulation)
-    population.iter_connections.return_value = [[None, None, 3]]  # number of connections
-    mock_segment_points.return_value = _get_segment_points(
+    _mock_source_index(population, [42, 42, 42])
+    mock_segment_points_loader.return_value.return_value = _get_segment_points(
         data=[
             [1.0, 1.0, 1.0, 3.0, 3.0, 3.0],
             [1.0, 1.0, 1.0, 4.0, 4.0, 4.0],
@@ -118,37 +350,78 @@ def test_bouton_density_1_without_mask(mock_segment_points):
     )
     actual = test_module.bouton_density(population, gid=42, synapses_per_bouton=1.5)
 
-    assert population.iter_connections.call_count == 1
-    assert mock_segment_points.call_count == 1
+    # the properties of the synapses are not read
+    assert population.efferent_edges.call_count == 0
+    assert mock_segment_points_loader.call_count == 1
     npt.assert_almost_equal(actual, expected)
 
 
-@patch.object(test_module, "Atlas")
-@patch.object(test_module, "_segment_points")
-def test_bouton_density_2_with_empty_mask(mock_segment_points, mock_atlas):
-    mock_mask = Mock()
-    mock_mask.lookup.return_value = np.array([False])
-    mock_atlas.load_data.return_value = mock_mask
-    mock_segment_points.return_value = _get_segment_points(
+@patch.object(test_module, "_segment_points_loader")
+def test_bouton_density_1_with_lengths(mock_segment_points_loader):
+    population = MagicMock(EdgePopulation)
+    _mock_source_index(population, [42, 42, 42])
+    population.source.get.return_value = "morph_A"
+    lengths = MorphologyLengths(
+        names=["morph_A"],
+        neurite_types=["axon", "basal_dendrite"],
+        totals=[[10.0, 20.0]],
+        section_offsets=[0, 0],
+        section_lengths=np.empty(0),
+    )
+
+    actual = test_module.bouton_density(
+        population, gid=42, neurite_type="basal_dendrite", synapses_per_bouton=1.5, lengths=lengths
+    )
+
+    npt.assert_almost_equal(actual, 3 / 1.5 / 20.0)
+    population.source.get.assert_called_once_with(42, properties="morphology")
+    assert mock_segment_points_loader.call_count == 0
+
+
+@patch.object(test_module, "sample_morphology_index")
+def test__sample_morphology_index(mock_index):
+    population = MagicMock(EdgePopulation)
+    lengths = MorphologyLengths(
+        names=["morph_A"],
+        neurite_types=["axon"],
+        totals=[[10.0]],
+        section_offsets=[0, 0],
+        section_lengths=np.empty(0),
+    )
+
+    test_module._sample_morphology_index(population.source, [1, 2], None, lengths)
+    # without mask, the morphologies found in the lengths are not indexed
+    mock_index.assert_called_once_with(population.source, [1, 2], lengths=lengths)
+
+    test_module._sample_morphology_index(population.source, [1, 2], "Foo", lengths)
+    # with a mask, all the morphologies are loaded
+    mock_index.assert_called_with(population.source, [1, 2], lengths=None)
+
+
+@patch("connectome_tools.mask.Atlas")
+@patch.object(test_module, "_segment_points_loader")
+def test_bouton_density_2_with_empty_mask(mock_segment_points_loader, mock_atlas):
+    roi_mask = ROIMask(np.zeros((10, 10, 10), dtype=np.uint8), voxel_dimensions=(1, 1, 1))
+    mock_atlas.open.return_value = Mock(load_data=Mock(return_value=roi_mask))
+    mock_segment_points_loader.return_value.return_value = _get_segment_points(
         data=[
             [0.0, 1.0, 1.0, 0.0, 2.0, 2.0],  # both endpoints out of ROI
         ]
     )
-    population = MagicMock(EdgePopulation)
+    population = _mock_edge_population()
     actual = test_module.bouton_density(population, 42, mask="Foo", atlas_path="Foo")
     npt.assert_equal(actual, np.nan)
 
 
-@patch.object(test_module, "Atlas")
-@patch.object(test_module, "_segment_points")
-def test_bouton_density_3_with_mask(mock_segment_points, mock_atlas):
-    def _mock_lookup(points, outer_value):
-        return np.all(points > 0, axis=-1)
-
-    mock_mask = Mock()
-    mock_mask.lookup.side_effect = _mock_lookup
-    mock_atlas.open.return_value = Mock(load_data=Mock(return_value=mock_mask))
-    mock_segment_points.return_value = _get_segment_points(
+@patch("connectome_tools.mask.Atlas")
+@patch.object(test_module, "_segment_points_loader")
+def test_bouton_density_3_with_mask(mock_segment_points_loader, mock_atlas):
+    # the points with all the coordinates > 0 are inside the mask
+    roi_mask = ROIMask(
+        np.ones((10, 10, 10), dtype=np.uint8), voxel_dimensions=(1, 1, 1), offset=(0.5, 0.5, 0.5)
+    )
+    mock_atlas.open.return_value = Mock(load_data=Mock(return_value=roi_mask))
+    mock_segment_points_loader.return_value.return_value = _get_segment_points(
         data=[
             [0.0, 0.0, 0.0, 1.0, 1.0, 1.0],  # first endpoint out of ROI
             [1.0, 1.0, 1.0, 3.0, 3.0, 3.0],  # both endpoints within ROI
@@ -156,7 +429,7 @@ def test_bouton_density_3_with_mask(mock_segment_points, mock_atlas):
             [1.0, 1.0, 1.0, 5.0, 5.0, 5.0],  # both endpoints within ROI
             [1.0, 1.0, 1.0, 0.0, 0.0, 0.0],  # second endpoint out of ROI
         ],
-        # the section id is decremented by 1 to be consistent with bluepy 2.3.0
+        # the section ids assigned by MorphIO are 1 less than the ids in the edge file
         index_tuples=[
             (11 - 1, 0),  # "outer" segment
             (11 - 1, 1),  # "inner" segment
@@ -165,16 +438,17 @@ def test_bouton_density_3_with_mask(mock_segment_points, mock_atlas):
             (12 - 1, 1),  # "outer" segment
         ],
     )
-    population = MagicMock(EdgePopulation)
+    population = _mock_edge_population()
     population.efferent_edges.return_value = pd.DataFrame(
         data=[
-            [11, 0],  # "outer" segment
-            [11, 1],  # "inner" segment
-            [12, 0],  # "inner" segment
-            [11, 1],  # "inner" segment
-            [11, 1],  # "inner" segment
+            [42, 11, 0],  # "outer" segment
+            [42, 11, 1],  # "inner" segment
+            [42, 12, 0],  # "inner" segment
+            [42, 11, 1],  # "inner" segment
+            [42, 11, 1],  # "inner" segment
         ],
         columns=[
+            "@source_node",
             Properties.PRE_SECTION_ID,
             Properties.PRE_SEGMENT_ID,
         ],
@@ -190,20 +464,533 @@ def test_bouton_density_3_with_mask(mock_segment_points, mock_atlas):
     npt.assert_almost_equal(actual, expected)
 
 
-@patch(test_module.__name__ + "._calc_bouton_density", side_effect=[42.0, 43.0])
-def test_sample_bouton_density_1(_):
+def test_bouton_density_with_mask_matches_baseline():
+    with tmp_cwd() as tmp_dir:
+        circuit_config, atlas_path = _build_branching_circuit(tmp_dir)
+        population = Circuit(str(circuit_config)).edges["default"]
+        mask = ROIMask.load_nrrd(str(atlas_path / "Foo.nrrd"))
+        morph_path = str(Path(tmp_dir, "morphologies", "cell.swc"))
+        expected = [_baseline_bouton_density(population, gid, morph_path, mask) for gid in [0, 1]]
+
+        actual = [
+            test_module.bouton_density(population, gid, mask="Foo", atlas_path=str(atlas_path))
+            for gid in [0, 1]
+        ]
+        sampled = test_module.sample_bouton_density(
+            population, n=2, mask="Foo", atlas_path=str(atlas_path)
+        )
+
+    # the first cell has 4 synapses on the segments inside the mask, the second one has 2
+    npt.assert_allclose(expected, [4 / 6, 2 / 4])
+    npt.assert_allclose(actual, expected)
+    npt.assert_allclose(np.sort(sampled), np.sort(expected))
+
+
+@patch.dict(test_module.os.environ, {"MASK_LOOKUP_SEGMENTS": "3"})
+@patch.object(test_module, "load_mask")
+@patch.object(test_module, "_segment_points_loader")
+def test__sample_bouton_density_task_with_mask(mock_segment_points_loader, mock_load_mask):
+    mock_mask = mock_load_mask.return_value
+    mock_mask.lookup.side_effect = lambda points, outer_value: np.all(points > 0, axis=-1)
+    mock_segment_points_loader.side_effect = lambda population, gid, *args, **kwargs: lambda: (
+        _get_segment_points(
+            data=[[gid, gid, gid, 2.0, 2.0, 2.0], [1.0, 1.0, 1.0, 3.0, 3.0, 3.0]],
+            index_tuples=[(0, 0), (0, 1)],
+        )
+    )
+    population = _mock_edge_population()
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [0, 1, 1, 2],
+            Properties.PRE_SECTION_ID: [1, 1, 1, 1],
+            Properties.PRE_SEGMENT_ID: [0, 0, 1, 1],
+        }
+    )
+
+    result = test_module._sample_bouton_density_task(population, [0, 1, 2], mask="Foo")
+
+    # the segments of the first 2 gids are looked up together, then the last gid
+    assert mock_mask.lookup.call_count == 2
+    length = np.sqrt(12)
+    # the synapse count, the segment length and the density of each gid
+    npt.assert_allclose(
+        result,
+        [
+            [0, length, 0 / length],
+            [2, np.sqrt(3) + length, 2 / (np.sqrt(3) + length)],
+            [1, length, 1 / length],
+        ],
+    )
+
+
+@patch.object(test_module, "load_mask")
+@patch.object(test_module, "_segment_points_loader")
+def test__sample_bouton_density_task_with_placements(mock_segment_points_loader, mock_load_mask):
+    mock_mask = mock_load_mask.return_value
+    mock_mask.lookup.side_effect = lambda points, outer_value: np.all(points > 0, axis=-1)
+    mock_segment_points_loader.return_value.return_value = _get_segment_points(
+        data=[[0.0, 0.0, 0.0, 1.0, 1.0, 1.0]], index_tuples=[(0, 0)]
+    )
+    population = MagicMock(EdgePopulation)
+    # the first cell is moved inside the mask, the second one is rotated outside the mask
+    population.source.orientations.return_value = pd.Series(
+        [np.identity(3), np.diag([-1.0, 1.0, 1.0])]
+    )
+    population.source.positions.return_value = pd.DataFrame(
+        [[1.0, 1.0, 1.0], [0.0, 0.0, 0.0]], columns=["x", "y", "z"]
+    )
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [0, 1],
+            Properties.PRE_SECTION_ID: [1, 1],
+            Properties.PRE_SEGMENT_ID: [0, 0],
+        }
+    )
+
+    result = test_module._sample_bouton_density_task(population, [0, 1], mask="Foo")
+
+    # the placement of all the cells is read at once, and applied to the untransformed segments
+    population.source.orientations.assert_called_once()
+    npt.assert_array_equal(population.source.orientations.call_args[0][0], [0, 1])
+    population.source.positions.assert_called_once()
+    npt.assert_allclose(result[..., -1], [1 / np.sqrt(3), np.nan])
+
+
+@patch.object(test_module, "load_mask")
+@patch.object(test_module, "_segment_points_loader")
+def test__sample_bouton_density_task_with_synapse_positions(
+    mock_segment_points_loader, mock_load_mask
+):
+    mock_mask = mock_load_mask.return_value
+    mock_mask.lookup.side_effect = lambda points, outer_value: np.all(points > 0, axis=-1)
+    mock_segment_points_loader.side_effect = lambda population, gid, *args, **kwargs: lambda: (
+        _get_segment_points(
+            data=[[gid, gid, gid, 2.0, 2.0, 2.0], [1.0, 1.0, 1.0, 3.0, 3.0, 3.0]],
+            index_tuples=[(0, 0), (0, 1)],
+        )
+    )
+    population = _mock_edge_population()
+    population.property_names = {
+        Properties.PRE_SECTION_ID,
+        Properties.PRE_SEGMENT_ID,
+        Properties.PRE_CENTER_X,
+        Properties.PRE_CENTER_Y,
+        Properties.PRE_CENTER_Z,
+    }
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [0, 1, 1, 2, 2],
+            Properties.PRE_CENTER_X: [1.0, 1.0, -1.0, 2.0, 2.5],
+            Properties.PRE_CENTER_Y: [1.0, 1.0, 1.0, 2.0, 2.5],
+            Properties.PRE_CENTER_Z: [1.0, 1.0, 1.0, 2.0, 2.5],
+        }
+    )
+
+    result = test_module._sample_bouton_density_task(
+        population, [0, 1, 2], mask="Foo", synapse_positions=True
+    )
+
+    # the synapses are counted by position, without reading the section and segment ids
+    assert population.efferent_edges.call_args[1] == {
+        "properties": ["@source_node", *POSITION_PROPERTIES]
+    }
+    length = np.sqrt(12)
+    npt.assert_allclose(result[..., -1], [1 / length, 1 / (np.sqrt(3) + length), 2 / length])
+
+
+@patch.object(test_module, "load_mask")
+@patch.object(test_module, "_load_segments_loader")
+def test__sample_bouton_density_task_with_threading(mock_load_segments_loader, mock_load_mask):
+    def locked(func):
+        # the populations must be read only while holding the lock
+        def wrapper(*args, **kwargs):
+            assert test_module._POPULATION_LOCK.locked()
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    mock_load_mask.return_value.lookup.side_effect = lambda points, outer_value: np.all(
+        points > 0, axis=-1
+    )
+    mock_load_segments_loader.return_value.return_value = _get_segment_points(
+        data=[[1.0, 1.0, 1.0, 2.0, 2.0, 2.0]]
+    )
+    population = _mock_edge_population()
+    population.source.orientations.side_effect = locked(population.source.orientations.side_effect)
+    population.source.positions.side_effect = locked(population.source.positions.side_effect)
+    population.efferent_edges.side_effect = locked(
+        lambda gids, properties: pd.DataFrame(
+            {
+                "@source_node": np.repeat(gids, 2),
+                Properties.PRE_SECTION_ID: np.ones(2 * len(gids), dtype=int),
+                Properties.PRE_SEGMENT_ID: np.zeros(2 * len(gids), dtype=int),
+            }
+        )
+    )
+    tasks = [
+        Task(test_module._sample_bouton_density_task, population, [gid], mask="Foo")
+        for gid in range(8)
+    ]
+
+    result = run_parallel(tasks, jobs=4, base_seed=None, backend="threading")
+
+    npt.assert_allclose([item.value[..., -1] for item in result], np.full((8, 1), 2 / np.sqrt(3)))
+
+
+@patch.object(test_module, "load_mask")
+@patch.object(test_module, "_segment_points_loader")
+def test__sample_bouton_density_task_with_synapse_positions_and_multiple_neurite_types(
+    mock_segment_points_loader, mock_load_mask
+):
+    mock_mask = mock_load_mask.return_value
+    mock_mask.lookup.side_effect = lambda points, outer_value: np.all(points > 0, axis=-1)
+    # one axon segment of length sqrt(3), and one dendrite segment of length sqrt(12)
+    mock_segment_points_loader.return_value.return_value = SegmentTable(
+        starts=np.array([[1.0, 1.0, 1.0], [1.0, 1.0, 1.0]]),
+        ends=np.array([[2.0, 2.0, 2.0], [3.0, 3.0, 3.0]]),
+        section_ids=np.array([0, 1]),
+        segment_ids=np.array([0, 0]),
+        section_types=np.array(
+            [int(morphio.SectionType.axon), int(morphio.SectionType.basal_dendrite)]
+        ),
+    )
+    population = _mock_edge_population()
+    population.property_names = {
+        Properties.PRE_SECTION_ID,
+        Properties.PRE_SEGMENT_ID,
+        *POSITION_PROPERTIES,
+    }
+    # 3 synapses inside the mask, 2 on the axon segment and 2 on the dendrite segment
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [0, 0, 0, 0],
+            Properties.PRE_SECTION_ID: [1, 2, 2, 1],
+            Properties.PRE_SEGMENT_ID: [0, 0, 0, 0],
+            Properties.PRE_CENTER_X: [1.0, 1.5, 2.0, -1.0],
+            Properties.PRE_CENTER_Y: [1.0, 1.5, 2.0, 1.0],
+            Properties.PRE_CENTER_Z: [1.0, 1.5, 2.0, 1.0],
+        }
+    )
+
+    result = test_module._sample_bouton_density_task(
+        population, [0], neurite_type=["axon", "basal_dendrite"], mask="Foo", synapse_positions=True
+    )
+
+    # the segments are read for the dendrite, together with the positions for the axon
+    assert set(population.efferent_edges.call_args[1]["properties"]) == {
+        "@source_node",
+        Properties.PRE_SECTION_ID,
+        Properties.PRE_SEGMENT_ID,
+        *POSITION_PROPERTIES,
+    }
+    npt.assert_allclose(result[..., -1], [[3 / np.sqrt(3), 2 / np.sqrt(12)]])
+
+
+def test__reachable_gids():
+    # the mask contains only the voxel between (10, 10, 10) and (11, 11, 11)
+    raw = np.zeros((12, 12, 12), dtype=np.uint8)
+    raw[10, 10, 10] = 1
+    mask = CompactMask.from_voxel_data(ROIMask(raw, voxel_dimensions=(1, 1, 1)))
+    lengths = MorphologyLengths(
+        names=["morph_A", "morph_B"],
+        neurite_types=["axon", "basal_dendrite"],
+        totals=[[1, 1], [1, 1]],
+        section_offsets=[0, 0, 0],
+        extents=[[2, 20], [5, 5]],
+    )
+    population = Mock()
+    population.get.return_value = pd.Series(["morph_A", "morph_B", "morph_C"])
+    population.positions.return_value = pd.DataFrame(np.zeros((3, 3)), columns=["x", "y", "z"])
+
+    result = test_module._reachable_gids(population, [1, 2, 3], ["axon"], [mask], lengths)
+    # the extent of morph_C is unknown
+    npt.assert_array_equal(result, [False, False, True])
+
+    result = test_module._reachable_gids(
+        population, [1, 2, 3], ["axon", "basal_dendrite"], [mask], lengths
+    )
+    npt.assert_array_equal(result, [True, False, True])
+
+    result = test_module._reachable_gids(population, [1, 2, 3], ["axon"], [mask], lengths=None)
+    npt.assert_array_equal(result, [True, True, True])
+
+
+@patch.object(test_module, "_reachable_gids", return_value=np.array([True, False, True]))
+@patch.object(test_module, "load_mask")
+@patch.object(test_module, "_segment_points_loader")
+def test__sample_bouton_density_task_with_unreachable_gids(
+    mock_segment_points_loader, mock_load_mask, _
+):
+    mock_load_mask.return_value.lookup.side_effect = lambda points, outer_value: np.ones(
+        len(points), dtype=bool
+    )
+    mock_segment_points_loader.return_value.return_value = _get_segment_points(
+        data=[[0.0, 0.0, 0.0, 1.0, 1.0, 1.0]], index_tuples=[(0, 0)]
+    )
+    population = _mock_edge_population()
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [1, 3],
+            Properties.PRE_SECTION_ID: [1, 1],
+            Properties.PRE_SEGMENT_ID: [0, 0],
+        }
+    )
+
+    result = test_module._sample_bouton_density_task(population, [1, 2, 3], mask="Foo")
+
+    # the morphology and the synapses of the unreachable gid are not loaded
+    assert [args[1] for args, _ in mock_segment_points_loader.call_args_list] == [1, 3]
+    npt.assert_array_equal(population.efferent_edges.call_args[0][0], [1, 3])
+    length = np.sqrt(3)
+    npt.assert_allclose(result, [[1, length, 1 / length], [0, 0, np.nan], [1, length, 1 / length]])
+
+
+@patch.object(test_module, "load_mask")
+@patch.object(test_module, "_segment_points_loader")
+def test_sample_bouton_density_with_multiple_masks(mock_segment_points_loader, mock_load_mask):
+    def _load_mask(mask, atlas_path):
+        # mask A contains only positive points, mask B contains all the points
+        return Mock(
+            lookup=lambda points, outer_value: (
+                np.all(points > 0, axis=-1) if mask == "A" else np.ones(len(points), dtype=bool)
+            )
+        )
+
+    mock_load_mask.side_effect = _load_mask
+    mock_segment_points_loader.return_value.return_value = _get_segment_points(
+        data=[[0.0, 0.0, 0.0, 1.0, 1.0, 1.0], [1.0, 1.0, 1.0, 2.0, 2.0, 2.0]],
+        index_tuples=[(0, 0), (0, 1)],
+    )
+    population = _mock_edge_population()
+    population.source.ids.return_value = [1, 2]
+    population.source.config = {}
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [1, 2, 2],
+            Properties.PRE_SECTION_ID: [1, 1, 1],
+            Properties.PRE_SEGMENT_ID: [0, 0, 1],
+        }
+    )
+
+    actual = test_module.sample_bouton_density(population, n=2, mask=["A", "B"], atlas_path="X")
+
+    assert actual.shape == (2, 2)
+    # the morphologies and the synapses are loaded only once for both the masks
+    assert mock_segment_points_loader.call_count == 2
+    assert population.efferent_edges.call_count == 1
+    length = np.sqrt(3)
+    npt.assert_allclose(actual[:, 0], [0, 1 / length])
+    npt.assert_allclose(actual[:, 1], [1 / (2 * length), 2 / (2 * length)])
+
+
+@patch.object(test_module, "load_mask")
+@patch.object(test_module, "_load_segments_loader")
+def test_sample_bouton_density_with_multiple_neurite_types(
+    mock_load_segments_loader, mock_load_mask
+):
+    mock_load_mask.return_value.lookup.side_effect = lambda points, outer_value: np.all(
+        points < 3, axis=-1
+    )
+    table = _get_segment_points(
+        data=[
+            [0.0, 0.0, 0.0, 1.0, 0.0, 0.0],
+            [1.0, 0.0, 0.0, 3.0, 0.0, 0.0],
+            [0.0, 0.0, 0.0, 0.0, 2.0, 0.0],
+            [0.0, 0.0, 0.0, 0.0, 0.0, 4.0],
+        ],
+        index_tuples=[(0, 0), (0, 1), (1, 0), (2, 0)],
+    )
+    mock_load_segments_loader.return_value.return_value = SegmentTable(
+        starts=table.starts,
+        ends=table.ends,
+        section_ids=table.section_ids,
+        segment_ids=table.segment_ids,
+        section_types=np.array([2, 2, 3, 4]),
+    )
+    population = _mock_edge_population()
+    population.source.ids.return_value = [1]
+    population.source.config = {}
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [1, 1, 1, 1],
+            Properties.PRE_SECTION_ID: [1, 1, 2, 3],
+            Properties.PRE_SEGMENT_ID: [0, 1, 0, 0],
+        }
+    )
+    _mock_source_index(population, [1, 1, 1, 1])
+    neurite_types = ["axon", "basal_dendrite", "apical_dendrite"]
+
+    unmasked = test_module.sample_bouton_density(population, n=1, neurite_type=neurite_types)
+    masked = test_module.sample_bouton_density(
+        population, n=1, neurite_type=neurite_types, mask="A", atlas_path="X"
+    )
+
+    # the morphology is loaded once for all the neurite types
+    assert mock_load_segments_loader.call_count == 2
+    npt.assert_allclose(unmasked, [[4 / 3, 4 / 2, 4 / 4]])
+    npt.assert_allclose(masked, [[1 / 1, 1 / 2, np.nan]])
+
+
+def test_sample_bouton_density_with_invalid_masks():
+    population = MagicMock(EdgePopulation)
+    with pytest.raises(ValueError, match="The list of masks must be non-empty"):
+        test_module.sample_bouton_density(population, n=2, mask=[])
+    with pytest.raises(ValueError, match="The list of masks must be non-empty"):
+        test_module.sample_bouton_density(population, n=2, mask=["A", None])
+    with pytest.raises(ValueError, match="The list of neurite types must be non-empty"):
+        test_module.sample_bouton_density(population, n=2, neurite_type=[])
+
+
+@patch(test_module.__name__ + "._total_lengths_loader", return_value=lambda: [1.0])
+@patch(test_module.__name__ + "._unmasked_bouton_densities", side_effect=[[42.0], [43.0]])
+def test_sample_bouton_density_1(*_):
     population = MagicMock(EdgePopulation)
     population.source.ids.return_value = [1, 2, 3]  # List of synapse IDs
+    population.source.config = {}
+    _mock_source_index(population, [1, 2, 2])
     actual = test_module.sample_bouton_density(population, n=2)
     npt.assert_equal(actual, [42.0, 43.0])
 
 
-@patch(test_module.__name__ + "._calc_bouton_density", side_effect=[42.0, 43.0])
-def test_sample_bouton_density_2(_):
+@patch.object(test_module, "_sample_bouton_density_gids")
+def test_sample_bouton_density_groups(mock_sample_gids):
+    # the synapse count, the segment length and the density of each gid
+    mock_sample_gids.side_effect = lambda population, gids, *args, **kwargs: np.stack(
+        [gids, np.ones(len(gids)), gids * 10.0], axis=-1
+    )
+    groups = {"A": [3, 1], "B": [2, 3, 5], "C": []}
+    population = MagicMock(EdgePopulation)
+    population.source.ids.side_effect = lambda group: groups[group]
+
+    result = test_module.sample_bouton_density_groups(population, n=10, groups=["A", "B", "C"])
+
+    # the gids in common are processed only once, in order of first occurrence
+    assert mock_sample_gids.call_count == 1
+    npt.assert_array_equal(mock_sample_gids.call_args[0][1], [3, 1, 2, 5])
+    assert len(result) == 3
+    npt.assert_array_equal(result[0], [30, 10])
+    npt.assert_array_equal(result[1], [20, 30, 50])
+    assert result[2].shape == (0,)
+
+
+@pytest.mark.parametrize("rel_error", [None, 0.01])
+@patch.object(test_module, "_sample_bouton_density_gids")
+def test_sample_bouton_density_groups_with_seed(mock_sample_gids, rel_error):
+    mock_sample_gids.side_effect = lambda population, gids, *args, **kwargs: np.stack(
+        [gids, np.ones(len(gids)), gids * 1.0], axis=-1
+    )
+    groups = {"A": np.arange(100), "B": np.arange(50, 200)}
+    population = MagicMock(EdgePopulation)
+    population.source.ids.side_effect = lambda group: groups[group]
+    kwargs = {"n": 10, "rel_error": rel_error, "batch_size": 5, "seed": 0}
+
+    result_ab = test_module.sample_bouton_density_groups(population, groups=["A", "B"], **kwargs)
+    np.random.seed(123)
+    result_b = test_module.sample_bouton_density_groups(population, groups=["B"], **kwargs)
+
+    # the sample of each group doesn't depend on the other groups or on the global random state
+    npt.assert_array_equal(result_ab[1], result_b[0])
+    result_a = test_module.sample_bouton_density_groups(
+        population, groups=["A"], **{**kwargs, "seed": 1}
+    )
+    assert not np.array_equal(result_ab[0], result_a[0])
+
+
+@patch(test_module.__name__ + "._sample_bouton_density_gids")
+def test_sample_bouton_density_groups_with_cache(mock_sample_gids):
+    # one column for each neurite type and mask, with synapse count, segment length and density
+    mock_sample_gids.side_effect = lambda population, gids, *args, **kwargs: (
+        gids[:, np.newaxis, np.newaxis, np.newaxis]
+        * np.array([[1.0, 2.0], [3.0, 4.0]])[..., np.newaxis]
+        * np.array([1.0, 2.0, 0.5])
+    )
+    population = MagicMock(EdgePopulation)
+    population.name = "default"
+    population.source.name = "nodes"
+    population.source.config = {}
+    population.source.ids.side_effect = lambda group: {"A": [3, 1], "B": [2, 3, 5]}[group]
+    kwargs = {
+        "neurite_type": ["axon", "basal_dendrite"],
+        "mask": ["roi1", "roi2"],
+        "atlas_path": "atlas",
+    }
+    with tmp_cwd() as tmp_dir:
+        population.h5_filepath = Path(tmp_dir, "edges.h5")
+        population.h5_filepath.touch()
+        cache_dir = Path(tmp_dir, "cache")
+
+        (result,) = test_module.sample_bouton_density_groups(
+            population, n=10, groups=["A"], cache_dir=cache_dir, **kwargs
+        )
+        npt.assert_array_equal(
+            result, mock_sample_gids.side_effect(None, np.array([3, 1]))[..., -1]
+        )
+        result = test_module.sample_bouton_density_groups(
+            population, n=10, groups=["A", "B"], cache_dir=cache_dir, **kwargs
+        )
+
+        # only the gids missing from the cache are processed
+        assert mock_sample_gids.call_count == 2
+        npt.assert_array_equal(mock_sample_gids.call_args[0][1], [2, 5])
+        npt.assert_array_equal(
+            result[1], mock_sample_gids.side_effect(None, np.array([2, 3, 5]))[..., -1]
+        )
+        # one cache for each neurite type, mask and value
+        assert len(list(cache_dir.glob("*.npz"))) == 12
+
+        with pytest.raises(ValueError, match="masks to be given by name"):
+            test_module.sample_bouton_density_groups(
+                population, n=10, groups=["A"], mask=Mock(), cache_dir=cache_dir
+            )
+
+
+@patch(test_module.__name__ + ".compute_distributed")
+def test_sample_bouton_density_groups_distributed(mock_compute):
+    mock_compute.side_effect = lambda func, gids, **kwargs: np.stack(
+        [gids, np.ones(len(gids)), gids * 1.0], axis=-1
+    )
+    population = MagicMock(EdgePopulation)
+    population.name = "default"
+    population.source.name = "nodes"
+    population.source.config = {}
+    population.source.ids.side_effect = lambda group: {"A": [3, 1], "B": [2, 3]}[group]
+    with tmp_cwd() as tmp_dir:
+        population.h5_filepath = Path(tmp_dir, "edges.h5")
+        population.h5_filepath.touch()
+        distributed = {"workdir": tmp_dir, "shard_size": 10, "cluster": "local"}
+
+        result = test_module.sample_bouton_density_groups(
+            population, n=10, groups=["A", "B"], mask="roi", distributed=distributed
+        )
+
+    npt.assert_array_equal(sorted(result[0]), [1, 3])
+    npt.assert_array_equal(sorted(result[1]), [2, 3])
+    # the gids in common are computed only once
+    assert mock_compute.call_count == 1
+    npt.assert_array_equal(sorted(mock_compute.call_args[0][1]), [1, 2, 3])
+    kwargs = mock_compute.call_args[1]
+    assert kwargs["workdir"] == tmp_dir
+    assert kwargs["shard_size"] == 10
+    assert kwargs["cluster"] == "local"
+    assert kwargs["executor_params"] is None
+    assert kwargs["key"]["mask"] == "roi"
+    assert kwargs["key"]["edge_population"] == "default"
+    assert kwargs["key"]["node_population"] == "nodes"
+
+    with pytest.raises(ValueError, match="masks to be given by name"):
+        test_module.sample_bouton_density_groups(
+            population, n=10, groups=["A"], mask=Mock(), distributed=distributed
+        )
+
+
+@patch(test_module.__name__ + "._sample_bouton_density_task")
+def test_sample_bouton_density_2(mock_task):
     population = MagicMock(EdgePopulation)
     population.source.ids.return_value = []  # List of synapse IDs
     actual = test_module.sample_bouton_density(population, n=2)
     npt.assert_equal(actual, [])
+    # no density is calculated when the group is empty
+    mock_task.assert_not_called()
 
 
 def test_sample_pathway_synapse_count_1():
@@ -211,3 +998,34 @@ def test_sample_pathway_synapse_count_1():
     population.iter_connections.return_value = [(0, 0, 42), (0, 0, 43), (0, 0, 44)]
     actual = test_module.sample_pathway_synapse_count(population, n=2)
     npt.assert_equal(actual, [42, 43])
+
+
+def test_sample_pathway_synapse_count_with_rel_error():
+    population = MagicMock(EdgePopulation)
+    population.iter_connections.return_value = [(0, 0, 5)] * 10
+    actual = test_module.sample_pathway_synapse_count(population, n=8, rel_error=0.1, batch_size=3)
+    # the connections with the same synapse count converge after the first batch
+    npt.assert_equal(actual, [5, 5, 5])
+    population.iter_connections.return_value = [(0, 0, 1), (0, 0, 9)] * 5
+    actual = test_module.sample_pathway_synapse_count(population, n=8, rel_error=0.1, batch_size=3)
+    # the sampling stops when n connections have been sampled
+    npt.assert_equal(actual, [1, 9, 1, 9, 1, 9, 1, 9])
+
+
+def test_sample_pathway_synapse_count_with_seed():
+    population = MagicMock(EdgePopulation)
+    # bluepysnap shuffles the connections using the global random state
+    population.iter_connections.side_effect = lambda *args, **kwargs: [
+        (0, 0, i) for i in np.random.permutation(20)
+    ]
+    np.random.seed(0)
+    expected_global = np.random.random()
+
+    np.random.seed(0)
+    first = test_module.sample_pathway_synapse_count(population, n=5, pre="A", post="B", seed=1)
+    assert np.random.random() == expected_global
+    second = test_module.sample_pathway_synapse_count(population, n=5, pre="A", post="B", seed=1)
+    other = test_module.sample_pathway_synapse_count(population, n=5, pre="A", post="C", seed=1)
+
+    npt.assert_equal(first, second)
+    assert not np.array_equal(first, other)
@@ -0,0 +1,132 @@
+from pathlib import Path
+
+import h5py
+import libsonata
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+from bluepysnap.edges import EdgePopulation
+from mock import MagicMock
+from utils import tmp_cwd
+
+import connectome_tools.synapses as test_module
+from connectome_tools.utils import Properties
+
+
+def test_efferent_synapses():
+    population = MagicMock(EdgePopulation)
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [3, 1, 3, 3, 1],
+            Properties.PRE_SECTION_ID: [10, 20, 11, 12, 21],
+            Properties.PRE_SEGMENT_ID: [0, 1, 2, 3, 4],
+        }
+    )
+
+    result = test_module.EfferentSynapses.load(population, [3, 1, 2], with_segments=True)
+
+    population.efferent_edges.assert_called_once()
+    npt.assert_array_equal(population.efferent_edges.call_args[0][0], [1, 2, 3])
+    npt.assert_array_equal(result.counts([3, 1, 2, 5]), [3, 2, 0, 0])
+    assert result.count(3) == 3
+    section_ids, segment_ids = result.segments(3)
+    npt.assert_array_equal(section_ids, [10, 11, 12])
+    npt.assert_array_equal(segment_ids, [0, 2, 3])
+    section_ids, segment_ids = result.segments(2)
+    assert len(section_ids) == len(segment_ids) == 0
+    npt.assert_array_equal(result.segment_keys(1), test_module.segment_keys([20, 21], [1, 4]))
+
+
+def test_segment_keys():
+    result = test_module.segment_keys([0, 0, 3, 2**20], [0, 5, 1, 2**32 - 1], section_offset=1)
+
+    assert result.dtype == np.int64
+    npt.assert_array_equal(result >> 32, [1, 1, 4, 2**20 + 1])
+    npt.assert_array_equal(result & (2**32 - 1), [0, 5, 1, 2**32 - 1])
+    assert len(np.unique(result)) == 4
+
+
+def test_efferent_synapses_without_segments():
+    population = MagicMock(EdgePopulation)
+    population.efferent_edges.return_value = pd.DataFrame({"@source_node": [3, 1, 3]})
+
+    result = test_module.EfferentSynapses.load(population, [1, 3])
+
+    assert population.efferent_edges.call_args[1] == {"properties": ["@source_node"]}
+    with pytest.raises(ValueError, match="loaded without section and segment ids"):
+        result.segments(3)
+
+
+def test_efferent_synapse_counts():
+    with tmp_cwd() as tmp_dir:
+        path = str(Path(tmp_dir, "edges.h5"))
+        # the synapses of gid 3 are not contiguous, so they are split in two ranges
+        with h5py.File(path, "w") as h5:
+            group = h5.create_group("edges/default")
+            group["source_node_id"] = [3, 1, 3, 0, 3]
+            group["target_node_id"] = [0, 0, 1, 1, 2]
+            group["edge_type_id"] = np.full(5, -1)
+            group["0/efferent_section_id"] = np.ones(5, dtype=np.int64)
+        libsonata.EdgePopulation.write_indices(path, "default", 4, 3)
+        population = MagicMock(EdgePopulation)
+        population._population = libsonata.EdgePopulation(path, "", "default")
+
+        result = test_module.efferent_synapse_counts(population, [3, 2, 1])
+
+    npt.assert_array_equal(result, [3, 0, 1])
+    # only the source index is read
+    population.efferent_edges.assert_not_called()
+
+
+def test_efferent_synapses_with_positions():
+    population = MagicMock(EdgePopulation)
+    population.efferent_edges.return_value = pd.DataFrame(
+        {
+            "@source_node": [3, 1, 3, 3, 1],
+            Properties.PRE_CENTER_X: [1.0, 2.0, -1.0, 3.0, -2.0],
+            Properties.PRE_CENTER_Y: [1.0, 2.0, 1.0, 3.0, 2.0],
+            Properties.PRE_CENTER_Z: [1.0, 2.0, 1.0, 3.0, 2.0],
+        }
+    )
+    mask = MagicMock()
+    mask.lookup.side_effect = lambda points, outer_value: np.all(points > 0, axis=-1)
+
+    result = test_module.EfferentSynapses.load(population, [1, 3], with_positions=True)
+
+    assert population.efferent_edges.call_args[1] == {
+        "properties": ["@source_node", *test_module.POSITION_PROPERTIES]
+    }
+    npt.assert_array_equal(result.counts_inside(mask, [3, 1, 2]), [2, 1, 0])
+    assert mask.lookup.call_count == 1
+    with pytest.raises(ValueError, match="loaded without section and segment ids"):
+        result.segments(3)
+
+
+def test_efferent_synapses_without_positions():
+    population = MagicMock(EdgePopulation)
+    population.efferent_edges.return_value = pd.DataFrame({"@source_node": [3, 1, 3]})
+    population.property_names = {Properties.PRE_SECTION_ID, Properties.PRE_SEGMENT_ID}
+
+    result = test_module.EfferentSynapses.load(population, [1, 3])
+
+    assert not test_module.EfferentSynapses.has_positions(population)
+    with pytest.raises(ValueError, match="loaded without positions"):
+        result.counts_inside(MagicMock(), [1, 3])
+
+
+def test_use_synapse_positions(caplog):
+    population = MagicMock(EdgePopulation)
+    population.property_names = {Properties.PRE_SECTION_ID, Properties.PRE_SEGMENT_ID}
+
+    assert not test_module.use_synapse_positions(population, False, ["axon"])
+    # fallback to the segments, when the positions are missing
+    assert not test_module.use_synapse_positions(population, True, ["axon"])
+
+    population.property_names |= set(test_module.POSITION_PROPERTIES)
+    assert test_module.use_synapse_positions(population, True, ["axon"])
+    caplog.clear()
+    # the positions are used only for the axon
+    assert test_module.use_synapse_positions(population, True, ["axon", "basal_dendrite"])
+    assert "matched by segment for basal_dendrite" in caplog.text
+    assert not test_module.use_synapse_positions(population, True, ["apical_dendrite"])
@@ -1,13 +1,15 @@
 import os
 import re
 
+import numpy as np
+import numpy.testing as npt
 import pytest
 from bluepysnap.edges import EdgePopulation
 from bluepysnap.nodes import NodePopulation
 from jsonschema import ValidationError
-from mock import Mock, patch
+from mock import MagicMock, Mock, call, patch
 from psutil import Process
-from utils import TEST_DATA_DIR
+from utils import TEST_DATA_DIR, tmp_cwd
 
 import connectome_tools.utils as test_module
 
@@ -75,6 +77,18 @@ def test_validate_config_success(config_file, schema_name):
     assert result is None
 
 
+def test_validate_strategies_with_executor():
+    config = test_module.load_yaml(TEST_DATA_DIR / "s2f_config_1.yaml")
+    strategy = config[2]["estimate_bouton_reduction"]
+    strategy["backend"] = "submitit"
+    strategy["executor"] = {"slurm_time": 10, "slurm_partition": "prod"}
+    test_module.validate_config(config, "strategies")
+
+    strategy["executor"]["slurm_time"] = "10"
+    with pytest.raises(ValidationError, match=re.escape("'10' is not of type 'integer'")):
+        test_module.validate_config(config, "strategies")
+
+
 def test_validate_strategies_failure_1():
     config_file = "s2f_config_1.yaml"
     schema_name = "strategies"
@@ -181,3 +195,171 @@ def test_get_edge_population_mtypes():
     population.source = []
     population.target = []
     assert test_module.get_edge_population_mtypes(population) == []
+
+
+@pytest.mark.parametrize("size", [0, 1, 3])
+def test_prefetch(size):
+    called = []
+
+    def _make(i):
+        def _func():
+            called.append(i)
+            return i * 10
+
+        return _func
+
+    result = test_module.prefetch((_make(i) for i in range(5)), size=size)
+
+    assert next(result) == 0
+    # no more than `size` callables are called ahead of the consumed result
+    assert len(called) <= 1 + size
+    assert list(result) == [10, 20, 30, 40]
+    assert sorted(called) == [0, 1, 2, 3, 4]
+
+
+def _square(x):
+    return x * x
+
+
+def test_run_parallel_with_initializer():
+    initializer = Mock()
+    tasks = [test_module.Task(_square, i) for i in range(3)]
+
+    with patch.object(test_module, "_INITIALIZED_WORKERS", set()):
+        result = test_module.run_parallel(
+            tasks, jobs=1, base_seed=None, initializer=initializer, initargs=["a", 1]
+        )
+
+    assert [item.value for item in result] == [0, 1, 4]
+    # the tasks are executed in the same process, so the initializer is called only once
+    initializer.assert_called_once_with("a", 1)
+
+
+@pytest.mark.parametrize("backend", ["loky", "threading", "fork"])
+def test_run_parallel_with_backend(backend):
+    tasks = [test_module.Task(_square, i) for i in range(5)]
+
+    result = test_module.run_parallel(tasks, jobs=2, base_seed=None, backend=backend)
+
+    assert [item.value for item in result] == [0, 1, 4, 9, 16]
+    assert [item.id for item in result] == [0, 1, 2, 3, 4]
+
+
+def test_run_parallel_with_submitit(monkeypatch):
+    tasks = [test_module.Task(_square, i) for i in range(3)]
+    with tmp_cwd() as tmp_dir:
+        monkeypatch.setenv("SUBMITIT_FOLDER", str(tmp_dir))
+        monkeypatch.setenv("SUBMITIT_CLUSTER", "debug")
+
+        result = test_module.run_parallel(tasks, jobs=2, base_seed=None, backend="submitit")
+
+    assert [item.value for item in result] == [0, 1, 4]
+
+
+@patch(test_module.__name__ + ".clean_slurm_env")
+@patch(test_module.__name__ + ".submitit.AutoExecutor")
+def test_submitit_pool_with_executor_params(mock_executor, mock_clean_slurm_env, monkeypatch):
+    monkeypatch.setenv("SUBMITIT_FOLDER", "submitit_dir")
+    monkeypatch.setenv("SUBMITIT_CLUSTER", "local")
+    default_params = test_module.default_executor_params()
+
+    with test_module.submitit_executor({"slurm_time": 10}, cluster="debug"):
+        with test_module._POOLS["submitit"](jobs=2, verbose=0):
+            pass
+
+    mock_clean_slurm_env.assert_called_once_with()
+    mock_executor.assert_called_once_with(folder="submitit_dir", cluster="debug")
+    executor = mock_executor.return_value
+    assert executor.update_parameters.call_args_list == [
+        call(**default_params),
+        call(slurm_array_parallelism=2),
+        call(slurm_time=10),
+    ]
+    assert test_module._submitit_executor == ({}, None)
+
+
+def test_worker_pool_with_submitit_executor():
+    tasks = [test_module.Task(_square, i) for i in range(3)]
+    mock_pool = MagicMock(wraps=test_module._POOLS["threading"])
+
+    with patch.dict(test_module._POOLS, {"submitit": mock_pool}):
+        with test_module.worker_pool(jobs=2, backend="submitit"):
+            test_module.run_parallel(tasks, jobs=2, base_seed=None)
+            with test_module.submitit_executor(None):
+                test_module.run_parallel(tasks, jobs=2, base_seed=None)
+            assert mock_pool.call_count == 1
+            # a new pool is created when the parameters of the executor are changed
+            with test_module.submitit_executor({"slurm_time": 10}):
+                test_module.run_parallel(tasks, jobs=2, base_seed=None)
+            assert mock_pool.call_count == 2
+
+
+def test_parallel_backend():
+    tasks = [test_module.Task(_square, i) for i in range(3)]
+    run = Mock(return_value=["result"])
+    mock_pool = MagicMock()
+    mock_pool.return_value.__enter__.return_value = run
+
+    with patch.dict(test_module._POOLS, {"threading": mock_pool}):
+        with test_module.parallel_backend("threading"):
+            with test_module.parallel_backend(None):
+                result = test_module.run_parallel(tasks, jobs=2, base_seed=None)
+
+    assert result == ["result"]
+    mock_pool.assert_called_once()
+    run.assert_called_once()
+    assert test_module._default_backend == test_module.DEFAULT_PARALLEL_BACKEND
+
+    with pytest.raises(ValueError, match="Invalid backend 'invalid'"):
+        with test_module.parallel_backend("invalid"):
+            pass
+    with pytest.raises(ValueError, match="Invalid backend 'invalid'"):
+        test_module.run_parallel(tasks, jobs=2, base_seed=None, backend="invalid")
+
+
+def test_worker_pool():
+    tasks = [test_module.Task(_square, i) for i in range(3)]
+    mock_pool = MagicMock(wraps=test_module._POOLS["threading"])
+
+    with patch.dict(test_module._POOLS, {"threading": mock_pool}):
+        with test_module.worker_pool(jobs=2, backend="threading"):
+            assert test_module._default_backend == "threading"
+            # the pool is reused by the calls with the same backend and jobs
+            for _ in range(3):
+                result = test_module.run_parallel(tasks, jobs=2, base_seed=None)
+                assert [item.value for item in result] == [0, 1, 4]
+            assert mock_pool.call_count == 1
+            # a new pool is created for different jobs
+            result = test_module.run_parallel(tasks, jobs=3, base_seed=None)
+            assert [item.value for item in result] == [0, 1, 4]
+            assert mock_pool.call_count == 2
+
+    assert test_module._active_pool is None
+    assert test_module._default_backend == test_module.DEFAULT_PARALLEL_BACKEND
+
+
+def test_worker_pool_with_initializer():
+    initializer = Mock()
+    tasks = [test_module.Task(_square, i) for i in range(3)]
+
+    with patch.object(test_module, "_INITIALIZED_WORKERS", set()):
+        with test_module.worker_pool(jobs=2, backend="threading"):
+            for _ in range(2):
+                test_module.run_parallel(
+                    tasks, jobs=2, base_seed=None, initializer=initializer, initargs=["a"]
+                )
+
+    # the workers are threads of the same process, initialized only once
+    initializer.assert_called_once_with("a")
+
+
+def test_cost_balanced_chunks():
+    costs = np.array([1, 50, 3, 8, 0, 20, 2])
+
+    result = test_module.cost_balanced_chunks(costs, 3)
+
+    assert len(result) == 3
+    # the most expensive gids are in the first chunks
+    npt.assert_array_equal(result[0], [1])
+    npt.assert_array_equal(result[1], [5])
+    npt.assert_array_equal(result[2], [3, 2, 6, 0, 4])